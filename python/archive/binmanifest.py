@@ -0,0 +1,280 @@
+"""
+Compact binary form of hashem.py manifests.
+
+Layout (all integers little-endian):
+
+    header      magic 'HMAN', u16 version, u16 digest size, u32 records per block, u32 0
+    block*      u32 count, u32 names length,
+                count x u8      type ('F'/'D', | 0x80 if there is a digest)
+                count x u64     size
+                count x i64     mtime_ns
+                count x digest  raw digest bytes (zeros if absent)
+                names           per record: varint shared-prefix, varint suffix length, suffix
+    end         u32 0, u32 0
+    index       per block: u64 offset, u32 count, u32 path length, first path
+    trailer     u64 index offset, u32 block count, u64 record count, magic 'HMAN'
+
+Paths are prefix-compressed against the previous path in the same block, so
+every block decodes on its own; with the index of each block's first path
+that allows 'find' to binary search a manifest without reading all of it.
+Readers and writers stream, and 'iter_records' works on pipes.
+
+Records must be written in manifest order (see hashem.manifest_key).
+"""
+
+from bisect import bisect_right
+import struct
+
+
+MAGIC   = b'HMAN'
+VERSION = 1
+
+HEADER  = struct.Struct('<4sHHII')
+BLOCK   = struct.Struct('<II')
+INDEX   = struct.Struct('<QII')
+TRAILER = struct.Struct('<QIQ4s')
+
+HAS_DIGEST = 0x80
+
+DEFAULT_BLOCK_RECORDS = 4096
+
+
+def manifest_key(path):
+    """ Manifest order: a directory, then everything below it, siblings by name. """
+    return path.replace('/', '\0')
+
+
+def encode_path(path):
+    return path.encode('utf-8', errors='surrogateescape')
+
+
+def decode_path(raw):
+    return raw.decode('utf-8', errors='surrogateescape')
+
+
+def _put_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(buf, pos):
+    value, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def is_binary_manifest(fh):
+    """ True if a (peekable/seekable) binary stream starts with our magic. """
+    if hasattr(fh, 'peek'):
+        return fh.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    pos = fh.tell()
+    magic = fh.read(len(MAGIC))
+    fh.seek(pos)
+    return magic == MAGIC
+
+
+class Record(object):
+    """ One manifest entry; mtime is in nanoseconds and digest is raw bytes (or None). """
+    __slots__ = ('path', 'item_type', 'size', 'mtime_ns', 'digest')
+
+    def __init__(self, path, item_type, size, mtime_ns, digest=None):
+        self.path      = path
+        self.item_type = item_type
+        self.size      = size
+        self.mtime_ns  = mtime_ns
+        self.digest    = digest
+
+    def __eq__(self, rhs):
+        return all(getattr(self, k) == getattr(rhs, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return "Record({})".format(", ".join("{}={!r}".format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class ManifestWriter(object):
+    """
+    Streams Records into a binary manifest, one block at a time.
+
+        with ManifestWriter(open("manifest.bin", "wb")) as writer:
+            for record in records:
+                writer.write(record)
+    """
+
+    def __init__(self, fh, digest_size=16, block_records=DEFAULT_BLOCK_RECORDS):
+        self.fh            = fh
+        self.digest_size   = digest_size
+        self.block_records = block_records
+        self.offset        = 0
+        self.index         = []     # (offset, count, first path bytes)
+        self.records       = 0
+        self._pending      = []
+        self._emit(HEADER.pack(MAGIC, VERSION, digest_size, block_records, 0))
+
+
+    def _emit(self, data):
+        self.fh.write(data)
+        self.offset += len(data)
+
+
+    def write(self, record):
+        self._pending.append(record)
+        if len(self._pending) >= self.block_records:
+            self.flush_block()
+
+
+    def flush_block(self):
+        pending, self._pending = self._pending, []
+        count = len(pending)
+        if not count:
+            return
+
+        digest_size, empty = self.digest_size, bytes(self.digest_size)
+        types, digests, names = bytearray(), bytearray(), bytearray()
+        previous = b''
+        for record in pending:
+            path = encode_path(record.path)
+            shared, limit = 0, min(len(path), len(previous))
+            while shared < limit and path[shared] == previous[shared]:
+                shared += 1
+            _put_varint(names, shared)
+            _put_varint(names, len(path) - shared)
+            names += path[shared:]
+            previous = path
+
+            item_type = ord(record.item_type)
+            if record.digest:
+                if len(record.digest) != digest_size:
+                    raise ValueError("%s: digest is %d bytes, expected %d" % (record.path, len(record.digest), digest_size))
+                item_type |= HAS_DIGEST
+                digests += record.digest
+            else:
+                digests += empty
+            types.append(item_type)
+
+        self.index.append((self.offset, count, encode_path(pending[0].path)))
+        self.records += count
+
+        self._emit(BLOCK.pack(count, len(names)))
+        self._emit(bytes(types))
+        self._emit(struct.pack('<%dQ' % count, *(r.size for r in pending)))
+        self._emit(struct.pack('<%dq' % count, *(r.mtime_ns for r in pending)))
+        self._emit(bytes(digests))
+        self._emit(bytes(names))
+
+
+    def close(self):
+        self.flush_block()
+        self._emit(BLOCK.pack(0, 0))
+        index_offset = self.offset
+        for offset, count, first in self.index:
+            self._emit(INDEX.pack(offset, count, len(first)) + first)
+        self._emit(TRAILER.pack(index_offset, len(self.index), self.records, MAGIC))
+        self.fh.flush()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_exact(fh, size):
+    data = fh.read(size)
+    if len(data) != size:
+        raise EOFError("Truncated manifest")
+    return data
+
+
+def _read_header(fh):
+    magic, version, digest_size, block_records, _ = HEADER.unpack(_read_exact(fh, HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a binary manifest")
+    if version != VERSION:
+        raise ValueError("Unsupported manifest version %d" % version)
+    return digest_size
+
+
+def _read_block(fh, digest_size):
+    """ Returns the list of Records in the block at the current position, or None at the end marker. """
+    count, names_len = BLOCK.unpack(_read_exact(fh, BLOCK.size))
+    if not count:
+        return None
+
+    data = _read_exact(fh, count * (17 + digest_size) + names_len)
+    types = data[:count]
+    sizes = struct.unpack_from('<%dQ' % count, data, count)
+    mtimes = struct.unpack_from('<%dq' % count, data, count * 9)
+    digest_base = count * 17
+    pos = digest_base + count * digest_size
+
+    records, previous = [], b''
+    for i in range(count):
+        shared, pos = _get_varint(data, pos)
+        length, pos = _get_varint(data, pos)
+        path = previous[:shared] + data[pos:pos + length]
+        pos += length
+        previous = path
+
+        item_type = types[i]
+        digest = None
+        if item_type & HAS_DIGEST:
+            start = digest_base + i * digest_size
+            digest = data[start:start + digest_size]
+        records.append(Record(decode_path(path), chr(item_type & ~HAS_DIGEST), sizes[i], mtimes[i], digest))
+
+    return records
+
+
+def iter_records(fh):
+    """ Generator: Records from a binary manifest stream, front to back (no seeking). """
+    digest_size = _read_header(fh)
+    while True:
+        block = _read_block(fh, digest_size)
+        if block is None:
+            return
+        yield from block
+
+
+class ManifestIndex(object):
+    """ Random access into a seekable binary manifest via its block index. """
+
+    def __init__(self, fh):
+        self.fh = fh
+        fh.seek(0)
+        self.digest_size = _read_header(fh)
+
+        fh.seek(-TRAILER.size, 2)
+        index_offset, blocks, self.records, magic = TRAILER.unpack(_read_exact(fh, TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Manifest has no index (truncated?)")
+
+        fh.seek(index_offset)
+        self.offsets, self.keys = [], []
+        for _ in range(blocks):
+            offset, count, length = INDEX.unpack(_read_exact(fh, INDEX.size))
+            self.offsets.append(offset)
+            self.keys.append(manifest_key(decode_path(_read_exact(fh, length))))
+
+
+    def find(self, path):
+        """ Returns the Record for path, or None; reads at most one block. """
+        block = bisect_right(self.keys, manifest_key(path)) - 1
+        if block < 0:
+            return None
+        self.fh.seek(self.offsets[block])
+        for record in _read_block(self.fh, self.digest_size):
+            if record.path == path:
+                return record
+        return None
+
+
+    def __len__(self):
+        return self.records
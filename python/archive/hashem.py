@@ -1,27 +1,128 @@
 #! /usr/bin/python3
 
 import argparse
-import hashlib
-import mmap
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os
 import posixpath
 import stat
 import sys
 
-from collections import namedtuple
+import binmanifest
+from binmanifest import manifest_key
+
+# lib/ is alongside archive/.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.hashing import hash_file
 
 
 exclusions = ('lost+found', 'restore', 'backup', 'Newsfeed', '.pki', 'Jenkins')
 
 joinpath = posixpath.join
 
+# How many items (per job) may be queued ahead of the output writer.
+QUEUE_DEPTH = 64
+
+
+# Manifest lines are "type,size,mtime,checksum,path" with the path relative to
+# the base dir. Entries are in manifest order (see manifest_key): a directory,
+# then everything below it, with siblings sorted by name.
+# mtime is in seconds; mtime_ns, where we have it from a stat or a binary
+# manifest, is the same to the nanosecond, which a float can't hold.
+FileDesc = namedtuple('FileDesc', ['path', 'item_type', 'size', 'mtime', 'checksum', 'mtime_ns'], defaults=(None,))
+
+
+# Manifests may round-trip mtimes through nanoseconds (binary form), so allow
+# for float rounding when comparing them.
+MTIME_EPSILON = 1e-6
+
+
+def same_mtime(lhs, rhs):
+    return abs(lhs - rhs) < MTIME_EPSILON
+
+
+def format_desc(fd):
+    return "{},{},{},{},{}".format(fd.item_type, fd.size, fd.mtime, fd.checksum, fd.path)
+
+
+def parse_desc(line):
+    item_type, size, mtime, checksum, path = line.rstrip('\n').split(',', 4)
+    return FileDesc(path, item_type, int(size), float(mtime), checksum if checksum != '0' else 0)
+
+
+def desc_to_record(fd):
+    digest = bytes.fromhex(fd.checksum) if fd.checksum else None
+    mtime_ns = fd.mtime_ns if fd.mtime_ns is not None else int(round(fd.mtime * 1e9))
+    return binmanifest.Record(fd.path, fd.item_type, fd.size, mtime_ns, digest)
+
+
+def record_to_desc(record):
+    checksum = record.digest.hex() if record.digest else 0
+    return FileDesc(record.path, record.item_type, record.size, record.mtime_ns / 1e9, checksum, record.mtime_ns)
+
+
+def read_manifest(filename):
+    """ Generator: FileDescs from a manifest file, in either text or binary form. """
+    with open(filename, "rb") as fl:
+        if binmanifest.is_binary_manifest(fl):
+            yield from map(record_to_desc, binmanifest.iter_records(fl))
+            return
+        for line in fl:
+            line = line.decode('utf-8', errors='surrogateescape')
+            if line.strip():
+                yield parse_desc(line)
+
+
+def write_manifest(fds, binary, fh=None):
+    """ Write FileDescs as a text manifest, or binary if 'binary', to fh (default: stdout). """
+    if binary:
+        with binmanifest.ManifestWriter(fh or sys.stdout.buffer) as writer:
+            for fd in fds:
+                writer.write(desc_to_record(fd))
+    else:
+        write = (fh or sys.stdout).write
+        for fd in fds:
+            write(format_desc(fd) + "\n")
+
+
+class ManifestCursor(object):
+    """
+    Forward-only lookup into a manifest, for callers visiting paths in
+    manifest order: memory use is one entry regardless of manifest size.
+    """
+    def __init__(self, entries):
+        self._entries = iter(entries)
+        self._current = next(self._entries, None)
+
+    def lookup(self, path):
+        key = manifest_key(path)
+        current = self._current
+        while current is not None and manifest_key(current.path) < key:
+            current = next(self._entries, None)
+        self._current = current
+        if current is not None and current.path == path:
+            return current
+        return None
+
 
-FileDesc = namedtuple('FileDesc', ['full_path', 'item_type', 'size', 'mtime', 'checksum'])
+def get_file_desc(full_path, rel_path, want_checksum, previous=None):
+    """
+    Stat (and if wanted, checksum) a path. If 'previous' describes the same
+    size and mtime with a checksum, that checksum is reused instead.
 
-def get_file_desc(full_path, want_checksum):
+    A symlinked file is described as the file it points to; symlinked
+    directories aren't followed, and are skipped with a note on stderr, as
+    are broken links.
+    """
     try:
-        stinf = os.stat(full_path)
-    except:
+        stinf = os.lstat(full_path)
+        if stat.S_ISLNK(stinf.st_mode):
+            stinf = os.stat(full_path)
+            if stat.S_ISDIR(stinf.st_mode):
+                print("hashem: skipping symlinked directory %s" % full_path, file=sys.stderr)
+                return None
+    except OSError as e:
+        print("hashem: skipping %s: %s" % (full_path, e), file=sys.stderr)
         return None
     if stat.S_ISREG(stinf.st_mode):
         item_type, item_size = 'F', stinf.st_size
@@ -31,33 +132,75 @@ def get_file_desc(full_path, want_checksum):
         return None
 
     checksum = 0
-    if item_type == 'F' and item_size > 0 and want_checksum(full_path):
-        with open(full_path, 'rb') as fl:
-            mm = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
-            checksum = hashlib.md5(mm).hexdigest().lower()
-            mm.close()
-
-    return FileDesc(full_path, item_type, item_size, stinf.st_mtime, checksum)
-
-
-def get_file_stats(base_dir, exclusions, get_checksums=None):
-
+    if item_type == 'F' and item_size > 0 and want_checksum(rel_path):
+        if (previous and previous.checksum and previous.item_type == 'F' and
+                previous.size == item_size and same_mtime(previous.mtime, stinf.st_mtime)):
+            checksum = previous.checksum
+        else:
+            try:
+                checksum = hash_file(full_path, "md5")
+            except OSError:
+                return None
+
+    return FileDesc(rel_path, item_type, item_size, stinf.st_mtime, checksum, stinf.st_mtime_ns)
+
+
+def walk_tree(base_dir, exclusions):
+    """
+    Generator: relative paths of everything below base_dir, in manifest order.
+    Exclusions apply to the top-level only.
+    """
+    def scan(rel_dir):
+        try:
+            with os.scandir(joinpath(base_dir, rel_dir) if rel_dir else base_dir) as it:
+                entries = sorted((e.name, e.is_dir(follow_symlinks=False)) for e in it)
+        except OSError:
+            return
+        for name, is_dir in entries:
+            if not rel_dir and name in exclusions:
+                continue
+            rel_path = joinpath(rel_dir, name) if rel_dir else name
+            yield rel_path
+            if is_dir:
+                yield from scan(rel_path)
+
+    yield from scan('')
+
+
+def get_file_stats(base_dir, exclusions, get_checksums=None, jobs=None, previous=None):
+    """
+    Generator: FileDescs for everything below base_dir in manifest order.
+
+    The walk runs on the calling thread and feeds a pool of stat/hash workers
+    through an ordered window, so output order is deterministic regardless of
+    which worker finishes first.
+
+    :param get_checksums: None for no checksums, empty for all, else relative paths to checksum,
+    :param jobs: number of stat/hash worker threads,
+    :param previous: optional iterable of FileDescs (in manifest order) to reuse checksums from,
+    """
     if get_checksums is None:
         want_checksum = lambda filename: False
     elif not get_checksums:
         want_checksum = lambda filename: True
     else:
+        get_checksums = set(posixpath.normpath(p) for p in get_checksums)
         want_checksum = lambda filename: filename in get_checksums
 
-    for base, dirs, files in os.walk(base_dir):
-
-        if base == base_dir:
-            # Skip top-level cruft
-            dirs[:] = [d for d in dirs if d not in exclusions]
-
-        for filename in files:
-
-            fd = get_file_desc(posixpath.join(base, filename), want_checksum)
+    jobs = jobs or os.cpu_count() or 1
+    cursor = ManifestCursor(previous) if previous is not None else None
+    window = deque()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for rel_path in walk_tree(base_dir, exclusions):
+            prev_fd = cursor.lookup(rel_path) if cursor else None
+            window.append(pool.submit(get_file_desc, joinpath(base_dir, rel_path), rel_path, want_checksum, prev_fd))
+            while len(window) > jobs * QUEUE_DEPTH:
+                fd = window.popleft().result()
+                if fd:
+                    yield fd
+        while window:
+            fd = window.popleft().result()
             if fd:
                 yield fd
 
@@ -68,46 +211,120 @@ def ls_cmd(args):
     else:
         get_checksums = args.filepath or None
 
-    for filedesc in get_file_stats(args.base_dir, exclusions, get_checksums):
-        print("{},{},{},{},{}".format(filedesc.item_type, filedesc.size, filedesc.mtime, filedesc.checksum, filedesc.full_path))
+    previous = read_manifest(args.previous) if args.previous else None
+
+    fds = get_file_stats(args.base_dir, exclusions, get_checksums, jobs=args.jobs, previous=previous)
+    write_manifest(fds, args.binary)
 
 
-class CompareError(Exception):
-    def __init__(self, action, reason):
-        super().__init__("Compare failed")
-        self.action = action
-        self.reason = reason
-    
+def convert_cmd(args):
+    """ Convert a manifest between the text and binary forms (direction is detected). """
+    with open(args.source, "rb") as fl:
+        to_binary = not binmanifest.is_binary_manifest(fl)
+    if to_binary:
+        with open(args.target, "wb") as fh:
+            write_manifest(read_manifest(args.source), True, fh)
+    else:
+        with open(args.target, "w", encoding="utf-8", errors="surrogateescape") as fh:
+            write_manifest(read_manifest(args.source), False, fh)
+
+
+def merge_manifests(remote, local):
+    """
+    Merge-join two FileDesc streams that are both in manifest order, yielding
+    (remote_fd, local_fd) pairs where either side is None if the path is only
+    present on the other. O(n) and holds one entry from each side.
+    """
+    remote, local = iter(remote), iter(local)
+    rfd, lfd = next(remote, None), next(local, None)
+    rkey = manifest_key(rfd.path) if rfd else None
+    lkey = manifest_key(lfd.path) if lfd else None
+
+    while rfd or lfd:
+        if lfd is None or (rfd is not None and rkey < lkey):
+            yield rfd, None
+            rfd = next(remote, None)
+            rkey = manifest_key(rfd.path) if rfd else None
+        elif rfd is None or lkey < rkey:
+            yield None, lfd
+            lfd = next(local, None)
+            lkey = manifest_key(lfd.path) if lfd else None
+        else:
+            yield rfd, lfd
+            rfd, lfd = next(remote, None), next(local, None)
+            rkey = manifest_key(rfd.path) if rfd else None
+            lkey = manifest_key(lfd.path) if lfd else None
+
+
+def compare_entry(remote_fd, local_fd, base_dir):
+    """
+    Decide what, if anything, needs doing to bring a local entry in line with
+    the remote one. Only touches the local disk when the metadata alone can't
+    answer the question (same size, different mtime, remote has a checksum).
+
+    :return: (action, reason) or None if the entry is up to date.
+    """
+    if local_fd is None:
+        return ("mkdir" if remote_fd.item_type == 'D' else "download"), "missing"
+    if remote_fd is None:
+        return "delete", "extra"
+
+    if local_fd.item_type != remote_fd.item_type:
+        return ("mkdir" if remote_fd.item_type == 'D' else "download"), "changed"
+
+    if remote_fd.size != local_fd.size:
+        return "download", "size"
+
+    if same_mtime(remote_fd.mtime, local_fd.mtime):
+        return None
+
+    if remote_fd.item_type == 'F' and remote_fd.size > 0:
+        if not remote_fd.checksum:
+            return "download", "mtime"
+
+        # Ambiguous: stat (and hash, unless a local manifest checksum is
+        # still current) the file itself.
+        local_path = os.path.join(base_dir, local_fd.path)
+        local_fd = get_file_desc(local_path, local_fd.path, lambda fn: True, previous=local_fd)
+        if local_fd is None or local_fd.item_type != 'F':
+            return "download", "missing"
+        if local_fd.size != remote_fd.size:
+            return "download", "size"
+
+        if local_fd.checksum != remote_fd.checksum:
+            return "download", "checksum"
+
+    return "#touched", "mtime"
+
 
 def cmp_cmd(args):
-    do_checksum, dont_checksum = lambda fn: True, lambda fn: False
-    with open(args.csv, "r") as fl:
-        for line in (l.strip() for l in fl):
-            if line:
-                remote_fd     = FileDesc(line.split(',', 4))
-                local_path    = os.path.normpath(os.path.join(args.base_dir, remote_fd.full_path))
-                want_checksum = do_checksum if local_fd.checksum else dont_checksum
-                local_fd      = get_file_desc(local_path, want_checksum)
-
-                try:
-                    if not local_fd:
-                        raise CompareError("download", "missing")
-                    if local_fd.item_type != remote_fd.item_type:
-                        if remote_fd.item_type == 'D':
-                            raise CompareError("mkdir", "changed")
-                        elif remote_fd.item_type == 'F':
-                            raise CompareError("download", "changed")
-                    if remote_fd.size != local_fd.size:
-                        raise CompareError("download", "size")
-                    if remote_fd.checksum != local_fd.checksum:
-                        raise CompareError("download", "checksum")
-                    if remote_fd.mtime != local_fd.mtime:
-                        os.utime(local_fd, (remote_fd.mtime, remote_fd.mtime))
-                        raise CompareError("#touched", "mtime")
-                except CompareError as e:
-                    print("%s,%s,%s,%s" % (e.action, e.reason, remote_fd.mtime, remote_fd.full_path))    
+    """ Compare a remote manifest against the local tree (or a local manifest). """
+    remote = read_manifest(args.csv)
+    if args.local:
+        local = read_manifest(args.local)
+    else:
+        local = get_file_stats(args.base_dir, exclusions, None, jobs=args.jobs)
+
+    deleted = None
+    write = sys.stdout.write
+    for remote_fd, local_fd in merge_manifests(remote, local):
+        # Anything below a directory being deleted goes with it.
+        if remote_fd is None and deleted and local_fd.path.startswith(deleted):
+            continue
+
+        result = compare_entry(remote_fd, local_fd, args.base_dir)
+        if not result:
+            continue
 
+        action, reason = result
+        if action == "delete" and local_fd.item_type == 'D':
+            deleted = local_fd.path + '/'
+        elif action == "#touched" and not args.dry_run:
+            local_path = os.path.join(args.base_dir, local_fd.path)
+            os.utime(local_path, (remote_fd.mtime, remote_fd.mtime))
 
+        fd = remote_fd or local_fd
+        write("%s,%s,%s,%s\n" % (action, reason, fd.mtime, fd.path))
 
 
 if __name__ == "__main__":
@@ -118,11 +335,23 @@ if __name__ == "__main__":
 
     lscmd = subp.add_parser("ls")
     lscmd.add_argument("--checksum", action="store_true", help="Force checksumming")
-    lscmd.add_argument("filepath", action="append", default=[], nargs='*', help="File paths to check")
+    lscmd.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Number of stat/hash threads")
+    lscmd.add_argument("--previous", "-p", type=str, help="Reuse checksums from this manifest where size and mtime match")
+    lscmd.add_argument("--binary", "-b", action="store_true", help="Write a binary manifest (see binmanifest.py)")
+    lscmd.add_argument("filepath", default=[], nargs='*', help="File paths (relative to base) to checksum")
     lscmd.set_defaults(func=ls_cmd)
 
     cmpcmd = subp.add_parser("cmp")
-    lscmd.add_argument("csv", type=str, help="CSV file to check against")
+    cmpcmd.add_argument("--local", "-l", type=str, help="Compare against this local manifest instead of walking")
+    cmpcmd.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Number of stat threads when walking")
+    cmpcmd.add_argument("--dry-run", "-n", dest="dry_run", action="store_true", help="Don't touch local mtimes")
+    cmpcmd.add_argument("csv", type=str, help="Manifest (text or binary) to check against")
+    cmpcmd.set_defaults(func=cmp_cmd)
+
+    convcmd = subp.add_parser("convert", help="Convert between text and binary manifests")
+    convcmd.add_argument("source", type=str, help="Manifest to read")
+    convcmd.add_argument("target", type=str, help="File to write the other form to")
+    convcmd.set_defaults(func=convert_cmd)
 
     args = argp.parse_args(sys.argv[1:])
 
@@ -0,0 +1,50 @@
+from io import BytesIO
+from unittest import TestCase
+
+import binmanifest
+from binmanifest import ManifestIndex, ManifestWriter, Record, iter_records, manifest_key
+
+
+def make_records():
+    paths = ["a", "a/sub", "a/sub/empty", "a/x", "a-b", "a-b/y", "co,mma", "z\udcff"]
+    records = []
+    for n, path in enumerate(sorted(paths, key=manifest_key)):
+        digest = bytes([n] * 16) if n % 2 else None
+        records.append(Record(path, 'F' if n % 3 else 'D', n * 1000, 1792397642179800700 + n, digest))
+    return records
+
+
+class TestBinManifest(TestCase):
+    def write(self, records, block_records):
+        fh = BytesIO()
+        with ManifestWriter(fh, block_records=block_records) as writer:
+            for record in records:
+                writer.write(record)
+        return fh
+
+    def test_round_trip(self) -> None:
+        records = make_records()
+        for block_records in (1, 3, 100):
+            with self.subTest(block_records=block_records):
+                fh = self.write(records, block_records)
+                self.assertTrue(binmanifest.is_binary_manifest(BytesIO(fh.getvalue())))
+                self.assertEqual(list(iter_records(BytesIO(fh.getvalue()))), records)
+
+    def test_empty(self) -> None:
+        fh = self.write([], 10)
+        self.assertEqual(list(iter_records(BytesIO(fh.getvalue()))), [])
+        self.assertIsNone(ManifestIndex(fh).find("a"))
+
+    def test_find(self) -> None:
+        records = make_records()
+        index = ManifestIndex(self.write(records, 3))
+        self.assertEqual(len(index), len(records))
+        for record in records:
+            self.assertEqual(index.find(record.path), record)
+        self.assertIsNone(index.find("0"))
+        self.assertIsNone(index.find("a/w"))
+        self.assertIsNone(index.find("zz"))
+
+    def test_bad_digest(self) -> None:
+        with self.assertRaises(ValueError):
+            self.write([Record("a", 'F', 1, 1, b'short')], 10)
@@ -0,0 +1,119 @@
+import hashlib
+from io import StringIO
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import hashem
+from hashem import FileDesc, ManifestCursor, compare_entry, get_file_stats, merge_manifests
+from binmanifest import manifest_key
+
+
+def write(root, rel_path, data):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    os.utime(path, (1500000000, 1500000000))
+
+
+def fd(path, item_type='F', size=1, mtime=1500000000.0, checksum=0):
+    return FileDesc(path, item_type, size, mtime, checksum)
+
+
+class TestHashem(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = root = self.tmp.name
+        for n in range(30):
+            write(root, "d%02d/f%d" % (n % 4, n), b"x" * n)
+        write(root, "a-b/c", b"abc")
+        write(root, "a/b", b"ab")
+        write(root, "lost+found/junk", b"junk")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_ls_order(self) -> None:
+        # A small window, so workers finishing out of order are put back in order.
+        with patch.object(hashem, "QUEUE_DEPTH", 1):
+            fds = list(get_file_stats(self.root, hashem.exclusions, [], jobs=4))
+        paths = [entry.path for entry in fds]
+        self.assertEqual(paths, sorted(paths, key=manifest_key))
+        self.assertEqual(paths[:4], ["a", "a/b", "a-b", "a-b/c"])
+        self.assertNotIn("lost+found", paths)
+        self.assertEqual(fds, list(get_file_stats(self.root, hashem.exclusions, [], jobs=1)))
+
+        by_path = {entry.path: entry for entry in fds}
+        self.assertEqual(by_path["a-b/c"].checksum, hashlib.md5(b"abc").hexdigest())
+        self.assertEqual((by_path["d00/f0"].size, by_path["d00/f0"].checksum), (0, 0))
+        self.assertEqual(by_path["a"].item_type, 'D')
+
+    def test_previous_checksums(self) -> None:
+        current = list(get_file_stats(self.root, hashem.exclusions, []))
+        # Reused where size and mtime still match, recomputed where they don't.
+        previous = [entry._replace(checksum="cafe") if entry.path == "a/b" else
+                    entry._replace(checksum="f00d", mtime=entry.mtime - 5) if entry.path == "a-b/c" else entry
+                    for entry in current]
+        with patch.object(hashem, "hash_file", wraps=hashem.hash_file) as hash_file:
+            fds = {entry.path: entry for entry in get_file_stats(self.root, hashem.exclusions, [], previous=previous)}
+        self.assertEqual(fds["a/b"].checksum, "cafe")
+        self.assertEqual(fds["a-b/c"].checksum, hashlib.md5(b"abc").hexdigest())
+        self.assertEqual(hash_file.call_count, 1)
+
+    def test_cursor(self) -> None:
+        cursor = ManifestCursor([fd("a"), fd("a/b"), fd("a-b"), fd("z")])
+        self.assertEqual(cursor.lookup("a").path, "a")
+        self.assertIsNone(cursor.lookup("a/a"))
+        self.assertEqual(cursor.lookup("a-b").path, "a-b")
+        self.assertIsNone(cursor.lookup("b"))
+        self.assertEqual(cursor.lookup("z").path, "z")
+        self.assertIsNone(cursor.lookup("zz"))
+
+    def test_merge(self) -> None:
+        remote = [fd("a"), fd("a/b"), fd("a-b"), fd("c")]
+        local = [fd("a"), fd("a/a"), fd("a-b"), fd("d")]
+        pairs = [(r and r.path, l and l.path) for r, l in merge_manifests(remote, local)]
+        self.assertEqual(pairs, [("a", "a"), (None, "a/a"), ("a/b", None), ("a-b", "a-b"),
+                                 ("c", None), (None, "d")])
+        self.assertEqual(list(merge_manifests([], [])), [])
+
+    def test_compare_entry(self) -> None:
+        root = self.root
+        abc = hashlib.md5(b"abc").hexdigest()
+        self.assertEqual(compare_entry(fd("x"), None, root), ("download", "missing"))
+        self.assertEqual(compare_entry(fd("x", 'D', 0), None, root), ("mkdir", "missing"))
+        self.assertEqual(compare_entry(None, fd("x"), root), ("delete", "extra"))
+        self.assertEqual(compare_entry(fd("x", 'D', 0), fd("x"), root), ("mkdir", "changed"))
+        self.assertEqual(compare_entry(fd("x", size=2), fd("x"), root), ("download", "size"))
+        self.assertIsNone(compare_entry(fd("x"), fd("x", mtime=1500000000.0000001), root))
+        self.assertEqual(compare_entry(fd("x", mtime=1), fd("x"), root), ("download", "mtime"))
+
+        # Same size, different mtime, remote checksum: decided by the local file.
+        local = fd("a-b/c", size=3)
+        self.assertEqual(compare_entry(fd("a-b/c", size=3, mtime=1, checksum=abc), local, root), ("#touched", "mtime"))
+        self.assertEqual(compare_entry(fd("a-b/c", size=3, mtime=1, checksum="0" * 32), local, root),
+                         ("download", "checksum"))
+        self.assertEqual(compare_entry(fd("gone", size=3, mtime=1, checksum=abc), fd("gone", size=3), root),
+                         ("download", "missing"))
+
+    def test_symlinks(self) -> None:
+        os.symlink(os.path.join(self.root, "a-b", "c"), os.path.join(self.root, "a", "link"))
+        os.symlink(os.path.join(self.root, "d00"), os.path.join(self.root, "a", "dirlink"))
+        with patch("sys.stderr", new_callable=StringIO) as stderr:
+            fds = {entry.path: entry for entry in get_file_stats(self.root, hashem.exclusions, [])}
+        self.assertEqual((fds["a/link"].size, fds["a/link"].checksum), (3, hashlib.md5(b"abc").hexdigest()))
+        self.assertNotIn("a/dirlink", fds)
+        self.assertNotIn("a/dirlink/f0", fds)
+        self.assertIn("skipping symlinked directory", stderr.getvalue())
+
+    def test_binary_mtimes(self) -> None:
+        # A float can't hold this to the nanosecond; the stat's st_mtime_ns can.
+        mtime_ns = 1500000000123456789
+        os.utime(os.path.join(self.root, "a", "b"), ns=(mtime_ns, mtime_ns))
+        path = os.path.join(self.root, "manifest.bin")
+        with open(path, "wb") as fh:
+            hashem.write_manifest(get_file_stats(self.root, hashem.exclusions, []), True, fh)
+        entries = {entry.path: entry for entry in hashem.read_manifest(path)}
+        self.assertEqual(entries["a/b"].mtime_ns, mtime_ns)
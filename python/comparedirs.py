@@ -1,9 +1,12 @@
 #! /usr/bin/env python3
 
 from   collections import defaultdict
-from   typing import DefaultDict, Tuple
+from   queue import Empty, Queue
+from   threading import Thread
+from   typing import DefaultDict, List, Tuple
 import os
 import shelve
+import sys
 
 from   lib.files import get_hash, walk, PathList
 
@@ -26,6 +29,9 @@ class DirInfo(object):
         # List of FileInfos in this directory
         self.files         = set()
 
+        # Total bytes of the files in this directory
+        self.bytes         = 0
+
         # filename -> set(match folders) where size, hash and name matched
         self.name_matches  = defaultdict(set)
 
@@ -33,10 +39,50 @@ class DirInfo(object):
         self.hash_matches  = defaultdict(list)
 
 
+class FolderSimilarity(object):
+    """ How much content two folders share, by file count and by bytes. """
+    def __init__(self, lhs: str, rhs: str, lhs_info: DirInfo, rhs_info: DirInfo):
+        self.lhs, self.rhs   = lhs, rhs
+        self.lhs_files       = len(lhs_info.files)
+        self.rhs_files       = len(rhs_info.files)
+        self.lhs_bytes       = lhs_info.bytes
+        self.rhs_bytes       = rhs_info.bytes
+        self.shared_files    = 0
+        self.shared_bytes    = 0
+
+
+    @property
+    def count_pct(self) -> float:
+        """ Percentage of the two folders' files that are shared (100 = identical content). """
+        total = self.lhs_files + self.rhs_files
+        return 200. * self.shared_files / total if total else 0.
+
+
+    @property
+    def bytes_pct(self) -> float:
+        """ Percentage of the two folders' bytes that are shared (100 = identical content). """
+        total = self.lhs_bytes + self.rhs_bytes
+        return 200. * self.shared_bytes / total if total else 0.
+
+
+    def __repr__(self):
+        return "<%s('%s', '%s', files=%.1f%%, bytes=%.1f%%)>" % (
+                self.__class__.__name__, self.lhs, self.rhs, self.count_pct, self.bytes_pct)
+
+
 class Comparison(object):
     """ Holds a description of a path comparison. See files, folders, sizes, hashes. """
     DB = "C:\\temp\\hashes.db"
 
+    # Number of threads hashing cache misses in parallel.
+    HASH_WORKERS = os.cpu_count() or 1
+
+    # Upper bound on files waiting for a hash worker, keeps memory flat on huge trees.
+    HASH_QUEUE_SIZE = 256
+
+    # Cache writes are committed to the DB in batches of this many entries.
+    DB_BATCH_SIZE = 512
+
     def __init__(self):
         self.files   = {}                   # Dict[str, FileInfo]
         self.folders = defaultdict(DirInfo) # DefaultDict[str, DirInfo]
@@ -68,7 +114,9 @@ class Comparison(object):
             files[file_path] = file_info
 
             if size > 0:
-                folders[dirname(file_path)].files.add(file_info)
+                dir_info = folders[dirname(file_path)]
+                dir_info.files.add(file_info)
+                dir_info.bytes += size
                 sizes[size].append(file_info)
 
         # Only sizes with > 1 file have anything worth comparing
@@ -87,35 +135,108 @@ class Comparison(object):
                 db.sync()
 
 
-    def match(self, filecallback=None, reverse: bool=False) -> Tuple[int, int]:
+    @staticmethod
+    def _hash_worker(jobs: Queue, results: Queue) -> None:
+        """ Hash-stage thread: hashes FileInfos from 'jobs' until it receives a None. """
+        while True:
+            file_info = jobs.get()
+            if file_info is None:
+                break
+            try:
+                results.put((file_info, get_hash(file_info.path, file_info.size), None))
+            except Exception as e:
+                results.put((file_info, None, e))
+
+
+    def match(self, filecallback=None, reverse: bool=False, workers: int=None, queue_size: int=None) -> Tuple[int, int]:
         """
         Retrieves hashes for all the files found to populate self.matches
 
+        Cache misses are hashed by a pool of worker threads fed through a bounded
+        queue; the calling thread remains the only one that touches the DB or
+        calls 'filecallback', so the callback sees the same (file_info, 0) then
+        (file_info, size) sequence per hashed file as before, just interleaved.
+
+        :param filecallback: Optional progress callback(file_info, bytes_read),
+        :param reverse: Process the largest sizes first,
+        :param workers: Number of hashing threads (default HASH_WORKERS),
+        :param queue_size: Max files queued for hashing (default HASH_QUEUE_SIZE),
         :return: total files that matched, discrete files
         """
         if not self.files:
             raise ValueError("No files found (did you call scan?)")
 
+        workers    = max(1, workers or self.HASH_WORKERS)
+        jobs       = Queue(maxsize=queue_size or self.HASH_QUEUE_SIZE)
+        results    = Queue()
+        pending    = {}         # path -> FileInfo, cache writes not yet committed
+        in_flight  = 0
+
+        threads = [Thread(target=self._hash_worker, args=(jobs, results), daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
         with shelve.open(self.DB) as db:
-            for size, files in sorted(self.sizes.items(), reverse=reverse):
-                for file_info in files:
-                    if file_info.hash:
-                        if filecallback:
-                            filecallback(file_info, size)
-                        continue
-                    dbinf = db.get(file_info.path, None)
-                    if not dbinf or dbinf.mtime != file_info.mtime or dbinf.size != size:
-                        if filecallback:
-                            filecallback(file_info, 0)
-                        file_info.hash = get_hash(file_info.path, size, size)
-                        db[file_info.path] = file_info
-                        self.cache_miss += 1
-                    else:
-                        file_info.hash = dbinf.hash
-                        self.cache_hit  += 1
-                    self.hashes[file_info.hash].append(file_info)
-                    if filecallback:
-                        filecallback(file_info, size)
+
+            def record(file_info):
+                self.hashes[file_info.hash].append(file_info)
+                if filecallback:
+                    filecallback(file_info, file_info.size)
+
+            def commit():
+                # Single writer: only this thread ever writes to the shelf.
+                for path, file_info in pending.items():
+                    db[path] = file_info
+                db.sync()
+                pending.clear()
+
+            def collect(block: bool) -> int:
+                collected = 0
+                while True:
+                    try:
+                        file_info, hash_str, error = results.get(block=block and collected == 0)
+                    except Empty:
+                        return collected
+                    collected += 1
+                    if error:
+                        raise error
+                    file_info.hash = hash_str
+                    pending[file_info.path] = file_info
+                    self.cache_miss += 1
+                    record(file_info)
+                    if len(pending) >= self.DB_BATCH_SIZE:
+                        commit()
+
+            try:
+                for size, files in sorted(self.sizes.items(), reverse=reverse):
+                    for file_info in files:
+                        if file_info.hash:
+                            if filecallback:
+                                filecallback(file_info, size)
+                            continue
+                        dbinf = db.get(file_info.path, None)
+                        if not dbinf or dbinf.mtime != file_info.mtime or dbinf.size != size:
+                            if filecallback:
+                                filecallback(file_info, 0)
+                            # Blocks when the queue is full; workers never wait on us.
+                            jobs.put(file_info)
+                            in_flight += 1
+                        else:
+                            file_info.hash = dbinf.hash
+                            self.cache_hit  += 1
+                            record(file_info)
+                        in_flight -= collect(block=False)
+
+                while in_flight:
+                    in_flight -= collect(block=True)
+
+            finally:
+                for _ in threads:
+                    jobs.put(None)
+                commit()
+
+        for thread in threads:
+            thread.join()
 
         self.matches = {hash_str: infos for hash_str, infos in self.hashes.items() if len(infos) > 1}
         
@@ -145,6 +266,61 @@ class Comparison(object):
                     self.folders[folder].name_matches[name] = folders - {folder,}
 
 
+    def similarity(self, min_pct: float=0.) -> List[FolderSimilarity]:
+        """
+        Scores every pair of folders that share at least one file's content.
+
+        Builds an inverted index of hash -> {folder: count} from the matches, so
+        the cost is proportional to the number of matched files rather than the
+        square of the number of folders. Duplicates within one folder only count
+        as shared as many times as they appear on both sides.
+
+        :param min_pct: Discard pairs whose byte and count overlap are both below this,
+        :return: list of FolderSimilarity, best matches first.
+        """
+        from os.path import dirname
+        if not self.matches:
+            raise ValueError("No matches found (did you call match?)")
+
+        pairs = {}      # Dict[Tuple[str, str], FolderSimilarity]
+
+        for hash_str, files in self.matches.items():
+            # Inverted index entry: which folders have this content, and how often.
+            counts = defaultdict(int)
+            for file_info in files:
+                counts[dirname(file_info.path)] += 1
+            if len(counts) < 2:
+                continue
+
+            size    = files[0].size
+            folders = sorted(counts.items())
+            for lhs_idx, (lhs, lhs_count) in enumerate(folders):
+                for rhs, rhs_count in folders[lhs_idx + 1:]:
+                    pair = pairs.get((lhs, rhs))
+                    if pair is None:
+                        pair = pairs[(lhs, rhs)] = FolderSimilarity(lhs, rhs, self.folders[lhs], self.folders[rhs])
+                    shared = min(lhs_count, rhs_count)
+                    pair.shared_files += shared
+                    pair.shared_bytes += shared * size
+
+        ranked = [p for p in pairs.values() if p.bytes_pct >= min_pct or p.count_pct >= min_pct]
+        ranked.sort(key=lambda p: (p.bytes_pct, p.count_pct, p.shared_bytes), reverse=True)
+        return ranked
+
+
+    def report(self, min_pct: float=0., limit: int=None, fh=None) -> None:
+        """ Writes a ranked folder-similarity report (to stdout by default), see 'similarity'. """
+        fh = fh or sys.stdout
+        ranked = self.similarity(min_pct)
+        if limit:
+            ranked = ranked[:limit]
+        for pair in ranked:
+            print("{:6.2f}% bytes {:6.2f}% files {:>15,} shared".format(
+                    pair.bytes_pct, pair.count_pct, pair.shared_bytes), file=fh)
+            print("  {:s} ({:,} files, {:,} bytes)".format(pair.lhs, pair.lhs_files, pair.lhs_bytes), file=fh)
+            print("  {:s} ({:,} files, {:,} bytes)".format(pair.rhs, pair.rhs_files, pair.rhs_bytes), file=fh)
+
+
 def main(paths: PathList, excludes: PathList = None):
     
     comparison = Comparison()
@@ -154,7 +330,13 @@ def main(paths: PathList, excludes: PathList = None):
     print("Files  :", len(comparison.files))
     print("Sizes  :", len(comparison.sizes))
 
-    comparison.hash()
+    matched, distinct = comparison.match()
+    print("Matches:", matched, "files,", distinct, "distinct")
+    if not distinct:
+        return
+
+    comparison.classify()
+    comparison.report(min_pct=50.)
 
 
 if __name__ == "__main__":
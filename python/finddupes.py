@@ -25,14 +25,13 @@ from collections import defaultdict
 from itertools import chain
 from multiprocessing.pool import ThreadPool as Pool
 
+from lib.walker import TreeWalker
+
 
 # -----------------------------------------------------------------------------
 # Settings.
 class Constants:
 
-    # Pass each worker thread this many stat candidates at a time.
-    STAT_CANDIDATE_CHUNKSIZE = 10
-
     # Pass each worker thread this many files to hash at a time.
     HASH_FILE_CHUNKSIZE = 8
 
@@ -174,69 +173,49 @@ class Catalog(object):
         )
         self.logger         = logger
         self.files_observed = 0
+        self.threads        = threads
         self.pool           = Pool(threads)
 
 
     def _get_files(self):
         """
-        Generator: Yields all files from recursively descending all
-        of the paths provided. No overlap check is provided so files
+        Generator: Yields a FileInfo for every file within our size limits
+        found by recursively descending all of the paths provided, using
+        the parallel lib.walker. No overlap check is provided so files
         may be yielded twice if your paths overlap.
         """
 
         self.files_observed = 0
 
-        num_folders = 0
-
+        folders = []
         for folder in self.folders:
             folder = os.path.normpath(os.path.abspath(folder))
             if not os.path.isdir(folder):
                 self.logger.warning("No such file or directory: %s" % folder)
                 continue
-
             self.logger.info("Scanning %s" % folder)
-            num_folders += 1
-
-            num_files = 0
-            for path, dirs, files in os.walk(folder):
-                if path in self.ignore_folders:
-                    if self.verbosity:
-                        self.logger.info('Ignoring %s' % path)
-                    dirs[:] = []
-                    continue
-                if self.verbosity > 1:
-                    self.logger.debug('Path %s' % path)
-
-                base = path + os.path.sep
-                yield from map(base.__add__, files)
-                self.files_observed += len(files)
-                num_files += len(files)
-
-            if self.verbosity:
-                self.logger.debug("=> %s: %d files" % (folder, num_files))
+            folders.append(folder)
 
-        if not num_folders:
+        if not folders:
             self.logger.error("No folders found to scan.")
+            return
 
+        # Size limits are applied here rather than by the walker, so that
+        # files_observed still counts every file seen, as it always has.
+        walker = TreeWalker(excludes=self.ignore_folders,
+                            workers=self.threads, ordered=False,
+                            onerror=self._walk_error)
+        for entry in walker.walk(folders):
+            self.files_observed += 1
+            if self.min_size <= entry.stat.st_size <= self.max_size:
+                yield FileInfo(entry.path, entry.stat)
 
         self.logger.debug("=> considered %d files" % self.files_observed)
 
 
-    def _get_file_info(self, path):
-        """
-        Returns a FileInfo if the file can be stat'd and meets our size
-        constraints.otherwise None.
-        """
-
-        try:
-            stat = os.stat(path)
-        except IOError:
-            pass
-        else:
-            if self.min_size <= stat.st_size <= self.max_size:
-                return FileInfo(path, stat)
-
-        return None
+    def _walk_error(self, path, error):
+        if self.verbosity:
+            self.logger.info("Skipping %s: %s" % (path, error))
 
 
     def _hash_file(self, info):
@@ -281,16 +260,13 @@ class Catalog(object):
 
         pool_map = self.pool.imap_unordered
 
-        # Invoke the _get_files generate and farm the resulting path lists
-        # to worker threads to stat and translate those that match our
-        # criteria into FileInfos in size buckets.
+        # The walker's threads stat and size-filter the files as they
+        # scan each directory; we just bucket the results by size.
         #
         self.logger.info("building size dict")
-        for fi in pool_map(self._get_file_info, self._get_files(),
-                           chunksize=Constants.STAT_CANDIDATE_CHUNKSIZE):
-            if fi:
-                total_files += 1
-                size_table[fi.size].append(fi)
+        for fi in self._get_files():
+            total_files += 1
+            size_table[fi.size].append(fi)
 
         # Eliminate unique sizes since they can't be duplicates of anything.
         matched_sizes = (l for l in size_table.values() if len(l) > 1)
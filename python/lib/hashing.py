@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+"""
+Streaming file hashing with a registry of algorithms.
+
+Files are read with 'readinto' into a single reusable buffer and each
+hasher is fed a memoryview of the bytes read, so no per-chunk bytes
+objects are created. Several digests can be computed in one pass:
+
+    digests = hash_file_many(path, ("md5", "sha256"))
+    print(digests["md5"], digests["sha256"])
+
+xxhash algorithms are registered when the 'xxhash' package is installed.
+"""
+
+from   typing import BinaryIO, Callable, Dict, Iterable, List, Union
+import hashlib
+
+
+# Type aliases
+HasherFactory = Callable[[], "hashlib._Hash"]
+Algorithm     = Union[str, HasherFactory]
+
+
+# Size of the reusable read buffer.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Name -> constructor for the hashers we know about.
+ALGORITHMS: Dict[str, HasherFactory] = {
+    'md5':     hashlib.md5,
+    'sha1':    hashlib.sha1,
+    'sha256':  hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+
+try:
+    import xxhash
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+    if hasattr(xxhash, 'xxh3_128'):
+        ALGORITHMS['xxh3_64']  = xxhash.xxh3_64
+        ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+
+def register_algorithm(name: str, factory: HasherFactory) -> None:
+    """
+    Make a hasher available by name. The factory must return an object with
+    the hashlib 'update' / 'hexdigest' interface.
+    """
+    if name in ALGORITHMS:
+        raise ValueError("Duplicate hash algorithm: %s" % name)
+    ALGORITHMS[name] = factory
+
+
+def get_hasher(algorithm: Algorithm):
+    """ Returns a new hasher for a registered name or a hashlib-style constructor. """
+    if callable(algorithm):
+        return algorithm()
+    try:
+        return ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("Unknown hash algorithm: %s (have: %s)" % (algorithm, ', '.join(sorted(ALGORITHMS)))) from None
+
+
+def hash_stream(fh: BinaryIO, hashers: List, chunk_size: int=None, limit: int=None) -> int:
+    """
+    Feed everything read from a binary stream to each of the hashers.
+
+    :param fh: Stream supporting readinto (e.g. a file opened 'rb', buffering=0),
+    :param hashers: List of hashlib-style objects to update,
+    :param chunk_size: Size of the read buffer,
+    :param limit: Optional maximum number of bytes to consume,
+    :return: Number of bytes hashed.
+    """
+    buffer = bytearray(chunk_size or DEFAULT_CHUNK_SIZE)
+    view   = memoryview(buffer)
+    total  = 0
+    readinto = fh.readinto
+
+    while limit is None or total < limit:
+        window = view if limit is None or limit - total >= len(view) else view[:limit - total]
+        count  = readinto(window)
+        if not count:
+            break
+        chunk = view[:count]
+        for hasher in hashers:
+            hasher.update(chunk)
+        total += count
+
+    return total
+
+
+def hash_file_many(file_path: str, algorithms: Iterable[Algorithm], chunk_size: int=None) -> Dict[Algorithm, str]:
+    """ Compute several hex digests of a file in a single read pass. """
+    algorithms = tuple(algorithms)
+    hashers    = [get_hasher(a) for a in algorithms]
+    with open(file_path, "rb", buffering=0) as fh:
+        hash_stream(fh, hashers, chunk_size)
+    return {a: h.hexdigest() for a, h in zip(algorithms, hashers)}
+
+
+def hash_file(file_path: str, algorithm: Algorithm="md5", chunk_size: int=None) -> str:
+    """ Returns the hex digest of a file's content (empty files are fine). """
+    return hash_file_many(file_path, (algorithm,), chunk_size)[algorithm]
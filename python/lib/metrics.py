@@ -0,0 +1,170 @@
+"""
+Run metrics: operation latencies, bytes per channel, and an optional trace.
+
+A Recorder collects
+
+  * a latency histogram per kind of operation (a listing, a checksum batch, a
+    download, ...), timed with
+
+        with recorder.timed("listdir", path=rel_path):
+            ...
+
+  * bytes transferred per channel -- by default the name of the thread that
+    moved them, e.g. "download-2",
+  * spans and counters from a Pipeline (lib/pipeline.py) it is attached to.
+
+summary() gives a plain-text end-of-run report. With tracing on, every
+timed operation and pipeline item is also kept as an event, and write_trace()
+saves them in Chrome's trace-event format, to be opened in chrome://tracing or
+https://ui.perfetto.dev to see where a run spent its time.
+"""
+
+from   contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from   typing import Any, Dict, Iterator, List, Optional
+
+
+""" Upper bounds of the histogram buckets, in seconds: 1ms doubling up to ~65s. """
+BUCKETS = [0.001 * 2 ** idx for idx in range(17)]
+
+
+class Histogram(object):
+    """ Counts of durations in power-of-two buckets, with the exact count, total, min and max. """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.min    = None
+        self.max    = None
+
+
+    def add(self, seconds: float) -> None:
+        idx = 0
+        while idx < len(BUCKETS) and seconds > BUCKETS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+
+    def percentile(self, pct: float) -> float:
+        """ Upper bound of the bucket the pct'th percentile falls in (the max, for the last bucket). """
+        if not self.count:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKETS[idx], self.max) if idx < len(BUCKETS) else self.max
+        return self.max
+
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Recorder(object):
+    """
+    Thread-safe collector of run metrics; see the module documentation.
+
+    :param trace: Keep events for write_trace(),
+    """
+
+    def __init__(self, trace: bool = False):
+        self.trace      = trace
+        self.histograms: Dict[str, Histogram] = {}
+        self.bytes:      Dict[str, int] = {}
+        self._lock      = threading.Lock()
+        self._events:    List[Dict[str, Any]] = []
+        self._tids:      Dict[str, int] = {}
+        self._origin    = time.monotonic()
+        self._pid       = os.getpid()
+
+
+    def _event(self, event: Dict[str, Any]) -> None:
+        """ Add a trace event, stamped with our pid and a tid per thread name. Needs the lock held. """
+        thread = threading.current_thread().name
+        tid = self._tids.setdefault(thread, len(self._tids) + 1)
+        event.update(pid=self._pid, tid=tid)
+        self._events.append(event)
+
+
+    def record(self, op: str, started: float, duration: float, category: str = "op", **args) -> None:
+        """ Record an operation that began at 'started' (time.monotonic()) and took 'duration' seconds. """
+        with self._lock:
+            histogram = self.histograms.get(op)
+            if histogram is None:
+                histogram = self.histograms[op] = Histogram()
+            histogram.add(duration)
+            if self.trace:
+                self._event({'name': op, 'cat': category, 'ph': 'X',
+                             'ts': (started - self._origin) * 1e6, 'dur': duration * 1e6,
+                             'args': args})
+
+
+    @contextmanager
+    def timed(self, op: str, **args) -> Iterator[None]:
+        """ Time the block as one 'op'; any keyword arguments go into its trace event. """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(op, started, time.monotonic() - started, **args)
+
+
+    def span(self, name: str, category: str, started: float, duration: float, **args) -> None:
+        """ A trace event that isn't counted in the histograms, e.g. a pipeline stage's item. """
+        if self.trace:
+            with self._lock:
+                self._event({'name': name, 'cat': category, 'ph': 'X',
+                             'ts': (started - self._origin) * 1e6, 'dur': duration * 1e6, 'args': args})
+
+
+    def counter(self, name: str, values: Dict[str, float]) -> None:
+        """ A sample of one or more named values over time, e.g. queue depths. """
+        if self.trace:
+            with self._lock:
+                self._event({'name': name, 'ph': 'C', 'ts': (time.monotonic() - self._origin) * 1e6,
+                             'args': dict(values)})
+
+
+    def add_bytes(self, nbytes: int, channel: Optional[str] = None) -> None:
+        channel = channel or threading.current_thread().name
+        with self._lock:
+            self.bytes[channel] = self.bytes.get(channel, 0) + nbytes
+
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self._origin
+        with self._lock:
+            lines = ["%-16s %8s %9s %9s %9s %9s %9s" % ("operation", "count", "mean ms", "p50 ms", "p90 ms",
+                                                         "p99 ms", "max ms")]
+            for op, h in sorted(self.histograms.items()):
+                lines.append("%-16s %8d %9.1f %9.1f %9.1f %9.1f %9.1f" % (
+                    op, h.count, h.mean * 1e3, h.percentile(50) * 1e3, h.percentile(90) * 1e3,
+                    h.percentile(99) * 1e3, (h.max or 0) * 1e3))
+            if self.bytes:
+                lines.append("%-16s %14s %12s" % ("channel", "bytes", "KB/s"))
+                for channel, total in sorted(self.bytes.items()):
+                    lines.append("%-16s %14d %12.1f" % (channel, total, total / 1024 / elapsed if elapsed else 0.0))
+                total = sum(self.bytes.values())
+                lines.append("%-16s %14d %12.1f" % ("total", total, total / 1024 / elapsed if elapsed else 0.0))
+        return "\n".join(lines)
+
+
+    def write_trace(self, path: str) -> None:
+        """ Save the events in Chrome trace-event (JSON object) format. """
+        with self._lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': thread}}
+                     for thread, tid in self._tids.items()]
+            events = names + self._events
+        with open(path, "w") as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
@@ -0,0 +1,419 @@
+"""
+Multi-stage threaded pipelines.
+
+A Pipeline is a set of named Stages, each with its own pool of worker
+threads and its own (optionally bounded) input queue. A stage function is
+called as func(context, item, emit), where 'context' is whatever the stage's
+per-worker 'setup' returned (e.g. a session, so every thread has its own
+connection) and emit(item, to=None) passes results on:
+
+  * to a named stage,
+  * or, by default, to the stage's outputs: the one chosen by its 'router'
+    if it has one, otherwise every output (fan-out).
+
+Any number of stages may emit into the same stage (fan-in), including itself
+-- e.g. a directory lister emitting sub-directories back to its own queue.
+
+    pipe = Pipeline()
+    pipe.add_stage(Stage("walk", walk_dir, workers=4, queue_size=0, outputs=["hash"]))
+    pipe.add_stage(Stage("hash", hash_files, workers=8, batch_size=64))
+    pipe.start()
+    pipe.put("walk", root)
+    pipe.drain()
+    print(pipe.metrics())
+
+Bounded queues give back-pressure: emit() blocks while the target's queue
+is full. A stage that feeds itself should have an unbounded queue
+(queue_size=0), or its workers can end up blocked on their own queue.
+
+An exception from a stage function doesn't stop the stage: the item is
+routed to the stage's 'errors' stage as an ItemError, or failing that
+appended to Pipeline.failures and logged. Nor does one from on_idle: the
+worker tears its context down and sets up a new one.
+
+Each stage counts what it received, processed and failed, how busy its
+workers were, the deepest its queue got and how long producers spent blocked
+on it being full; report() tabulates that. Given a Recorder (lib/metrics.py)
+the pipeline also adds a trace span for every item (or batch) a stage runs,
+and samples queue depths while it runs.
+
+drain() waits until everything put in, and everything emitted as a result,
+has been processed, then stops the workers; cancel() discards anything not
+yet started and stops them as soon as their current items are done. Workers
+are told to stop with a private sentinel object compared by identity, so no
+item value can be mistaken for it.
+"""
+
+import logging
+from   queue import Empty, Queue
+import threading
+import time
+from   typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+""" Tells a worker to exit. Compared by identity. """
+_STOP = object()
+
+
+class ItemError(NamedTuple):
+    """ What a stage's 'errors' stage receives when it fails to process an item. """
+    stage: str
+    item:  Any
+    error: Exception
+
+
+class Stage(object):
+    """
+    :param name:          Unique name of the stage,
+    :param func:          Called as func(context, item, emit) -- or with a list of items, if batching,
+    :param workers:       Number of threads,
+    :param queue_size:    Bound on the input queue, 0 for unbounded,
+    :param outputs:       Stages that emit(item) sends to by default,
+    :param router:        Optional callable(item) -> name of the output to send an item to,
+    :param errors:        Optional name of a stage to send ItemErrors to,
+    :param setup:         Optional callable() run by each worker thread to create its context,
+    :param teardown:      Optional callable(context) run as each worker exits; by default the
+                          context's close() method is called, if it has one,
+    :param batch_size:    Hand func lists of up to this many items,
+    :param batch_weight:  Optional callable(item) -> weight, e.g. a file size, for ...
+    :param batch_limit:   ... ending a batch once its total weight reaches this,
+    :param batch_timeout: How long to wait for more items before running a partial batch,
+    :param idle_timeout:  Call on_idle(context) when a worker has had nothing to do for this long,
+    :param on_idle:       e.g. a keep-alive for the worker's session,
+    """
+
+    def __init__(self, name: str, func: Callable[[Any, Any, Callable], None], workers: int = 1,
+                 queue_size: int = 64, outputs: List[str] = None, router: Callable[[Any], str] = None,
+                 errors: str = None, setup: Callable[[], Any] = None, teardown: Callable[[Any], None] = None,
+                 batch_size: int = None, batch_weight: Callable[[Any], int] = None, batch_limit: int = None,
+                 batch_timeout: float = 0.5, idle_timeout: float = None, on_idle: Callable[[Any], None] = None):
+        self.name          = name
+        self.func          = func
+        self.workers       = max(1, workers)
+        self.queue         = Queue(maxsize=max(0, queue_size))
+        self.outputs       = list(outputs or ())
+        self.router        = router
+        self.errors        = errors
+        self.setup         = setup
+        self.teardown      = teardown
+        self.batch_size    = batch_size
+        self.batch_weight  = batch_weight
+        self.batch_limit   = batch_limit
+        self.batch_timeout = batch_timeout
+        self.idle_timeout  = idle_timeout
+        self.on_idle       = on_idle
+
+        # Metrics
+        self.received      = 0
+        self.processed     = 0
+        self.failed        = 0
+        self.busy_time     = 0.0
+        self.blocked_time  = 0.0
+        self.max_queued    = 0
+        self.active        = 0
+        self._lock         = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+
+    def metrics(self, elapsed: float) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'workers':     self.workers,
+                'queued':      self.queue.qsize(),
+                'received':    self.received,
+                'processed':   self.processed,
+                'failed':      self.failed,
+                'max_queued':  self.max_queued,
+                'blocked':     self.blocked_time,
+                'busy':        self.busy_time / (elapsed * self.workers) if elapsed else 0.0,
+                'per_second':  self.processed / elapsed if elapsed else 0.0,
+            }
+
+
+class Pipeline(object):
+    """
+    A set of connected Stages; see the module documentation.
+
+    :param on_error:        Optional callable(ItemError) for failures of stages without an 'errors' stage,
+    :param recorder:        Optional lib.metrics.Recorder for trace spans and queue depth samples,
+    :param sample_interval: How often to sample queue depths for the recorder's trace (seconds),
+    """
+
+    def __init__(self, on_error: Callable[[ItemError], None] = None, logger=logging, recorder=None,
+                 sample_interval: float = 0.5):
+        self.logger       = logger
+        self.on_error     = on_error
+        self.recorder     = recorder
+        self.sample_interval = sample_interval
+        self.failures: List[ItemError] = []
+        self._stages: Dict[str, Stage] = {}
+        self._outstanding = 0
+        self._idle        = threading.Condition()
+        self._cancelled   = threading.Event()
+        self._finished    = threading.Event()
+        self._started     = None
+        self._stopped     = None
+
+
+    def add_stage(self, stage: Stage) -> Stage:
+        if stage.name in self._stages:
+            raise ValueError("Duplicate stage name: %s" % stage.name)
+        if self._started is not None:
+            raise RuntimeError("Cannot add stages to a running pipeline")
+        self._stages[stage.name] = stage
+        return stage
+
+
+    def __getitem__(self, name: str) -> Stage:
+        return self._stages[name]
+
+
+    def start(self) -> "Pipeline":
+        for stage in self._stages.values():
+            for name in stage.outputs + ([stage.errors] if stage.errors else []):
+                if name not in self._stages:
+                    raise ValueError("Stage %s: unknown output stage %s" % (stage.name, name))
+        self._started = time.monotonic()
+        for stage in self._stages.values():
+            stage._threads = [
+                threading.Thread(target=self._run, args=(stage,), name="%s-%d" % (stage.name, idx), daemon=True)
+                for idx in range(stage.workers)
+            ]
+            for thread in stage._threads:
+                thread.start()
+        if self.recorder is not None and self.recorder.trace:
+            threading.Thread(target=self._sample, name="pipeline-sampler", daemon=True).start()
+        return self
+
+
+    def _sample(self) -> None:
+        while not self._finished.wait(self.sample_interval):
+            self.recorder.counter("queued", {name: stage.queue.qsize() for name, stage in self._stages.items()})
+
+
+    def put(self, stage: str, item: Any) -> None:
+        """ Feed an item into a stage; blocks while its queue is full. """
+        if self._cancelled.is_set():
+            raise RuntimeError("Pipeline has been cancelled")
+        target = self._stages[stage]
+        with self._idle:
+            self._outstanding += 1
+        with target._lock:
+            target.received += 1
+        if target.queue.maxsize:
+            started = time.monotonic()
+            target.queue.put(item)
+            blocked = time.monotonic() - started
+        else:
+            target.queue.put(item)
+            blocked = 0.0
+        with target._lock:
+            target.blocked_time += blocked
+            target.max_queued = max(target.max_queued, target.queue.qsize())
+
+
+    def _emitter(self, stage: Stage) -> Callable[..., None]:
+        def emit(item: Any, to: Optional[str] = None) -> None:
+            if self._cancelled.is_set():
+                return
+            if to is not None:
+                self.put(to, item)
+            elif stage.router is not None:
+                self.put(stage.router(item), item)
+            else:
+                for name in stage.outputs:
+                    self.put(name, item)
+        return emit
+
+
+    def _done(self, count: int) -> None:
+        with self._idle:
+            self._outstanding -= count
+            if self._outstanding == 0:
+                self._idle.notify_all()
+
+
+    def _next_batch(self, stage: Stage, first: Any) -> List[Any]:
+        batch  = [first]
+        weigh  = stage.batch_weight
+        weight = weigh(first) if weigh else 0
+        while len(batch) < stage.batch_size and (stage.batch_limit is None or weight < stage.batch_limit):
+            try:
+                item = stage.queue.get(timeout=stage.batch_timeout)
+            except Empty:
+                break
+            if item is _STOP:
+                # Put it back for whoever is next; this batch still gets run.
+                stage.queue.put(item)
+                break
+            batch.append(item)
+            weight += weigh(item) if weigh else 0
+        return batch
+
+
+    def _fail(self, stage: Stage, item: Any, error: Exception) -> None:
+        failure = ItemError(stage.name, item, error)
+        with stage._lock:
+            stage.failed += 1
+        if stage.errors and not self._cancelled.is_set():
+            self.put(stage.errors, failure)
+            return
+        self.logger.error("%s: failed on %s: %s", stage.name, item, error)
+        self.failures.append(failure)
+        if self.on_error:
+            try:
+                self.on_error(failure)
+            except Exception as e:
+                self.logger.error("%s: on_error failed: %s", stage.name, e)
+
+
+    def _setup(self, stage: Stage) -> Tuple[Any, Optional[Exception]]:
+        """ A worker's context: returns (context, None), or (None, exception) if setup failed. """
+        try:
+            return (stage.setup() if stage.setup else None), None
+        except Exception as e:
+            # Without a context this worker can only fail whatever it picks up,
+            # but it has to keep doing so or a drain would never finish.
+            self.logger.error("%s: worker setup failed: %s", stage.name, e)
+            return None, e
+
+
+    def _teardown(self, stage: Stage, context: Any) -> None:
+        try:
+            if stage.teardown:
+                stage.teardown(context)
+            elif hasattr(context, "close"):
+                context.close()
+        except Exception as e:
+            self.logger.warning("%s: worker teardown failed: %s", stage.name, e)
+
+
+    def _run(self, stage: Stage) -> None:
+        logger  = self.logger
+        emit    = self._emitter(stage)
+        context, setup_error = self._setup(stage)
+
+        timeout = stage.idle_timeout if stage.on_idle else None
+        try:
+            while True:
+                try:
+                    item = stage.queue.get(timeout=timeout)
+                except Empty:
+                    if not setup_error:
+                        try:
+                            stage.on_idle(context)
+                        except Exception as e:
+                            # e.g. the keep-alive found the session dead: start afresh.
+                            logger.warning("%s: on_idle failed (%s), setting the worker up again", stage.name, e)
+                            self._teardown(stage, context)
+                            context, setup_error = self._setup(stage)
+                    continue
+                if item is _STOP:
+                    break
+
+                work = self._next_batch(stage, item) if stage.batch_size else item
+                count = len(work) if stage.batch_size else 1
+                try:
+                    if self._cancelled.is_set():
+                        continue
+                    started = time.monotonic()
+                    with stage._lock:
+                        stage.active += 1
+                    try:
+                        if setup_error:
+                            raise setup_error
+                        stage.func(context, work, emit)
+                    except Exception as e:
+                        self._fail(stage, work, e)
+                    finally:
+                        duration = time.monotonic() - started
+                        with stage._lock:
+                            stage.active -= 1
+                            stage.processed += count
+                            stage.busy_time += duration
+                        if self.recorder is not None:
+                            self.recorder.span(stage.name, "stage", started, duration, items=count)
+                finally:
+                    self._done(count)
+        finally:
+            if setup_error is None:
+                self._teardown(stage, context)
+            logger.debug("%s: worker exiting", stage.name)
+
+
+    def _stop_workers(self) -> None:
+        for stage in self._stages.values():
+            for _ in stage._threads:
+                stage.queue.put(_STOP)
+        for stage in self._stages.values():
+            for thread in stage._threads:
+                thread.join()
+        self._finished.set()
+        self._stopped = time.monotonic()
+
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Wait for all work, including work emitted by other work, to finish and
+        stop the workers. Returns False if it timed out (workers still running).
+        """
+        with self._idle:
+            if not self._idle.wait_for(lambda: self._outstanding == 0, timeout=timeout):
+                return False
+        self._stop_workers()
+        return True
+
+
+    def cancel(self) -> None:
+        """ Discard queued work and stop the workers once their current items are done. """
+        self._cancelled.set()
+        for stage in self._stages.values():
+            while True:
+                try:
+                    item = stage.queue.get_nowait()
+                except Empty:
+                    break
+                if item is not _STOP:
+                    self._done(1)
+        with self._idle:
+            self._idle.wait_for(lambda: self._outstanding == 0)
+        self._stop_workers()
+
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
+    def depth(self, stage: str) -> int:
+        """ Number of items waiting in a stage's queue. """
+        return self._stages[stage].queue.qsize()
+
+
+    def idle(self, stage: str) -> int:
+        """ Number of a stage's workers not working on an item right now. """
+        target = self._stages[stage]
+        with target._lock:
+            return target.workers - target.active
+
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Per-stage counts, queue depth (now and deepest), seconds producers were
+        blocked on a full queue, utilisation ('busy', 0-1) and throughput.
+        """
+        if self._started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._stopped or time.monotonic()) - self._started
+        return {name: stage.metrics(elapsed) for name, stage in self._stages.items()}
+
+
+    def report(self) -> str:
+        lines = ["%-16s %7s %7s %7s %9s %7s %9s %6s %9s" % (
+            "stage", "workers", "queued", "max q", "processed", "failed", "blocked s", "busy", "items/s")]
+        for name, m in self.metrics().items():
+            lines.append("%-16s %7d %7d %7d %9d %7d %9.2f %5.0f%% %9.1f" % (
+                name, m['workers'], m['queued'], m['max_queued'], m['processed'], m['failed'], m['blocked'],
+                m['busy'] * 100, m['per_second']))
+        return "\n".join(lines)
@@ -0,0 +1,55 @@
+import hashlib
+from io import BytesIO
+import os
+import tempfile
+from unittest import TestCase
+
+from hashing import ALGORITHMS, get_hasher, hash_file, hash_file_many, hash_stream, register_algorithm
+
+
+class TestHashing(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def write(self, name, data) -> str:
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return path
+
+    def test_empty_file(self) -> None:
+        path = self.write("empty", b"")
+        self.assertEqual(hash_file(path), hashlib.md5().hexdigest())
+        self.assertEqual(hash_file(path, "sha256", chunk_size=1), hashlib.sha256().hexdigest())
+
+    def test_larger_than_buffer(self) -> None:
+        data = os.urandom(10000)
+        path = self.write("data", data)
+        # Buffer sizes that do and don't divide the file evenly.
+        for chunk_size in (1, 7, 1000, 9999, 10000, 65536):
+            digests = hash_file_many(path, ("md5", "sha1", hashlib.sha256), chunk_size)
+            self.assertEqual(digests["md5"], hashlib.md5(data).hexdigest(), chunk_size)
+            self.assertEqual(digests["sha1"], hashlib.sha1(data).hexdigest(), chunk_size)
+            self.assertEqual(digests[hashlib.sha256], hashlib.sha256(data).hexdigest(), chunk_size)
+
+    def test_stream_limit(self) -> None:
+        hasher = hashlib.md5()
+        self.assertEqual(hash_stream(BytesIO(b"x" * 100), [hasher], chunk_size=16, limit=40), 40)
+        self.assertEqual(hasher.hexdigest(), hashlib.md5(b"x" * 40).hexdigest())
+
+    def test_registry(self) -> None:
+        self.assertIn("blake2b", ALGORITHMS)
+        with self.assertRaises(ValueError):
+            get_hasher("no-such-hash")
+        with self.assertRaises(ValueError):
+            register_algorithm("md5", hashlib.md5)
+
+        register_algorithm("sha512-test", hashlib.sha512)
+        try:
+            path = self.write("data", b"abc")
+            self.assertEqual(hash_file(path, "sha512-test"), hashlib.sha512(b"abc").hexdigest())
+        finally:
+            del ALGORITHMS["sha512-test"]
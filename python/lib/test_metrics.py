@@ -0,0 +1,43 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from metrics import Histogram, Recorder
+from pipeline import Pipeline, Stage
+
+
+class TestMetrics(TestCase):
+    def test_histogram(self) -> None:
+        h = Histogram()
+        for ms in [0.5, 1.5, 3, 3, 3, 3, 3, 3, 3, 100]:
+            h.add(ms / 1000)
+        self.assertEqual(h.count, 10)
+        self.assertAlmostEqual(h.max, 0.1)
+        self.assertAlmostEqual(h.percentile(50), 0.004)     # the 2-4ms bucket
+        self.assertAlmostEqual(h.percentile(100), 0.1)      # capped at the max
+
+    def test_pipeline_trace(self) -> None:
+        recorder = Recorder(trace=True)
+        pipe = Pipeline(recorder=recorder)
+        pipe.add_stage(Stage("double", lambda ctx, n, emit: emit(n * 2), outputs=["sum"]))
+        pipe.add_stage(Stage("sum", lambda ctx, batch, emit: recorder.add_bytes(sum(batch), "sum"),
+                             batch_size=4, batch_timeout=0.01))
+        pipe.start()
+        for n in range(10):
+            with recorder.timed("put", n=n):
+                pipe.put("double", n)
+        pipe.drain()
+
+        self.assertEqual(recorder.bytes, {"sum": 90})
+        self.assertEqual(recorder.histograms["put"].count, 10)
+        self.assertIn("double", pipe.report())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            recorder.write_trace(path)
+            with open(path) as fh:
+                events = json.load(fh)["traceEvents"]
+        spans = [event for event in events if event["ph"] == "X" and event["name"] == "double"]
+        self.assertEqual(len(spans), 10)
+        self.assertTrue(any(event["ph"] == "M" and event["args"]["name"] == "double-0" for event in events))
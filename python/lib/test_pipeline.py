@@ -0,0 +1,146 @@
+import threading
+import time
+from unittest import TestCase
+
+from pipeline import ItemError, Pipeline, Stage
+
+
+class TestPipeline(TestCase):
+    def test_tree_walk_with_fan_out(self) -> None:
+        """ A stage that feeds itself, routing leaves to one of two stages, with batching. """
+        tree = {1: [2, 3], 2: [4, 5, 6], 3: [7], 4: [], 5: [8, 9], 6: [], 7: [], 8: [], 9: []}
+        evens, odds, lock = [], [], threading.Lock()
+
+        def walk(ctx, node, emit):
+            for child in tree[node]:
+                emit(child, to="walk")
+            emit(node)
+
+        def collect(into):
+            def func(ctx, batch, emit):
+                with lock:
+                    into.extend(batch)
+            return func
+
+        pipe = Pipeline()
+        pipe.add_stage(Stage("walk", walk, workers=3, queue_size=0,
+                             outputs=["even", "odd"], router=lambda n: "odd" if n % 2 else "even"))
+        pipe.add_stage(Stage("even", collect(evens), queue_size=2, batch_size=3, batch_timeout=0.01))
+        pipe.add_stage(Stage("odd", collect(odds), queue_size=2, batch_size=3, batch_timeout=0.01))
+        pipe.start()
+        pipe.put("walk", 1)
+        self.assertTrue(pipe.drain(timeout=10))
+
+        self.assertEqual(sorted(evens), [2, 4, 6, 8])
+        self.assertEqual(sorted(odds), [1, 3, 5, 7, 9])
+        metrics = pipe.metrics()
+        self.assertEqual(metrics["walk"]["processed"], 9)
+        self.assertEqual(metrics["odd"]["processed"], 5)
+
+    def test_errors_are_routed(self) -> None:
+        seen = []
+
+        def check(ctx, n, emit):
+            if n == 3:
+                raise ValueError(n)
+
+        pipe = Pipeline()
+        pipe.add_stage(Stage("check", check, errors="errors"))
+        pipe.add_stage(Stage("errors", lambda ctx, failure, emit: seen.append(failure)))
+        pipe.start()
+        for n in range(5):
+            pipe.put("check", n)
+        pipe.drain()
+
+        self.assertEqual(len(seen), 1)
+        self.assertIsInstance(seen[0], ItemError)
+        self.assertEqual((seen[0].stage, seen[0].item), ("check", 3))
+        self.assertEqual(pipe.metrics()["check"]["failed"], 1)
+
+    def test_setup_per_worker(self) -> None:
+        contexts, closed = [], []
+
+        class Session(object):
+            def __init__(self):
+                contexts.append(self)
+            def close(self):
+                closed.append(self)
+
+        pipe = Pipeline()
+        pipe.add_stage(Stage("work", lambda session, n, emit: time.sleep(0.001), workers=4, setup=Session))
+        pipe.start()
+        for n in range(20):
+            pipe.put("work", n)
+        pipe.drain()
+        self.assertEqual(len(contexts), 4)
+        self.assertEqual(len(closed), 4)
+
+    def test_cancel(self) -> None:
+        started = threading.Event()
+        release = threading.Event()
+        done = []
+
+        def slow(ctx, n, emit):
+            started.set()
+            release.wait()
+            done.append(n)
+
+        pipe = Pipeline()
+        pipe.add_stage(Stage("slow", slow, queue_size=0))
+        pipe.start()
+        for n in range(10):
+            pipe.put("slow", n)
+        started.wait()
+        threading.Timer(0.05, release.set).start()
+        pipe.cancel()
+        self.assertEqual(done, [0])
+        self.assertTrue(pipe.cancelled)
+
+    def test_on_idle_failure(self) -> None:
+        """ A keep-alive that fails gets the worker a new context, rather than killing it. """
+        contexts, closed, done = [], [], []
+
+        class Session(object):
+            def __init__(self):
+                self.pings = 0
+                contexts.append(self)
+            def ping(self):
+                self.pings += 1
+                raise IOError("session dropped")
+            def close(self):
+                closed.append(self)
+
+        pipe = Pipeline(on_error=lambda failure: 1 / 0)
+        pipe.add_stage(Stage("work", lambda session, n, emit: done.append((session, n)) if n else 1 / 0,
+                             setup=Session, idle_timeout=0.01, on_idle=Session.ping))
+        pipe.start()
+        time.sleep(0.05)
+        for n in range(3):
+            pipe.put("work", n)
+        self.assertTrue(pipe.drain(timeout=10))
+
+        self.assertGreater(len(contexts), 1)
+        self.assertEqual(len(closed), len(contexts))
+        self.assertEqual([n for session, n in done], [1, 2])
+        self.assertIs(done[0][0], done[1][0])
+        self.assertIn(done[0][0], contexts[1:])
+        # The failing on_error callback didn't stop the worker either.
+        self.assertEqual(len(pipe.failures), 1)
+
+    def test_idle(self) -> None:
+        started, release = threading.Event(), threading.Event()
+
+        def slow(ctx, n, emit):
+            started.set()
+            release.wait()
+
+        pipe = Pipeline()
+        pipe.add_stage(Stage("slow", slow, workers=3))
+        pipe.start()
+        self.assertEqual(pipe.idle("slow"), 3)
+        pipe.put("slow", 1)
+        started.wait()
+        self.assertEqual((pipe.idle("slow"), pipe.depth("slow")), (2, 0))
+        release.set()
+        pipe.drain()
+        self.assertEqual(pipe.idle("slow"), 3)
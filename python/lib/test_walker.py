@@ -0,0 +1,81 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from walker import TreeWalker, compile_excludes
+
+
+def touch(root, rel_path, size=1):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(b"x" * size)
+
+
+class TestTreeWalker(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = root = os.path.realpath(self.tmp.name)
+        touch(root, "a/one", 10)
+        touch(root, "a/two", 20)
+        touch(root, "b/[old]/three")
+        touch(root, "b/keep/four")
+        touch(root, "c.egg-info/five")
+        touch(root, "outside/six")
+        os.symlink(os.path.join(root, "a", "one"), os.path.join(root, "b", "link-to-one"))
+        os.symlink(os.path.join(root, "outside"), os.path.join(root, "b", "link-to-dir"))
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def names(self, **kwargs):
+        walker = TreeWalker(**kwargs)
+        return [os.path.relpath(entry.path, self.root) for entry in walker.walk([self.root])]
+
+    def test_order_and_filters(self) -> None:
+        excludes = ("outside", "*.egg-info")
+        self.assertEqual(self.names(excludes=excludes),
+                         ["a/one", "a/two", "b/link-to-one", "b/[old]/three", "b/keep/four"])
+        self.assertEqual(self.names(excludes=excludes, min_size=15), ["a/two"])
+        self.assertEqual(sorted(self.names(excludes=excludes, ordered=False, workers=3)),
+                         sorted(self.names(excludes=excludes)))
+
+    def test_symlinks(self) -> None:
+        excludes = ("outside", "*.egg-info")
+        # Symlinked files are the file they point to, as os.walk + os.stat saw them.
+        entry = [entry for entry in TreeWalker(excludes=excludes).walk([self.root])
+                 if entry.name == "link-to-one"][0]
+        self.assertEqual(entry.size, 10)
+        self.assertNotIn("b/link-to-one", self.names(excludes=excludes, skip_symlinks=True))
+        self.assertIn("b/link-to-dir/six", self.names(excludes=excludes, follow_symlinks=True))
+
+    def test_excludes(self) -> None:
+        # A literal path with glob characters in it still excludes itself.
+        bracketed = os.path.join(self.root, "b", "[old]")
+        names = self.names(excludes=(bracketed, "keep", "*.egg-info", "outside"))
+        self.assertEqual(names, ["a/one", "a/two", "b/link-to-one"])
+
+        excluded = compile_excludes(["/data/[old]", "*.tmp"], regex=r".*/cache\Z")
+        self.assertTrue(excluded("/data/[old]"))
+        self.assertTrue(excluded("/data/o"))
+        self.assertTrue(excluded("scratch.tmp"))
+        self.assertTrue(excluded("/var/cache"))
+        self.assertFalse(excluded("/data/older"))
+        self.assertIsNone(compile_excludes(None))
+
+    def test_errors(self) -> None:
+        os.symlink(os.path.join(self.root, "missing"), os.path.join(self.root, "a", "broken"))
+        errors = []
+        names = self.names(excludes=("outside", "*.egg-info", "b"),
+                           onerror=lambda path, error: errors.append((os.path.basename(path), type(error))))
+        self.assertEqual(names, ["a/one", "a/two"])
+        self.assertEqual(errors, [("broken", FileNotFoundError)])
+
+        walker = TreeWalker(onerror=lambda path, error: errors.append(path))
+        self.assertEqual(list(walker.walk([os.path.join(self.root, "nowhere")])), [])
+        self.assertEqual(errors[-1], os.path.join(self.root, "nowhere"))
+
+        def abort(path, error):
+            raise error
+        with self.assertRaises(FileNotFoundError):
+            list(TreeWalker(onerror=abort).walk([os.path.join(self.root, "nowhere")]))
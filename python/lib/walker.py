@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+"""
+Parallel directory-tree walker.
+
+Directories are scanned by a pool of worker threads; each worker does the
+scandir and stat calls for one directory and applies the filters there, so
+only wanted entries come back to the caller. Excluded directories are never
+submitted, which prunes their whole subtree.
+
+    walker = TreeWalker(excludes=(".git", "*.egg-info", "/tmp"), min_size=1)
+    for entry in walker.walk(("/home", "/opt")):
+        print(entry.path, entry.size)
+
+Exclude patterns are globs (see fnmatch) matched against both a directory's
+name and its full path, and also match themselves literally, so a path such
+as '/data/[old]' still excludes itself; 'exclude_regex' adds a raw regular
+expression that is tested the same way.
+
+Symlinked files are yielded with the stat of what they point to (a broken
+link goes to 'onerror'); symlinked directories are not descended into unless
+follow_symlinks is set, and skip_symlinks ignores links altogether.
+
+With ordered=True (the default) entries come out in breadth-first order,
+sorted by name within each directory, so a walk is repeatable; ordered=False
+yields each directory as soon as it is scanned.
+"""
+
+from   collections import deque
+from   concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from   fnmatch import translate
+from   stat import S_ISDIR
+from   typing import Callable, Iterable, Iterator, List, Optional, Tuple
+import logging
+import os
+import re
+
+
+# Type aliases
+PathList     = Iterable[str]
+ErrorHandler = Callable[[str, OSError], None]
+
+
+# Characters that make an exclude pattern a glob as well as a literal.
+GLOB_CHARS = re.compile(r'[*?\[]').search
+
+
+class WalkEntry(object):
+    """ A file (or, with include_dirs, directory) found by the walker. """
+    __slots__ = ('path', 'name', 'stat')
+
+    def __init__(self, path: str, name: str, stat: os.stat_result):
+        self.path = path
+        self.name = name
+        self.stat = stat
+
+    @property
+    def size(self) -> int:
+        return self.stat.st_size
+
+    @property
+    def mtime(self) -> float:
+        return self.stat.st_mtime
+
+    @property
+    def is_dir(self) -> bool:
+        return S_ISDIR(self.stat.st_mode)
+
+    def __repr__(self):
+        return "<%s('%s')>" % (self.__class__.__name__, self.path)
+
+
+def compile_excludes(patterns: PathList, regex: str = None) -> Optional[Callable[[str], Optional[re.Match]]]:
+    """
+    Fold a list of glob/literal exclude patterns, plus an optional regex, into a
+    single compiled matcher. Returns None when there is nothing to exclude.
+    """
+    parts = []
+    for pattern in patterns or ():
+        pattern = os.path.normcase(os.path.normpath(pattern))
+        parts.append(re.escape(pattern) + r'\Z')
+        if GLOB_CHARS(pattern):
+            parts.append(translate(pattern))
+    if regex:
+        parts.append('(?:%s)' % regex)
+    if not parts:
+        return None
+    return re.compile('|'.join('(?:%s)' % p for p in parts)).match
+
+
+def log_error(path: str, error: OSError) -> None:
+    """ Default error handler: report and carry on. """
+    logging.warning("walk: %s: %s", path, error)
+
+
+class TreeWalker(object):
+    """
+    Configurable walker; create once and call 'walk' as often as you like.
+
+    :param excludes:      Glob/literal directory names or paths to prune,
+    :param exclude_regex: Regex matched against directory names/paths to prune,
+    :param min_size:      Only yield files >= this many bytes,
+    :param max_size:      Only yield files <= this many bytes,
+    :param newer_than:    Only yield files with an mtime >= this timestamp,
+    :param older_than:    Only yield files with an mtime < this timestamp,
+    :param predicate:     Optional callable(WalkEntry) -> bool for anything else,
+    :param workers:       Number of scanning threads (default: cpu count),
+    :param ordered:       Yield in a repeatable order (see module docs),
+    :param onerror:       callable(path, OSError) for unreadable dirs/files,
+                          raise from it to abort the walk,
+    :param include_dirs:  Also yield an entry for each directory descended into,
+    :param follow_symlinks: Descend into symlinked directories too,
+    :param skip_symlinks: Ignore symlinks, including symlinked files,
+    """
+
+    def __init__(self, excludes: PathList = None, exclude_regex: str = None,
+                 min_size: int = None, max_size: int = None,
+                 newer_than: float = None, older_than: float = None,
+                 predicate: Callable[[WalkEntry], bool] = None,
+                 workers: int = None, ordered: bool = True,
+                 onerror: ErrorHandler = log_error,
+                 include_dirs: bool = False, follow_symlinks: bool = False,
+                 skip_symlinks: bool = False):
+        self.excluded        = compile_excludes(excludes, exclude_regex)
+        self.min_size        = min_size
+        self.max_size        = max_size
+        self.newer_than      = newer_than
+        self.older_than      = older_than
+        self.predicate       = predicate
+        self.workers         = workers or os.cpu_count() or 1
+        self.ordered         = ordered
+        self.onerror         = onerror
+        self.include_dirs    = include_dirs
+        self.follow_symlinks = follow_symlinks
+        self.skip_symlinks   = skip_symlinks
+
+
+    def _wanted(self, entry: WalkEntry) -> bool:
+        st = entry.stat
+        if self.min_size is not None and st.st_size < self.min_size:
+            return False
+        if self.max_size is not None and st.st_size > self.max_size:
+            return False
+        if self.newer_than is not None and st.st_mtime < self.newer_than:
+            return False
+        if self.older_than is not None and st.st_mtime >= self.older_than:
+            return False
+        return not self.predicate or self.predicate(entry)
+
+
+    def _scan(self, path: str) -> Tuple[List[WalkEntry], List[WalkEntry], List[Tuple[str, OSError]]]:
+        """ Worker: list one directory, returning (files, subdirs, errors). """
+        files, dirs, errors = [], [], []
+        excluded, follow, skip_links = self.excluded, self.follow_symlinks, self.skip_symlinks
+        normcase = os.path.normcase
+
+        try:
+            with os.scandir(path) as it:
+                dirents = list(it)
+        except OSError as e:
+            return files, dirs, [(path, e)]
+
+        for dirent in dirents:
+            try:
+                if dirent.is_symlink() and (skip_links or (not follow and dirent.is_dir())):
+                    continue
+                if dirent.is_dir(follow_symlinks=follow):
+                    if excluded and (excluded(normcase(dirent.name)) or excluded(normcase(dirent.path))):
+                        continue
+                    dirs.append(WalkEntry(dirent.path, dirent.name, dirent.stat(follow_symlinks=follow)))
+                    continue
+                # Files are what they point to, as os.walk + os.stat would see them.
+                entry = WalkEntry(dirent.path, dirent.name, dirent.stat())
+            except OSError as e:
+                errors.append((dirent.path, e))
+                continue
+            if self._wanted(entry):
+                files.append(entry)
+
+        if self.ordered:
+            files.sort(key=lambda e: e.name)
+            dirs.sort(key=lambda e: e.name)
+
+        return files, dirs, errors
+
+
+    def walk(self, paths: PathList) -> Iterator[WalkEntry]:
+        """ Generator: yields WalkEntry for every wanted file below the given paths. """
+        roots = [os.path.abspath(p) for p in paths]
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="walker") as pool:
+            submit = pool.submit
+            pending = deque(submit(self._scan, p) for p in roots)
+
+            try:
+                while pending:
+                    if self.ordered:
+                        done = (pending.popleft(),)
+                    else:
+                        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                        pending = deque(not_done)
+
+                    for future in done:
+                        files, dirs, errors = future.result()
+                        for path, error in errors:
+                            if self.onerror:
+                                self.onerror(path, error)
+                        for entry in dirs:
+                            pending.append(submit(self._scan, entry.path))
+                        if self.include_dirs:
+                            yield from dirs
+                        yield from files
+
+            finally:
+                # Generator closed early or an error handler raised: don't wait for the rest.
+                for future in pending:
+                    future.cancel()
@@ -5,13 +5,25 @@ The subset of C that is understand is limited to:
 
     #define <group>_<name> <value>
 
+    enum E
+    {
+        <name>,
+        <name> = <value>,
+    };
+
+    #pragma pack(...)
+
     struct X
     {
         <type> <name>;
         <type> <name>[dimension];
+        struct <Y> <name>;
     };
 
-Blank lines and single-line comments are ignored.
+where <type> is one of TYPE_MAP or 'enum E', and 'struct Y' is a struct
+defined earlier. Structs get the padding a C compiler would give them, for
+natural alignment or as limited by '#pragma pack'. Blank lines, other
+preprocessor lines and single-line comments are ignored.
 
 defines are expected to be in contiguous groups with a pattern of naming that
 has each define start with a grouping, e.g.
@@ -51,41 +63,101 @@ You can then use these to consume data from a stream by using
     fh = open('file_with_my_header', 'rb')
     struct = MyHeader(fh)
     print(struct.mName, struct.mValue)
+
+or decode them straight out of a buffer, and encode them again
+
+    struct = MyHeader.unpack_from(data, offset)
+    data = struct.pack()
+
+A file of records can be memory-mapped as a RecordFile, for random access
+without reading it: records[i] is a view whose fields are only decoded when
+they are accessed, which is enough to binary-search a sorted file
+
+    with RecordFile(MyHeader, 'file_of_headers') as records:
+        idx = records.bisect_left(b'name', key=lambda record: record.mName)
+
+Streams of variable-length frames -- a header whose length field says how
+much payload follows -- can be read from a file, pipe or socket with a
+FrameReader, which decodes each payload's leading record by a type field
+
+    for frame in FrameReader(sock, MyHeader, 'length', 'type', {1: MyLogin}):
+        print(frame.header.mType, frame.record, len(frame.payload))
+
+With numpy installed, a file (or region of one) that is just records can be
+read in bulk as a structured array, with a column per field:
+
+    records = MyHeader.memmap('file_of_headers')
+    print(records['mValue'].max(), MyHeader.columns(records).mName[:10])
 """
 
-from struct import calcsize, pack, unpack
+from collections import namedtuple
+from struct import Struct, calcsize
 import logging
+import mmap
+import os
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 """ Map C types to the 'struct' representations. """
 TYPE_MAP = {
     'char': 's',
+    'signed char': 'b',
+    'unsigned char': 'B',
+    'bool': '?',
+    '_Bool': '?',
     'int': 'i',
+    'unsigned int': 'I',
     'short': 'h',
+    'unsigned short': 'H',
+    'long long': 'q',
+    'unsigned long long': 'Q',
     'float': 'f',
     'double': 'd',
+    'uint8': 'B',
     'uint16': 'H',
     'uint32': 'I',
+    'uint64': 'Q',
+    'sint8': 'b',
     'sint16': 'h',
     'sint32': 'i',
+    'sint64': 'q',
+    'int8_t': 'b',
+    'int16_t': 'h',
+    'int32_t': 'i',
+    'int64_t': 'q',
+    'uint8_t': 'B',
     'uint16_t': 'H',
     'uint32_t': 'I',
+    'uint64_t': 'Q',
+    'sint8_t': 'b',
     'sint16_t': 'h',
     'sint32_t': 'i',
+    'sint64_t': 'q',
 }
 
+""" 'struct' representation of an enum member, which C makes an int. """
+ENUM_TYPE = 'i'
+
 """ Pattern for removing single-line comments. """
-CMT_REMOVE = re.compile('\s*//.*').sub
+CMT_REMOVE = re.compile(r'\s*//.*').sub
 
 """ For matching the array dimensions of a field. """
 ARRAY_MATCH = re.compile(r'(\S+)\[(\d+)\]').match
 
+""" For matching '#pragma pack(...)', capturing what's in the brackets. """
+PRAGMA_PACK = re.compile(r'#pragma\s+pack\s*\((.*)\)').match
+
 """ Format the definition of a struct. """
 STRUCT_FMT = (
     "{struct} = PackedStruct.create("
     "'{struct}',"
     " {fields},"
-    " net_endian={end}"
+    " net_endian={end},"
+    " aligned=False"
     ")\n"
     "\n"
 )
@@ -96,68 +168,624 @@ class PackedStruct(object):
     BaseClass for implementing pack/unpack struct representations, created
     by calling `PackedStruct.create().
 
+    Each class gets a precompiled `struct.Struct` (CODEC), `__slots__` for its
+    fields, and unpack/pack methods generated for its exact field list, so
+    decoding a record is a single unpack_from and a tuple assignment:
+
+        header = MyHeader.unpack_from(buffer, offset)
+        for record in MyRecord.iter_unpack(data): ...
+        data = header.pack()
+
     See the `Converter` class for generating this automatically from C/C++
     structure definitions.
     """
 
-    def __init__(self, fh, *args):
-        self._values = unpack(self.STRUCT, fh.read(self.SIZE))
+    __slots__ = ()
+
+    def __init__(self, fh=None, **values):
+        """
+        Read a record from a file-like 'fh', or build one from its field
+        values by attribute name, e.g. MyHeader(mName=b'x', mValue=1).
+        """
+        if fh is not None:
+            self._assign(self.CODEC.unpack(fh.read(self.SIZE)))
+            return
+        missing = [name for name in self.FIELDS if name not in values]
+        if missing:
+            raise TypeError("%s: missing fields %s" % (self.__class__.__name__, ", ".join(missing)))
+        for name in self.FIELDS:
+            setattr(self, name, values.pop(name))
+        if values:
+            raise TypeError("%s: unknown fields %s" % (self.__class__.__name__, ", ".join(values)))
+
+    def values(self):
+        """ Field values, in order (array fields as tuples). """
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    def to_bytes(self):
+        return self.pack()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.unpack_from(data)
+
+    @classmethod
+    def iter_unpack(cls, buffer):
+        """ Decode consecutive records filling 'buffer' (a multiple of SIZE bytes). """
+        unpacked = cls._from_values
+        for values in cls.CODEC.iter_unpack(buffer):
+            yield unpacked(values)
+
+    @classmethod
+    def dtype(cls):
+        """
+        The numpy structured dtype equivalent to STRUCT: a field per member,
+        named as the attributes are, at the same offsets, in the same byte
+        order. Array fields are sub-arrays, except char arrays, which are
+        fixed-length bytes.
+        """
+        if cls._dtype is None:
+            cls._dtype = _numpy_dtype(cls)
+        return cls._dtype
+
+    @classmethod
+    def from_buffer(cls, buffer, count=-1, offset=0):
+        """ A structured array of 'count' records (default: as many as fit) in 'buffer', without copying. """
+        dtype = cls.dtype()
+        if count < 0:
+            count = (len(memoryview(buffer).cast('B')) - offset) // cls.SIZE
+        return numpy.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+
+    @classmethod
+    def memmap(cls, path, count=None, offset=0, mode='r'):
+        """ Map 'count' records (default: as many as the file holds) from 'offset' of a file. """
+        return numpy.memmap(path, dtype=cls.dtype(), mode=mode, offset=offset,
+                            shape=(count,) if count is not None else None)
+
+    @classmethod
+    def read_array(cls, fh, count):
+        """
+        Read up to 'count' records from a stream (file, pipe, socket file) straight
+        into a new structured array; it's shorter if the stream ends first.
+        """
+        array = numpy.empty(count, dtype=cls.dtype())
+        view = memoryview(array.view(numpy.uint8))
+        filled = 0
+        while filled < len(view):
+            got = fh.readinto(view[filled:])
+            if not got:
+                break
+            filled += got
+        return array[:filled // cls.SIZE]
+
+    @classmethod
+    def view_class(cls):
+        """ The RecordView subclass for this record type, with a property per field. """
+        if cls._view is None:
+            cls._view = _view_class(cls)
+        return cls._view
+
+    @classmethod
+    def view(cls, buffer, offset=0):
+        """ A lazy RecordView of the record at 'offset' in 'buffer'; fields are decoded as they're accessed. """
+        return cls.view_class()(buffer, offset)
+
+    @staticmethod
+    def columns(array):
+        """ The structured array as a numpy.recarray, so each column is an attribute, e.g. .mValue. """
+        return array.view(numpy.recarray)
+
+    def __eq__(self, rhs):
+        return type(self) is type(rhs) and self.values() == rhs.values()
+
+    def __hash__(self):
+        return hash(self.values())
 
     def __str__(self):
         return '<'+self.__class__.__name__+'>'
 
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__,
-            ','.join('{}={}'.format(self.FIELDS[i], self._values[i])
-                     for i in range(len(self.FIELDS))
-                     if not self.FIELDS[i].startswith('mReserved'))
+            ','.join('{}={}'.format(name, getattr(self, name))
+                     for name in self.FIELDS
+                     if not name.startswith('mReserved'))
         )
 
     @staticmethod
-    def create(struct_name, fields, net_endian=False):
+    def create(struct_name, fields, net_endian=False, aligned=True):
         """
         Create a PackedStruct class describing the representation of a binary
         data structure as might be specified via a C 'struct'.
 
         The field list is an iterable of (defn, fieldname), where defn is the
-        `struct` field representation.
+        `struct` field representation, or another PackedStruct class for a
+        nested struct, or (count, class) for an array of them.
 
         Fields can be accessed as attributes by using the name prefixed with
         'm' and parsed as title(), e.g. "('2h', 'shorts')" would be mShorts.
+        A field with more than one value, like that, is a tuple; 'Ns' (a char
+        array) is a single bytes value. Padding ('Nx') gets no attribute. A
+        nested struct is an instance of its class, an array of them a tuple.
+        Nesting needs unaligned classes (aligned=False, or network order)
+        with the padding spelled out, as Converter writes them: the struct
+        module doesn't pad the end of a struct as C does, so aligned nested
+        structs wouldn't be laid out as their own class is.
 
         :param struct_name: The name of the struct and class.
         :param fields: An iterable of field descriptions where each entry is
                        a tuple of (`struct` representation, fieldname)
         :param net_endian: True or False whether the data is stored in
                        network endian order.
+        :param aligned: False for native byte order without the struct
+                       module's alignment, when 'fields' spell out the
+                       padding (as Converter does). Network order is never
+                       aligned.
         :return:       A class definition.
         """
 
-        struct_defs, field_names, members = [], [], {}
+        struct_defs, field_names, spans, layout, nested, position = [], [], [], [], {}, 0
 
-        # build a list of lambdas to implement the members.
         for defn, field_name in fields:
+            record_cls = None
+            if isinstance(defn, tuple):
+                repeat, record_cls = defn
+            elif isinstance(defn, type):
+                repeat, record_cls = 1, defn
+            if record_cls is not None:
+                if record_cls.STRUCT.startswith('!') != bool(net_endian):
+                    raise ValueError("%s.%s: %s has a different byte order"
+                                     % (struct_name, field_name, record_cls.__name__))
+                if not net_endian and (aligned or _mode(record_cls) == '@'):
+                    raise ValueError("%s.%s: nesting %s needs aligned=False for both, with the padding spelled out"
+                                     % (struct_name, field_name, record_cls.__name__))
+                defn = record_cls.STRUCT.lstrip('@=!') * repeat
+            struct_defs.append(defn)
+            count = _value_count(defn)
+            if not count:
+                # Padding ('x'): takes up room but has no value.
+                layout.append((None, defn))
+                continue
             field_name = "m" + field_name.title()
+            if not field_name.isidentifier():
+                raise ValueError("Invalid field name: %s" % field_name)
             field_names.append(field_name)
-            member_num = len(members)
-            members[field_name] = property(
-                lambda self, n=member_num: self._values[int(n)]
-            )
-            struct_defs.append(defn)
+            layout.append((field_name, defn))
+            if record_cls is not None:
+                nested[field_name] = (record_cls, repeat)
+            spans.append((position, count, nested.get(field_name)))
+            position += count
 
         struct_def = "".join(struct_defs)
-        if net_endian: struct_def = '!' + struct_def
+        if net_endian:
+            struct_def = '!' + struct_def
+        elif not aligned:
+            struct_def = '=' + struct_def
+        codec = Struct(struct_def)
 
         cls_members = {
-            'STRUCT':  struct_def,
-            'SIZE':    calcsize(struct_def),
-            'FIELDS':  tuple(field_names),
+            '__slots__': tuple(field_names),
+            'STRUCT':    struct_def,
+            'SIZE':      codec.size,
+            'FIELDS':    tuple(field_names),
+            'LAYOUT':    tuple(layout),
+            'NESTED':    nested,
+            'CODEC':     codec,
+            '_dtype':    None,
+            '_view':     None,
         }
-        cls_members.update(members)
+        cls_members.update(_codec_methods(field_names, spans, codec))
 
         return type(struct_name, (PackedStruct,), cls_members)
 
 
+""" One format code with its optional repeat count. """
+FORMAT_CODES = re.compile(r'(\d*)([xcbB?hHiIlLqQnNefdspP])').findall
+
+
+def _value_count(defn):
+    """ Number of values a field's `struct` representation unpacks to. """
+    count = 0
+    for repeat, code in FORMAT_CODES(defn):
+        if code in 'sp':
+            count += 1
+        elif code != 'x':
+            count += int(repeat or 1)
+    return count
+
+
+""" numpy kinds for the `struct` codes, by code; sizes come from the struct module. """
+NUMPY_KINDS = {
+    'b': 'i', 'B': 'u', 'h': 'i', 'H': 'u', 'i': 'i', 'I': 'u', 'l': 'i', 'L': 'u',
+    'q': 'i', 'Q': 'u', 'n': 'i', 'N': 'u', 'P': 'u', 'e': 'f', 'f': 'f', 'd': 'f',
+}
+
+
+def _mode(cls):
+    """ The byte order/alignment character of a class's STRUCT. """
+    return cls.STRUCT[0] if cls.STRUCT[:1] in ('!', '=') else '@'
+
+
+def _field_offsets(cls):
+    """ (name, defn, offset) of each field, where the struct module puts it, alignment padding included. """
+    mode = _mode(cls)
+    fields, prefix = [], ""
+    for name, defn in cls.LAYOUT:
+        if name is not None:
+            # Where its first value goes, after aligning for that.
+            first = FORMAT_CODES(defn)[0][1]
+            fields.append((name, defn, calcsize(mode + prefix + first) - calcsize(mode + first)))
+        prefix += defn
+    return fields
+
+
+def _numpy_dtype(cls):
+    if numpy is None:
+        raise ImportError("%s.dtype() needs numpy" % cls.__name__)
+    mode = _mode(cls)
+    order = '>' if mode == '!' else '='
+
+    names, formats, offsets = [], [], []
+    for name, defn, offset in _field_offsets(cls):
+        if name in cls.NESTED:
+            record_cls, repeat = cls.NESTED[name]
+            offsets.append(offset)
+            names.append(name)
+            formats.append((record_cls.dtype(), (repeat,)) if repeat > 1 else record_cls.dtype())
+            continue
+        codes = FORMAT_CODES(defn)
+        if len(codes) != 1:
+            raise ValueError("%s.%s: can't map '%s' to a numpy type" % (cls.__name__, name, defn))
+        repeat, code = codes[0]
+        repeat = int(repeat or 1)
+        offsets.append(offset)
+        names.append(name)
+        if code in 'sp':
+            formats.append('S%d' % repeat)
+        elif code == 'c':
+            formats.append(('S1', (repeat,)) if repeat > 1 else 'S1')
+        elif code == '?':
+            formats.append(('?', (repeat,)) if repeat > 1 else '?')
+        elif code in NUMPY_KINDS:
+            base = '%s%s%d' % (order, NUMPY_KINDS[code], calcsize(mode + code))
+            formats.append((base, (repeat,)) if repeat > 1 else base)
+        else:
+            raise ValueError("%s.%s: can't map '%s' to a numpy type" % (cls.__name__, name, defn))
+
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': cls.SIZE})
+
+
+class RecordView(object):
+    """
+    One record in a buffer (e.g. an mmap), decoded a field at a time, with
+    unpack_from, as its attributes are accessed. Made by PackedStruct.view()
+    and RecordFile; record() decodes the whole thing.
+    """
+
+    __slots__ = ('_buffer', '_offset')
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        self._offset = offset
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def record(self):
+        return self.RECORD.unpack_from(self._buffer, self._offset)
+
+    def __repr__(self):
+        return "{}View(@{})".format(self.RECORD.__name__, self._offset)
+
+
+def _view_class(cls):
+    """ A RecordView subclass with a property per field of 'cls'. """
+    mode = _mode(cls)
+    members = {'__slots__': (), 'RECORD': cls}
+    for name, defn, offset in _field_offsets(cls):
+        if name in cls.NESTED:
+            # Nested structs are views too, of the same buffer.
+            record_cls, repeat = cls.NESTED[name]
+            view = record_cls.view_class()
+            if repeat == 1:
+                getter = lambda self, _v=view, _o=offset: _v(self._buffer, self._offset + _o)
+            else:
+                offsets = tuple(offset + idx * record_cls.SIZE for idx in range(repeat))
+                getter = lambda self, _v=view, _os=offsets: tuple(_v(self._buffer, self._offset + _o) for _o in _os)
+            members[name] = property(getter)
+            continue
+        unpack_from = Struct(mode + defn).unpack_from
+        if _value_count(defn) == 1:
+            getter = lambda self, _u=unpack_from, _o=offset: _u(self._buffer, self._offset + _o)[0]
+        else:
+            getter = lambda self, _u=unpack_from, _o=offset: _u(self._buffer, self._offset + _o)
+        members[name] = property(getter)
+    return type(cls.__name__ + "View", (RecordView,), members)
+
+
+class RecordFile(object):
+    """
+    A file of fixed-size records of one PackedStruct class, memory-mapped
+    rather than read: records[i] and iteration give lazy RecordViews,
+    slicing gives another RecordFile over part of the same mapping, and
+    only the pages holding fields that are actually accessed get read.
+
+        with RecordFile(Sample, 'capture.bin') as records:
+            start = records.bisect_left(t0, key=lambda record: record.mTimestamp)
+            for record in records[start:start + 100]:
+                ...
+
+    :param record_cls: The PackedStruct class of the records,
+    :param path:       File to map,
+    :param offset:     Where the records start (e.g. after a file header),
+    :param count:      Most records to use; by default as many as the file holds,
+    """
+
+    def __init__(self, record_cls, path, offset=0, count=None):
+        self.record_cls = record_cls
+        self._fh = open(path, "rb")
+        size = os.fstat(self._fh.fileno()).st_size
+        # An empty file can't be mapped, but then there's nothing to read either.
+        self._buffer = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        available = max(0, (size - offset) // record_cls.SIZE)
+        count = available if count is None else min(count, available)
+        self._offsets = range(offset, offset + count * record_cls.SIZE, record_cls.SIZE)
+        self._view = record_cls.view_class()
+
+    def _part(self, offsets):
+        part = object.__new__(RecordFile)
+        part.record_cls, part._fh, part._buffer, part._view = self.record_cls, None, self._buffer, self._view
+        part._offsets = offsets
+        return part
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._part(self._offsets[index])
+        return self._view(self._buffer, self._offsets[index])
+
+    def __iter__(self):
+        view, buffer = self._view, self._buffer
+        for offset in self._offsets:
+            yield view(buffer, offset)
+
+    def decode(self, index):
+        """ The record at 'index', fully decoded. """
+        return self.record_cls.unpack_from(self._buffer, self._offsets[index])
+
+    def bisect_left(self, value, key):
+        """
+        Index of the first record whose key(view) is not less than 'value', in
+        a file sorted by that key; only about log2(len) records are touched.
+        """
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(self[mid]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def array(self):
+        """ The records as a numpy structured array over the same mapping (no copy); needs numpy. """
+        offsets = self._offsets
+        if offsets.step != self.record_cls.SIZE and len(offsets) > 1:
+            raise ValueError("array() needs contiguous records, not a stepped slice")
+        return self.record_cls.from_buffer(self._buffer, count=len(offsets),
+                                           offset=offsets.start if offsets else 0)
+
+    def close(self):
+        """
+        Unmap the file; only the RecordFile that opened it can. While arrays
+        from array() are still around the mapping can't be closed, so it is
+        left for them, and goes once they have.
+        """
+        if self._fh is not None:
+            try:
+                if isinstance(self._buffer, mmap.mmap):
+                    self._buffer.close()
+            except BufferError:
+                pass
+            finally:
+                self._fh.close()
+                self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+""" A frame from a FrameReader: its header, the record decoded from the payload (if any), and the payload. """
+Frame = namedtuple('Frame', ('header', 'record', 'payload'))
+
+
+class FrameReader(object):
+    """
+    Frames from a stream of <header><payload>..., where the header is a
+    PackedStruct and one of its fields holds the payload's length.
+
+    Frames are read a buffer-full at a time with readinto (recv_into for a
+    socket) into one bytearray that's reused for the whole stream, and only
+    grown if a frame doesn't fit. Each Frame's payload is a memoryview of
+    that buffer, so it's only good until the next frame is read; take
+    bytes(frame.payload) to keep it.
+
+        reader = FrameReader(fh, MsgHeader, 'length', 'type', {MSG_LOGIN: Login})
+        for frame in reader:
+            if frame.header.mType == MSG_LOGIN:
+                print(frame.record.mUser, bytes(frame.payload[Login.SIZE:]))
+
+    :param stream:       File, pipe or socket to read,
+    :param header_cls:   PackedStruct class of the headers,
+    :param length_field: Header field holding the payload length, by name
+                         ('length') or attribute ('mLength'),
+    :param type_field:   [optional] Header field to pick a record class by,
+    :param records:      {type value: PackedStruct class} to decode from the
+                         start of the payload; record is None for others,
+    :param length_includes_header: If the length counts the header too,
+    :param buffer_size:  Initial size of the buffer,
+    :param max_length:   [optional] Longest frame to accept, against garbage,
+    """
+
+    def __init__(self, stream, header_cls, length_field, type_field=None, records=None,
+                 length_includes_header=False, buffer_size=64 * 1024, max_length=None):
+        self.stream = stream
+        self.header_cls = header_cls
+        self.length_field = _attribute(header_cls, length_field)
+        self.type_field = _attribute(header_cls, type_field) if type_field else None
+        self.records = records or {}
+        self.length_includes_header = length_includes_header
+        self.max_length = max_length
+        self.frames = 0
+        self._readinto = getattr(stream, 'readinto', None) or stream.recv_into
+        self._buffer = bytearray(max(buffer_size, header_cls.SIZE))
+
+    def __iter__(self):
+        header_size, unpack_header = self.header_cls.SIZE, self.header_cls.unpack_from
+        length_field, type_field, records = self.length_field, self.type_field, self.records
+        adjust = 0 if self.length_includes_header else header_size
+        buffer = self._buffer
+        view = memoryview(buffer)
+        start = end = 0
+
+        while True:
+            # Every whole frame that's in the buffer.
+            needed = header_size
+            while end - start >= header_size:
+                header = unpack_header(buffer, start)
+                needed = getattr(header, length_field) + adjust
+                if needed < header_size or (self.max_length and needed > self.max_length):
+                    raise ValueError("%s: bad frame length %d at frame %d"
+                                     % (self.header_cls.__name__, needed, self.frames))
+                if end - start < needed:
+                    break
+                record = None
+                if type_field:
+                    record_cls = records.get(getattr(header, type_field))
+                    if record_cls is not None:
+                        if needed - header_size < record_cls.SIZE:
+                            raise ValueError("%s: frame %d is too short for a %s"
+                                             % (self.header_cls.__name__, self.frames, record_cls.__name__))
+                        record = record_cls.unpack_from(buffer, start + header_size)
+                payload = view[start + header_size:start + needed]
+                start += needed
+                self.frames += 1
+                yield Frame(header, record, payload)
+                needed = header_size
+
+            # Move the partial frame, if any, to the front, and make room for the rest of it.
+            if start == end:
+                start = end = 0
+            elif start:
+                view[:end - start] = view[start:end]
+                end, start = end - start, 0
+            if needed > len(buffer):
+                # A new buffer rather than resizing, which payloads still held would prevent.
+                grown = bytearray(max(needed, 2 * len(buffer)))
+                grown[:end] = view[:end]
+                buffer = self._buffer = grown
+                view = memoryview(buffer)
+
+            got = self._readinto(view[end:])
+            if not got:
+                if end:
+                    raise EOFError("%s: stream ended %d bytes into frame %d"
+                                   % (self.header_cls.__name__, end, self.frames))
+                return
+            end += got
+
+
+def _attribute(cls, field):
+    """ The attribute of a PackedStruct field, given as one ('mLength') or its field name ('length'). """
+    if field in cls.FIELDS:
+        return field
+    attribute = "m" + field.title()
+    if attribute not in cls.FIELDS:
+        raise ValueError("%s has no field %s" % (cls.__name__, field))
+    return attribute
+
+
+def _codec_methods(field_names, spans, codec):
+    """
+    Generate the per-class methods that move values between the codec and
+    the fields' slots: straight tuple (un)packing when every field is a
+    single value, slices for array fields, and the nested class's own
+    _from_values/_flat for nested structs.
+    """
+    scalar = all(count == 1 and not nested for _, count, nested in spans)
+    namespace = {'_new': object.__new__, '_unpack_from': codec.unpack_from,
+                 '_pack': codec.pack, '_pack_into': codec.pack_into}
+    targets, sources, assign = [], [], ""
+    for name, (start, count, nested) in zip(field_names, spans):
+        targets.append("self." + name)
+        if nested:
+            record_cls, repeat = nested
+            namespace['_' + name] = record_cls
+            if repeat == 1:
+                assign += "    self.%s = _%s._from_values(values[%d:%d])\n" % (name, name, start, start + count)
+                sources.append("self.%s._flat()" % name)
+            else:
+                step = count // repeat
+                assign += ("    self.%s = tuple(_%s._from_values(values[idx:idx + %d]) for idx in range(%d, %d, %d))\n"
+                           % (name, name, step, start, start + count, step))
+                sources.append("tuple(value for item in self.%s for value in item._flat())" % name)
+        elif scalar:
+            sources.append("self." + name)
+        elif count == 1:
+            assign += "    self.%s = values[%d]\n" % (name, start)
+            sources.append("(self.%s,)" % name)
+        else:
+            assign += "    self.%s = values[%d:%d]\n" % (name, start, start + count)
+            sources.append("tuple(self.%s)" % name)
+
+    if scalar:
+        assign = "    %s, = values\n" % ", ".join(targets) if targets else "    pass\n"
+        packed = ", ".join(sources)
+        flat = "(%s,)" % packed if packed else "()"
+    else:
+        # Not scalar, so there's at least one field.
+        flat = " + ".join(sources)
+        packed = "*(%s)" % flat
+
+    source = (
+        "def _assign(self, values):\n" + assign +
+        "\n"
+        "def _from_values(cls, values):\n"
+        "    self = _new(cls)\n"
+        "    self._assign(values)\n"
+        "    return self\n"
+        "\n"
+        "def unpack_from(cls, buffer, offset=0):\n"
+        "    \"\"\" Decode a record from 'buffer' (bytes, bytearray, memoryview, mmap) at 'offset'. \"\"\"\n"
+        "    self = _new(cls)\n"
+        "    self._assign(_unpack_from(buffer, offset))\n"
+        "    return self\n"
+        "\n"
+        "def _flat(self):\n"
+        "    return %s\n"
+        "\n"
+        "def pack(self):\n"
+        "    return _pack(%s)\n"
+        "\n"
+        "def pack_into(self, buffer, offset=0):\n"
+        "    _pack_into(buffer, offset, %s)\n" % (flat, packed, packed)
+    )
+    exec(source, namespace)
+    return {
+        '_assign':      namespace['_assign'],
+        '_flat':        namespace['_flat'],
+        '_from_values': classmethod(namespace['_from_values']),
+        'unpack_from':  classmethod(namespace['unpack_from']),
+        'pack':         namespace['pack'],
+        'pack_into':    namespace['pack_into'],
+    }
+
+
 class Converter(object):
     """ Helper for parsing .h file-like definitions to generate PackedStructs. """
 
@@ -169,6 +797,27 @@ class Converter(object):
 
         self._define_group = None
         self._struct_name = None
+        self._c_name = None
+        self._enum_name = None
+
+        # C struct name => (class name, size, alignment), for nesting.
+        self._structs = {}
+        # The #pragma pack in force (None: natural alignment) and pushed ones.
+        self._pack = None
+        self._pack_stack = []
+
+
+    def _type_name(self, name, prefix):
+        """ Internal: the Python class name for a struct or enum name. """
+        if prefix:
+            assert name.startswith(prefix)
+            name = prefix.title() + name[len(prefix):].title()
+        else:
+            name = name.title()
+        if name in self.types:
+            raise ValueError("Duplicate type: %s" % name)
+        self.types.add(name)
+        return name
 
 
     def _read_define(self, line, prefix):
@@ -211,94 +860,214 @@ class Converter(object):
         return text + self.indent + "%s = %s\n" % (name, value)
 
 
-    def parse(self, iterable, prefix="", net_endian=False):
+    def _read_pragma_pack(self, args, default):
+        """
+        Internal: Apply a '#pragma pack(args)': 'N', 'push', 'push, N', 'pop',
+        or nothing to go back to 'default'.
+        """
+        args = [arg.strip() for arg in args.split(',') if arg.strip()]
+        if args and args[0] == 'push':
+            self._pack_stack.append(self._pack)
+            args = args[1:]
+        elif args and args[0] == 'pop':
+            self._pack = self._pack_stack.pop() if self._pack_stack else default
+            return
+        if not args:
+            self._pack = default
+        else:
+            self._pack = int(args[0])
+        self.logger.debug("pack %s", self._pack)
+
+
+    def _read_enum(self, line, members):
+        """
+        Internal: Read a line of enumerators ('A', 'B = 4', ... separated by
+        commas) from the body of an enum.
+        :param line: the line to process
+        :param members: [name, value] of the enumerators so far, added to.
+        """
+        for item in line.split(','):
+            if not item.strip():
+                continue
+            name, _, value = item.partition('=')
+            name, value = name.strip(), value.strip()
+            if not value:
+                # One more than the last, which may be an expression.
+                if not members:
+                    value = "0"
+                else:
+                    last = members[-1][1]
+                    try:
+                        value = str(int(last, 0) + 1)
+                    except ValueError:
+                        value = "%s + 1" % last
+            self.logger.debug("enum %s.%s = %s", self._enum_name, name, value)
+            members.append((name, value))
+
+
+    def _member(self, typename, field, layout):
         """
-        Process c-like #defines, structs and members from an iterable of lines
-        of text, generating text to produce equivalent PackedStruct classes
-        in Python.
+        Internal: Lay out a struct member where a C compiler would, with any
+        padding it needs before it.
+        :param typename: the C type, e.g. 'int', 'uint8_t', 'struct point'
+        :param field: the member name, with any [dimension]
+        :param layout: the struct being laid out: {'fields', 'offset', 'align'}
+        """
+        # If it's an array, prefix the type by the count
+        m = ARRAY_MATCH(field)
+        if m:
+            field, count = m.group(1), int(m.group(2))
+        else:
+            count = 1
+
+        kind, _, name = typename.partition(' ')
+        if kind == 'struct':
+            if name not in self._structs:
+                raise ValueError("Unknown struct: %s" % name)
+            class_name, size, align = self._structs[name]
+            # A nested struct is its class, or (count, class) for an array.
+            type_rep = class_name if count == 1 else "(%d, %s)" % (count, class_name)
+        else:
+            if kind == 'enum':
+                code = ENUM_TYPE
+            elif typename in TYPE_MAP:
+                code = TYPE_MAP[typename]
+            else:
+                raise ValueError("Unknown type: %s" % typename)
+            # Put the count and type together for the representation, e.g.
+            # a single int => 'i', 8 shorts => '8h', etc.
+            type_rep = repr((str(count) if m else '') + code)
+            size = align = calcsize('=' + code)
+
+        if self._pack:
+            align = min(align, self._pack)
+        padding = -layout['offset'] % align
+        if padding:
+            layout['fields'].append("('%dx', 'pad')" % padding)
+        layout['fields'].append("(%s, %r)" % (type_rep, field))
+        layout['offset'] += padding + size * count
+        layout['align'] = max(layout['align'], align)
+        self.logger.debug('%s.%s %s', self._struct_name, type_rep, field)
+
+
+    def parse(self, iterable, prefix="", net_endian=False, pack=None):
+        """
+        Process c-like #defines, enums, structs and members from an iterable
+        of lines of text, generating text to produce equivalent PackedStruct
+        classes in Python.
+
+        Structs are laid out as a C compiler would: each member at its natural
+        alignment, or at most '#pragma pack' alignment, with the padding that
+        takes written out, including at the end so arrays of them line up.
 
         :param iterable: iterable of lines to parse
         :param prefix: [optional] prefix to require infront of structs/defines.
         :param net_endian: Set to True for the '!' prefix on struct definitions.
+        :param pack: [optional] packing in force before any '#pragma pack',
+                     e.g. 1 for no padding at all.
         :return: Python text string that would generate the supplied structures.
         """
 
         logger = self.logger
-        struct_fields, text = None, ""
+        struct, enum, text = None, None, ""
+        self._pack = pack
 
-        for line in iterable:
-
-            # Get rid of cruft.
-            line = CMT_REMOVE('', line.rstrip().replace(';', ''))
-            line = line.replace('\t', ' ')
-            if not line: continue
+        for line in _source_lines(iterable):
 
             # '#define' statements get converted into blocks.
             if line.startswith('#define'):
-                text += self.read_define(line, prefix)
+                text += self._read_define(line, prefix)
+                continue
+
+            if line.startswith('#'):
+                m = PRAGMA_PACK(line)
+                if m:
+                    self._read_pragma_pack(m.group(1), pack)
+                else:
+                    logger.debug("Ignoring %s", line)
                 continue
 
             # nop the open brace of a structure definition.
             if line.startswith('{'):
-                assert self._struct_name
-                assert struct_fields is None
-                struct_fields = []
+                if self._enum_name:
+                    assert enum is None
+                    enum = []
+                else:
+                    assert self._struct_name
+                    assert struct is None
+                    struct = {'fields': [], 'offset': 0, 'align': 1}
+                continue
+
+            # end of an enum
+            if line.startswith('}') and enum is not None:
+                text += "class %s:\n" % self._enum_name
+                text += "".join(self.indent + "%s = %s\n" % member for member in enum) or self.indent + "pass\n"
+                text += "\n"
+                self._enum_name, enum = None, None
                 continue
 
             # end of a struct
             if line.startswith('}'):
-                assert self._struct_name
+                assert self._struct_name and struct is not None
+                # Round up to its alignment, as C does so arrays of it line up.
+                padding = -struct['offset'] % struct['align']
+                if padding:
+                    struct['fields'].append("('%dx', 'pad')" % padding)
+                fields = struct['fields']
                 text += STRUCT_FMT.format(struct=self._struct_name,
-                                          fields=tuple(struct_fields), end=net_endian)
-                self._struct_name, fields = None, None
+                                          fields="(" + ", ".join(fields) + ("," if len(fields) == 1 else "") + ")",
+                                          end=net_endian)
+                self._structs[self._c_name] = (self._struct_name, struct['offset'] + padding, struct['align'])
+                self._struct_name, struct = None, None
                 continue
 
-            # The remaining lines we understand are 'struct X' and 'type Name'.
+            if enum is not None:
+                self._read_enum(line, enum)
+                continue
+
+            # The remaining lines we understand are 'struct X', 'enum X' and
+            # 'type Name', where the type may be several words.
             try:
-                typename, field = line.split()
+                typename, field = line.rsplit(None, 1)
             except Exception as e:
                 # Anything else we just ignore.
                 logger.debug("Ignoring %s: %s", line, str(e))
                 continue
 
-            # struct definition.
-            if typename == 'struct':
+            # struct or enum definition.
+            if typename in ('struct', 'enum'):
                 if self._define_group:
                     # So we get a blank link between enums and structs.
                     self._define_group = None
                     text += "\n"
 
                 # Turn the field name into something we can use
-                if prefix:
-                    assert field.startswith(prefix)
-                    field = prefix.title() + field[len(prefix):].title()
+                name = self._type_name(field, prefix)
+                logger.info('%s %s', typename, name)
+                if typename == 'enum':
+                    self._enum_name = name
                 else:
-                    field = field.title()
-
-                if field in self.types:
-                    raise ValueError("Duplicate type: %s", field)
-                logger.info('struct %s', field)
-
-                # Add to the types list
-                self._struct_name = field
-                self.types.add(field)
-                struct_fields = None
+                    self._struct_name, self._c_name = name, field
                 continue
 
             # Otherwise it's a member declaration (we think).
+            if struct is None:
+                logger.debug("Ignoring %s: not in a struct", line)
+                continue
+            self._member(typename, field, struct)
 
-            # If it's an array, prefix the type by the count
-            m = ARRAY_MATCH(field)
-            if m:
-                field, count = m.group(1), str(m.group(2))
-            else:
-                count = ''
-
-            # Put the count and type together for the representation, e.g.
-            # a single int => 'i', 8 shorts => '8h', etc.
-            type_rep = str(count) + TYPE_MAP[typename]
+        return text
 
-            logger.debug('%s.%s %s', self._struct_name, type_rep, field)
-            struct_fields.append((type_rep, field))
 
-        return text
+def _source_lines(iterable):
+    """ Lines without comments, semicolons or surrounding space, with a trailing '{' split off. """
+    for line in iterable:
+        # Get rid of cruft.
+        line = CMT_REMOVE('', line.rstrip().replace(';', ''))
+        line = line.replace('\t', ' ').strip()
+        if not line:
+            continue
+        if line.endswith('{') and line != '{':
+            yield line[:-1].rstrip()
+            line = '{'
+        yield line
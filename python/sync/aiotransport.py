@@ -0,0 +1,191 @@
+"""
+asyncio front end for the sync sessions.
+
+paramiko is blocking, so each SFTP channel has a private single-thread
+executor, and async callers check a channel out of a pool for the duration
+of a call. However many coroutines are waiting, the number of threads and
+SFTP channels stays fixed -- thousands of small-file operations just queue
+for a channel instead of needing a thread each. A channel only goes back to
+the pool once its thread is done with the call, even if the caller was
+cancelled meanwhile. Remote commands open their own channel per call on the
+SSH transport, and run on a separate executor, bounded by a semaphore to
+stay under the server's MaxSessions.
+
+    async def main():
+        async with await AsyncSFTP.connect(host, user, password, initial_path="/data", channels=8) as remote:
+            names = [attrs.filename for attrs in await remote.listdir(".")]
+            async for name, attrs in bounded_map(remote.stat, names, limit=64):
+                ...
+
+bounded_map is the scheduler: it keeps at most 'limit' coroutines in flight
+over an iterable of any size and yields results as they complete.
+
+syncer fetches batches of small files this way with --async-channels: one
+pipeline worker runs an event loop over the channels.
+"""
+
+import asyncio
+from   concurrent.futures import ThreadPoolExecutor
+import logging
+from   typing import Any, AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Tuple, TypeVar
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+# Default number of remote commands we'll have running at once.
+DEFAULT_MAX_EXECS = 4
+
+
+class AsyncSFTP(object):
+    """
+    :param sessions:     Already opened SFTPSessions (anything with .client and .close), one per channel,
+    :param ssh:          SSHSession to run remote commands on,
+    :param max_execs:    Most remote commands to run at once,
+    """
+
+    def __init__(self, sessions: List["SFTPSession"], ssh: "SSHSession", max_execs: int = DEFAULT_MAX_EXECS, logger=logging):
+        if not sessions:
+            raise ValueError("AsyncSFTP needs at least one SFTP session")
+        self.logger    = logger
+        self._sessions = list(sessions)
+        self._ssh      = ssh
+        self._owned    = []
+        # (session, its executor): a channel is only ever used from its own thread.
+        self._channels = [(session, ThreadPoolExecutor(max_workers=1, thread_name_prefix="aiosftp"))
+                          for session in self._sessions]
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_execs), thread_name_prefix="aioexec")
+        self._idle     = asyncio.Queue()
+        for channel in self._channels:
+            self._idle.put_nowait(channel)
+        self._execs    = asyncio.Semaphore(max_execs)
+
+
+    @classmethod
+    async def connect(cls, hostname: str, username: str, password: str, initial_path: str = None,
+                      channels: int = 8, transports: int = 1, max_execs: int = DEFAULT_MAX_EXECS,
+                      logger=logging) -> "AsyncSFTP":
+        """ Open 'transports' SSH connections and spread 'channels' SFTP channels over them. """
+        from sync.sftpsession import SSHSession, SFTPSession
+
+        loop = asyncio.get_running_loop()
+        ssh  = await asyncio.gather(*(
+            loop.run_in_executor(None, lambda: SSHSession(hostname, username, password, logger=logger))
+            for _ in range(max(1, transports))
+        ))
+        sessions = await asyncio.gather(*(
+            loop.run_in_executor(None, lambda idx=idx: SFTPSession(initial_path=initial_path, logger=logger,
+                                                                  ssh=ssh[idx % len(ssh)]))
+            for idx in range(max(1, channels))
+        ))
+        remote = cls(sessions, ssh[0], max_execs=max_execs, logger=logger)
+        remote._owned = ssh
+        return remote
+
+
+    @property
+    def channels(self) -> int:
+        return len(self._sessions)
+
+
+    async def _call(self, func: Callable[..., R], *args) -> R:
+        """
+        Run func(sftp_client, *args) on an idle channel's thread. If we're
+        cancelled the call still runs to the end (a thread can't be stopped),
+        and the channel only goes back to the pool when it has.
+        """
+        channel = await self._idle.get()
+        session, executor = channel
+        try:
+            future = asyncio.get_running_loop().run_in_executor(executor, func, session.client, *args)
+        except BaseException:
+            self._idle.put_nowait(channel)
+            raise
+        future.add_done_callback(lambda future: self._release(channel, future))
+        return await asyncio.shield(future)
+
+
+    def _release(self, channel: Tuple[Any, ThreadPoolExecutor], future: asyncio.Future) -> None:
+        if not future.cancelled():
+            # Retrieved, so an abandoned call's error isn't reported as never retrieved.
+            future.exception()
+        self._idle.put_nowait(channel)
+
+
+    async def listdir(self, path: str = ".") -> List[Any]:
+        """ SFTPAttributes (with filename) for each entry of a remote directory. """
+        return await self._call(lambda client, path: list(client.listdir_iter(path)), path)
+
+
+    async def stat(self, path: str) -> Any:
+        return await self._call(lambda client, path: client.stat(path), path)
+
+
+    async def read(self, path: str, offset: int = 0, size: Optional[int] = None) -> bytes:
+        """ Read 'size' bytes (or the rest of the file) from 'offset' of a remote file. """
+        def read(client, path, offset, size):
+            with client.open(path, "rb") as fh:
+                if size is None:
+                    size = fh.stat().st_size - offset
+                if size <= 0:
+                    return b""
+                # readv pipelines the requests rather than one round-trip per block.
+                return b"".join(fh.readv([(offset, size)]))
+        return await self._call(read, path, offset, size)
+
+
+    async def exec(self, command: str, inputs: Optional[bytes] = None) -> Tuple[int, bytes]:
+        """ Run a remote command, returning (exit status, stdout). """
+        async with self._execs:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, lambda: self._ssh.execute(command, inputs=inputs, read_stdout=True))
+
+
+    async def close(self) -> None:
+        loop = asyncio.get_running_loop()
+        for session, executor in self._channels:
+            await loop.run_in_executor(executor, session.close)
+            executor.shutdown(wait=True)
+        for ssh in self._owned:
+            await loop.run_in_executor(self._executor, ssh.close)
+        self._executor.shutdown(wait=True)
+
+
+    async def __aenter__(self) -> "AsyncSFTP":
+        return self
+
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+async def bounded_map(func: Callable[[T], Awaitable[R]], items: Iterable[T], limit: int) -> AsyncIterator[Tuple[T, R]]:
+    """
+    Await func(item) for every item with no more than 'limit' in flight,
+    yielding (item, result) in completion order. Items are pulled from the
+    iterable lazily, so it can be a generator over a huge tree; an exception
+    from func cancels the rest and is raised.
+    """
+    items   = iter(items)
+    pending = {}
+
+    def fill():
+        while len(pending) < limit:
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            pending[asyncio.ensure_future(func(item))] = item
+
+    fill()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future.result()
+            fill()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,303 @@
+"""
+rsync-style delta downloads.
+
+The remote side runs summer.py in signature mode (piped to the remote python
+over SSH, so nothing needs installing) to get an adler32 + md5 signature per
+block of the remote file. We then work out which of those blocks the local
+copy already has:
+
+  1. Aligned pass: compare each remote block with the local block at the same
+     offset. This is a straight hashlib/zlib pass and catches the common case
+     of files that have only grown or changed in place.
+  2. Rolling pass: for full-size remote blocks still unmatched, roll an adler32
+     window over the local data not already claimed by aligned matches to find
+     blocks that have moved (e.g. after an insertion). With numpy the weak sum
+     of every window in a chunk of the file is computed at once from prefix
+     sums, so only the offsets whose weak sum is wanted are looked at from
+     Python; without it the window is rolled a byte at a time. Either way a
+     match moves the window on by a whole block.
+
+Only the ranges we don't have are read from the remote, with SFTP readv, and
+the file is rebuilt into the temp file create_file hands us, in order, while
+the whole-file md5 is checked against the remote's.
+"""
+
+from   collections import defaultdict, namedtuple
+from   typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+import hashlib
+import logging
+import mmap
+import os
+import shlex
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+BlockSignature = namedtuple('BlockSignature', ['offset', 'length', 'weak', 'strong'])
+
+# Modulus of adler32.
+ADLER_MOD = 65521
+
+# Largest single range we read from the remote at a time.
+MAX_FETCH = 4 * 1024 * 1024
+
+# Window offsets whose weak sums are computed at once in the numpy scan.
+SCAN_CHUNK = 1024 * 1024
+
+# The numpy scan pre-filters weak sums with a table indexed by their low bits.
+WEAK_FILTER_MASK = (1 << 20) - 1
+
+# Path of the remote helper we pipe to the remote python.
+SUMMER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "summer.py")
+
+
+class DeltaError(Exception):
+    """ The delta could not be applied; callers should fall back to a full download. """
+    pass
+
+
+def parse_signatures(text: str) -> Tuple[int, str, List[BlockSignature]]:
+    """ Parses summer.py --signatures output into (size, md5, [BlockSignature]). """
+    lines = text.splitlines()
+    size, digest = lines[0].split()
+    blocks = []
+    for line in lines[1:]:
+        if line:
+            offset, length, weak, strong = line.split()
+            blocks.append(BlockSignature(int(offset), int(length), int(weak, 16), strong))
+    return int(size), digest, blocks
+
+
+def remote_signatures(ssh, remote_path: str, block_size: int, python: str="python3") -> Tuple[int, str, List[BlockSignature]]:
+    """ Run summer.py on the remote host via an SSHSession and parse its output. """
+    with open(SUMMER_PATH, "rb") as fh:
+        script = fh.read()
+    cmd = "%s - --signatures %d %s" % (python, block_size, shlex.quote(remote_path))
+    rc, stdout = ssh.execute(cmd, inputs=script, read_stdout=True)
+    if rc != 0:
+        raise DeltaError("remote signatures failed (%d): %s" % (rc, cmd))
+    return parse_signatures(stdout.decode())
+
+
+def roll(a: int, b: int, out_byte: int, in_byte: int, length: int) -> Tuple[int, int]:
+    """ Slide an adler32 window of 'length' bytes along by one byte. """
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - length * out_byte + a - 1) % ADLER_MOD
+    return a, b
+
+
+def match_blocks(data, blocks: List[BlockSignature]) -> List[Optional[int]]:
+    """
+    For each remote block, find the offset of identical data in 'data' (a
+    bytes-like view of the local file), or None if we don't have it.
+    """
+    size = len(data)
+    matches = [None] * len(blocks)
+    md5 = hashlib.md5
+    covered = []
+
+    # Aligned pass.
+    for idx, sig in enumerate(blocks):
+        end = sig.offset + sig.length
+        if end > size:
+            continue
+        window = data[sig.offset:end]
+        if (zlib.adler32(window) & 0xffffffff) == sig.weak and md5(window).hexdigest() == sig.strong:
+            matches[idx] = sig.offset
+            covered.append((sig.offset, end))
+
+    # Rolling pass over the gaps, for full-size blocks only (a short tail block
+    # can only live at the end, which the aligned pass already tried).
+    block_size = max((sig.length for sig in blocks), default=0)
+    wanted = defaultdict(list)
+    for idx, sig in enumerate(blocks):
+        if matches[idx] is None and sig.length == block_size:
+            wanted[sig.weak].append(idx)
+    if not wanted:
+        return matches
+
+    gaps, pos = [], 0
+    for start, end in covered:
+        if start > pos:
+            gaps.append((pos, start))
+        pos = max(pos, end)
+    if pos < size:
+        gaps.append((pos, size))
+
+    scan = _scan_numpy if numpy is not None else _scan_rolling
+    for start, end in gaps:
+        if not wanted:
+            break
+        scan(data, start, end, block_size, blocks, wanted, matches)
+
+    return matches
+
+
+def _claim(data, pos: int, block_size: int, blocks: List[BlockSignature], wanted, weak: int,
+           matches: List[Optional[int]]) -> bool:
+    """ If the block at 'pos' (whose weak sum is wanted) is one of the remote blocks, record it as theirs. """
+    candidates = wanted[weak]
+    strong = hashlib.md5(data[pos:pos + block_size]).hexdigest()
+    hits = [idx for idx in candidates if blocks[idx].strong == strong]
+    if not hits:
+        return False
+    for idx in hits:
+        matches[idx] = pos
+        candidates.remove(idx)
+    if not candidates:
+        del wanted[weak]
+    return True
+
+
+def _scan_rolling(data, start: int, end: int, block_size: int, blocks: List[BlockSignature], wanted,
+                  matches: List[Optional[int]]) -> None:
+    """ Find wanted blocks in data[start:end], rolling the weak sum along a byte at a time. """
+    pos = start
+    weak = None
+    while pos + block_size <= end and wanted:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block_size]) & 0xffffffff
+            a, b = weak & 0xffff, weak >> 16
+        if weak in wanted and _claim(data, pos, block_size, blocks, wanted, weak, matches):
+            pos += block_size
+            weak = None
+            continue
+        if pos + block_size >= end:
+            break
+        a, b = roll(a, b, data[pos], data[pos + block_size], block_size)
+        weak = (b << 16) | a
+        pos += 1
+
+
+def weak_sums(data, start: int, count: int, block_size: int):
+    """
+    numpy array of the adler32 of each of the 'count' windows of 'block_size'
+    bytes starting at data[start], data[start + 1], ...
+
+    For a window of bytes d[i:i + L], adler32 is (b << 16) | a where
+        a = 1 + sum(d[i:i + L])
+        b = L + sum((L - k) * d[i + k] for k in range(L))
+    both mod ADLER_MOD, and both come from prefix sums of d and of j * d[j].
+    """
+    span = numpy.frombuffer(data, dtype=numpy.uint8, count=count + block_size - 1, offset=start)
+    span = span.astype(numpy.int64)
+    sums = numpy.zeros(len(span) + 1, dtype=numpy.int64)
+    numpy.cumsum(span, out=sums[1:])
+    weighted = numpy.zeros(len(span) + 1, dtype=numpy.int64)
+    numpy.cumsum(span * numpy.arange(len(span), dtype=numpy.int64), out=weighted[1:])
+
+    first = numpy.arange(count, dtype=numpy.int64)
+    window = sums[block_size:block_size + count] - sums[:count]
+    a = (1 + window) % ADLER_MOD
+    b = (block_size + (block_size + first) * window - (weighted[block_size:block_size + count] - weighted[:count])) % ADLER_MOD
+    return (b << 16) | a
+
+
+def _scan_numpy(data, start: int, end: int, block_size: int, blocks: List[BlockSignature], wanted,
+                matches: List[Optional[int]]) -> None:
+    """ Find wanted blocks in data[start:end] a chunk of window offsets at a time. """
+    pos = start
+    while pos + block_size <= end and wanted:
+        count = min(SCAN_CHUNK, end - block_size + 1 - pos)
+        sums = weak_sums(data, pos, count, block_size)
+        # Cheap pre-filter on the low WEAK_FILTER_BITS of the weak sums; the
+        # few false positives are weeded out by the lookup in 'wanted' below.
+        wanted_low = numpy.zeros(WEAK_FILTER_MASK + 1, dtype=bool)
+        wanted_low[numpy.fromiter(wanted, dtype=numpy.int64, count=len(wanted)) & WEAK_FILTER_MASK] = True
+        hits = numpy.flatnonzero(wanted_low[sums & WEAK_FILTER_MASK])
+
+        skip_to = pos
+        for offset in hits.tolist():
+            at = pos + offset
+            if at < skip_to:
+                # Inside a block we've already claimed.
+                continue
+            weak = int(sums[offset])
+            if weak not in wanted or not _claim(data, at, block_size, blocks, wanted, weak, matches):
+                continue
+            # Moved data tends to move in runs of blocks: try the next whole
+            # block straight away rather than every offset inside this one.
+            skip_to = at + block_size
+            while skip_to + block_size <= end and wanted:
+                weak = zlib.adler32(data[skip_to:skip_to + block_size]) & 0xffffffff
+                if weak not in wanted or not _claim(data, skip_to, block_size, blocks, wanted, weak, matches):
+                    break
+                skip_to += block_size
+            if not wanted:
+                return
+        pos = max(pos + count, skip_to)
+
+
+def plan_segments(blocks: List[BlockSignature], matches: List[Optional[int]]) -> List[Tuple[bool, int, int]]:
+    """
+    Turns block matches into an ordered list of (is_local, source_offset, length)
+    segments covering the whole remote file, merging contiguous runs. Remote
+    segments are capped at MAX_FETCH.
+    """
+    segments = []
+    for sig, local in zip(blocks, matches):
+        is_local = local is not None
+        source = local if is_local else sig.offset
+        if segments:
+            last_local, last_source, last_length = segments[-1]
+            if (last_local == is_local and last_source + last_length == source and
+                    (is_local or last_length + sig.length <= MAX_FETCH)):
+                segments[-1] = (is_local, last_source, last_length + sig.length)
+                continue
+        segments.append((is_local, source, sig.length))
+    return segments
+
+
+def rebuild(fl: BinaryIO, data, segments: List[Tuple[bool, int, int]], fetched: Iterator[bytes], digest: str) -> int:
+    """
+    Write the remote file's content into 'fl' from local 'data' and the
+    'fetched' remote segment contents (in segment order). Verifies the md5.
+
+    :return: Number of bytes written.
+    """
+    whole = hashlib.md5()
+    written = 0
+    fl.seek(0)
+    for is_local, source, length in segments:
+        chunk = data[source:source + length] if is_local else next(fetched)
+        if len(chunk) != length:
+            raise DeltaError("short read: wanted %d bytes, got %d" % (length, len(chunk)))
+        whole.update(chunk)
+        fl.write(chunk)
+        written += length
+    if whole.hexdigest() != digest:
+        raise DeltaError("checksum mismatch after rebuild (remote changed during sync?)")
+    return written
+
+
+def delta_fetch(sftp_client, ssh, remote_path: str, local_path: str, fl: BinaryIO,
+                block_size: int, python: str="python3", logger=logging) -> int:
+    """
+    Rebuild 'remote_path' into the open temp file 'fl', reusing data from the
+    existing 'local_path'. Intended as a create_file callback.
+
+    :return: Size of the rebuilt file.
+    :raises DeltaError: if the delta couldn't be applied.
+    """
+    size, digest, blocks = remote_signatures(ssh, remote_path, block_size, python)
+
+    with open(local_path, "rb") as src:
+        local_size = os.fstat(src.fileno()).st_size
+        if not local_size or not blocks:
+            raise DeltaError("nothing to reuse")
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            matches = match_blocks(mm, blocks)
+            segments = plan_segments(blocks, matches)
+
+            ranges = [(source, length) for is_local, source, length in segments if not is_local]
+            fetch_bytes = sum(length for _, length in ranges)
+            logger.info("%s: delta fetching %d of %d bytes in %d ranges", remote_path, fetch_bytes, size, len(ranges))
+
+            if ranges:
+                with sftp_client.open(remote_path, "rb") as rfh:
+                    return rebuild(fl, mm, segments, rfh.readv(ranges), digest)
+            return rebuild(fl, mm, segments, iter(()), digest)
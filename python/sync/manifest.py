@@ -0,0 +1,146 @@
+"""
+Whole-tree remote listings in one round-trip.
+
+Listing a big tree over SFTP costs a request per directory, however little
+has changed. Instead summer.py can walk the remote tree itself and stream
+back a gzipped manifest of every file and directory -- size, mtime, inode
+and ctime -- over a single exec channel:
+
+    python3 - --manifest /remote/root < summer.py | (gzip stream)
+
+read_manifest turns that stream back into one listing per directory, with
+the entries as RemoteStats that stand in for SFTPAttributes, parents before
+their children and each directory's entries in name order, ready to be
+merge-joined against the local listing.
+
+The inode and ctime are what SFTP can't tell us: a file rewritten in place
+with its old mtime put back still gets a new ctime (and often a new inode),
+so with the values recorded at the last sync we can tell a remote file
+changed without comparing checksums.
+"""
+
+from   stat import S_IFDIR, S_IFREG
+from   typing import BinaryIO, Dict, Iterator, NamedTuple, Optional
+import logging
+import os
+import shlex
+import zlib
+
+
+SUMMER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "summer.py")
+
+""" Size of the reads from the manifest stream. """
+READ_SIZE = 256 * 1024
+
+
+class ManifestError(Exception):
+    """ The remote manifest couldn't be produced or read. """
+    pass
+
+
+class RemoteStat(object):
+    """ An entry from a manifest, with the SFTPAttributes fields syncer uses plus inode and ctime. """
+
+    __slots__ = ("filename", "st_mode", "st_size", "st_mtime", "st_mtime_ns", "st_ino", "st_ctime_ns")
+
+    def __init__(self, filename: str, is_dir: bool, size: int, mtime_ns: int, ino: int, ctime_ns: int):
+        self.filename    = filename
+        self.st_mode     = (S_IFDIR | 0o755) if is_dir else (S_IFREG | 0o644)
+        self.st_size     = size
+        self.st_mtime    = mtime_ns // 1000000000      # whole seconds, as SFTP reports it
+        self.st_mtime_ns = mtime_ns
+        self.st_ino      = ino
+        self.st_ctime_ns = ctime_ns
+
+    def __repr__(self) -> str:
+        return "RemoteStat(%r, size=%d, mtime=%d, ino=%d)" % (self.filename, self.st_size, self.st_mtime, self.st_ino)
+
+
+class DirListing(NamedTuple):
+    """
+    One directory of a manifest. 'stat' and 'entries' are None if the remote
+    couldn't list it.
+    """
+    path:    str
+    stat:    Optional[RemoteStat]
+    entries: Optional[Dict[str, RemoteStat]]
+
+
+def manifest_command(remote_root: str, python: str = "python3") -> str:
+    return "%s - --manifest %s" % (python, shlex.quote(remote_root))
+
+
+def _records(stream: BinaryIO) -> Iterator[bytes]:
+    """ Decompress the stream as it arrives and split it into records. """
+    unpacker = zlib.decompressobj(31)
+    tail = b""
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        try:
+            data = tail + unpacker.decompress(chunk)
+        except zlib.error as e:
+            raise ManifestError("bad manifest stream: %s" % e) from None
+        records = data.split(b"\0")
+        tail = records.pop()
+        yield from records
+    if tail or not unpacker.eof:
+        raise ManifestError("manifest stream was cut short")
+
+
+def read_manifest(stream: BinaryIO) -> Iterator[DirListing]:
+    """ Parse a manifest stream into DirListings as each directory is complete. """
+    current = None
+    for record in _records(stream):
+        kind, _, rest = record.partition(b" ")
+        if kind in (b"f", b"d"):
+            size, mtime_ns, ino, ctime_ns, path = rest.split(b" ", 4)
+            path = os.fsdecode(path)
+            name = path.rpartition('/')[2]
+            current.entries[name] = RemoteStat(name, kind == b"d", int(size), int(mtime_ns), int(ino), int(ctime_ns))
+            continue
+
+        if current is not None:
+            yield current
+            current = None
+        if kind == b"D":
+            mtime_ns, ino, ctime_ns, path = rest.split(b" ", 3)
+            path = os.fsdecode(path)
+            current = DirListing(path, RemoteStat(path.rpartition('/')[2], True, 0, int(mtime_ns), int(ino),
+                                                  int(ctime_ns)), {})
+        elif kind == b"E":
+            yield DirListing(os.fsdecode(rest), None, None)
+        else:
+            raise ManifestError("unexpected manifest record: %r" % record[:80])
+
+    if current is not None:
+        yield current
+
+
+def remote_manifest(ssh, remote_root: str, python: str = "python3", logger=logging) -> Iterator[DirListing]:
+    """
+    Run summer.py's manifest mode on the remote via an SSHSession (anything
+    with start()) and yield its DirListings as they stream in.
+
+    :raises ManifestError: if the stream was bad or the remote command failed.
+    """
+    with open(SUMMER_PATH, "rb") as fh:
+        script = fh.read()
+    cmd = manifest_command(remote_root, python)
+    logger.debug(cmd)
+
+    try:
+        stdout = ssh.start(cmd, inputs=script)
+    except Exception as e:
+        # e.g. the interpreter doesn't exist, and the remote closed our stdin.
+        raise ManifestError("couldn't start %s: %s" % (cmd, e)) from e
+    try:
+        yield from read_manifest(stdout)
+    finally:
+        # Drain anything left so the command can exit.
+        while stdout.read(READ_SIZE):
+            pass
+    rc = stdout.channel.recv_exit_status()
+    if rc != 0:
+        raise ManifestError("remote manifest failed (%d): %s" % (rc, cmd))
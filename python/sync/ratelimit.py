@@ -0,0 +1,32 @@
+"""
+Bandwidth limiting for transfers that share a connection.
+"""
+
+from threading import Lock
+import time
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all download channels to cap total bandwidth.
+
+    :param bytes_per_sec: Sustained rate; a second's worth may be used in a burst,
+    """
+
+    def __init__(self, bytes_per_sec: int):
+        self.rate    = float(bytes_per_sec)
+        self._tokens = self.rate
+        self._stamp  = time.monotonic()
+        self._lock   = Lock()
+
+
+    def consume(self, nbytes: int) -> None:
+        """ Account for nbytes transferred, sleeping if we're over budget. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= nbytes
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
@@ -1,7 +1,10 @@
 import logging
+import threading
 from paramiko import client as pmclient
 
-import time
+
+# Size of the reads when draining a command's output.
+DRAIN_SIZE = 32 * 1024
 
 
 class SSHSession(object):
@@ -15,23 +18,52 @@ class SSHSession(object):
         ssh.connect(hostname, username=username, password=password, look_for_keys=False)
 
 
-    def execute(self, command, inputs=None, read_stdout=False, *args, **kwargs):
+    def start(self, command, inputs=None, *args, **kwargs):
+        """
+        Start a command, send it any inputs, and return its stdout without
+        waiting for it to finish, so the caller can get on with other work.
+        Read the output, then collect the exit code with
+        stdout.channel.recv_exit_status().
+
+        The command's stderr is read by a thread of its own and logged (at
+        debug level), so a chatty command can't fill the channel and stall
+        while the caller is still reading stdout or waiting for it to exit.
+        """
         stdin, stdout, stderr = self.client.exec_command(command, *args, **kwargs)
 
+        threading.Thread(target=self._drain_stderr, args=(command, stderr),
+                         name="stderr", daemon=True).start()
+
         if inputs:
             stdin.channel.sendall(inputs)
             stdin.channel.shutdown_write()
 
-        while True:
-            if stdout.channel.exit_status_ready():
-                break
-            time.sleep(0.001)
+        return stdout
 
-        rc = stdout.channel.recv_exit_status()
+
+    def _drain_stderr(self, command, stderr):
+        try:
+            for line in stderr:
+                self.logger.debug("%s: %s", command, line.rstrip())
+        except Exception as e:
+            self.logger.debug("%s: reading stderr: %s", command, e)
+
+
+    def execute(self, command, inputs=None, read_stdout=False, *args, **kwargs):
+        stdout = self.start(command, inputs, *args, **kwargs)
+
+        # Drain output as it arrives, even if we don't want it: a command with
+        # more output than the channel window would otherwise stall before it
+        # could exit. (start() takes care of stderr.)
         if read_stdout:
-            return rc, stdout.read()
+            output = stdout.read()
         else:
-            return rc
+            while stdout.read(DRAIN_SIZE):
+                pass
+
+        # Blocks on the channel's exit-status event rather than polling.
+        rc = stdout.channel.recv_exit_status()
+        return (rc, output) if read_stdout else rc
 
 
     def ping(self):
@@ -59,6 +91,12 @@ class SFTPSession(object):
             sftp.chdir(initial_path)
 
 
+    @property
+    def ssh(self):
+        """ The SSHSession this SFTP channel runs over (e.g. for remote commands). """
+        return self.__ssh_client
+
+
     def ping(self):
         self.client.stat('.')
 
@@ -0,0 +1,223 @@
+"""
+Persistent record of what syncer last reconciled.
+
+For every directory syncer has fully reconciled we keep the remote mtime we
+synced from and the local mtime that resulted, plus the remote and local
+attributes of each entry in it. On the next run a directory whose mtime is
+unchanged on both sides doesn't need listing: its entries are as recorded and
+only its sub-directories need looking at (a change further down doesn't touch
+the parent's mtime), so a run costs one stat per unchanged directory rather
+than a listing of both sides.
+
+With a remote manifest (sync/manifest.py) each file's remote inode and ctime
+are kept too, so a later run can tell whether the remote file changed.
+
+Note that this trusts directory mtimes: a file edited in place, on either
+side, doesn't change its directory's mtime and so isn't noticed. syncer only
+skips directories like this with --skip-unchanged-dirs, and even then lists
+everything once the last full listing ('listed' meta value, a time()) is
+--full-listing-hours old.
+
+The database is sqlite in WAL mode. A directory's rows are only written once
+everything in it has been synced, in a single transaction, so a crash just
+means that directory gets listed again next time; removing the file makes
+the next run a full one.
+
+It also serves as the checkpoint of a run in progress: directories are
+recorded as soon as they are finished rather than at the end, files whose
+checksums were found to differ are kept until they've been downloaded (so an
+interrupted run doesn't checksum them again), and the 'run' meta value is set
+until the run completes, so the next one knows it is resuming. Directories are
+stamped with the run that recorded them, and a resumed run skips those the
+interrupted one finished, if they haven't changed since, whether or not it
+would otherwise skip unchanged directories.
+"""
+
+from   typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import os
+import sqlite3
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path     TEXT PRIMARY KEY,  -- relative posix path, '' for the root
+    parent   TEXT,              -- path of the containing directory, NULL for the root
+    is_dir   INTEGER NOT NULL,
+    r_size   INTEGER,
+    r_mtime  INTEGER,           -- remote mtime in seconds, as SFTP reports it
+    l_size   INTEGER,
+    l_mtime  INTEGER,           -- local mtime in nanoseconds
+    r_ino    INTEGER,           -- remote inode and ctime (ns), if a manifest told us
+    r_ctime  INTEGER,
+    run      TEXT               -- stamp of the run that reconciled a directory
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+CREATE TABLE IF NOT EXISTS mismatches (
+    path     TEXT PRIMARY KEY,  -- a file whose checksum differed from the remote's
+    parent   TEXT,
+    r_size   INTEGER,           -- ... when the two sides looked like this
+    r_mtime  INTEGER,
+    l_size   INTEGER,
+    l_mtime  INTEGER
+);
+CREATE INDEX IF NOT EXISTS mismatches_parent ON mismatches(parent);
+CREATE TABLE IF NOT EXISTS meta (
+    key      TEXT PRIMARY KEY,
+    value    TEXT
+);
+"""
+
+COLUMNS = "path, is_dir, r_size, r_mtime, l_size, l_mtime, r_ino, r_ctime, run"
+
+""" Columns added since the first version, for upgrading older databases. """
+ADDED_COLUMNS = ("r_ino INTEGER", "r_ctime INTEGER", "run TEXT")
+
+
+class Entry(NamedTuple):
+    """
+    State of one path. A directory's own sizes are unused and its mtimes are
+    only set once it has been reconciled; until then it is just a name its
+    parent listed. 'run' is the stamp of the run that reconciled a directory.
+    """
+    path:    str
+    is_dir:  bool
+    r_size:  Optional[int] = None
+    r_mtime: Optional[int] = None
+    l_size:  Optional[int] = None
+    l_mtime: Optional[int] = None
+    r_ino:   Optional[int] = None
+    r_ctime: Optional[int] = None
+    run:     Optional[str] = None
+
+
+def parent_of(rel_path: str) -> Optional[str]:
+    return rel_path.rpartition('/')[0] if rel_path else None
+
+
+def _like_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SyncState(object):
+    """
+    sqlite-backed sync state. Calls are serialised, so it can be shared between threads.
+
+    :param db_path: Location of the database file,
+    :param rebuild: Discard any existing state first,
+    """
+
+    def __init__(self, db_path: str, rebuild: bool = False):
+        if rebuild:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink(db_path + suffix)
+                except FileNotFoundError:
+                    pass
+        self.path = db_path
+        # Used from one thread at a time (see _lock), though not always the one that opened it.
+        self.db   = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        have = {row[1] for row in self.db.execute("PRAGMA table_info(entries)")}
+        for column in ADDED_COLUMNS:
+            if column.split()[0] not in have:
+                self.db.execute("ALTER TABLE entries ADD COLUMN %s" % column)
+
+
+    def get(self, rel_path: str) -> Optional[Entry]:
+        with self._lock:
+            row = self.db.execute("SELECT %s FROM entries WHERE path = ?" % COLUMNS, (rel_path,)).fetchone()
+        return Entry(*row) if row else None
+
+
+    def children(self, rel_path: str) -> Dict[str, Entry]:
+        """ Recorded entries of a directory, by name. """
+        with self._lock:
+            rows = self.db.execute("SELECT %s FROM entries WHERE parent = ?" % COLUMNS, (rel_path,)).fetchall()
+        return {row[0].rpartition('/')[2]: Entry(*row) for row in rows}
+
+
+    def child_dirs(self, rel_path: str) -> List[str]:
+        with self._lock:
+            rows = self.db.execute("SELECT path FROM entries WHERE parent = ? AND is_dir ORDER BY path",
+                                   (rel_path,)).fetchall()
+        return [row[0] for row in rows]
+
+
+    def record_dir(self, rel_path: str, r_mtime: int, l_mtime: int, entries: Iterable[Entry],
+                   run: Optional[str] = None) -> None:
+        """
+        Record a reconciled directory and its entries, dropping anything it no
+        longer contains (and everything below that), in one transaction.
+        Any mismatches recorded for its files are done with. 'run' stamps the
+        directory with the run that reconciled it.
+        """
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM mismatches WHERE parent = ?", (rel_path,))
+            names = set()
+            for entry in entries:
+                names.add(entry.path)
+                if entry.is_dir:
+                    # Keep any state the sub-directory has of its own, unless it used to be a file.
+                    self.db.execute("DELETE FROM entries WHERE path = ? AND NOT is_dir", (entry.path,))
+                    self.db.execute("INSERT OR IGNORE INTO entries (path, parent, is_dir) VALUES (?, ?, 1)",
+                                    (entry.path, rel_path))
+                else:
+                    self._delete_tree(entry.path)
+                    self.db.execute("INSERT INTO entries (parent, %s) VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?)" % COLUMNS,
+                                    (rel_path, entry.path, entry.r_size, entry.r_mtime, entry.l_size, entry.l_mtime,
+                                     entry.r_ino, entry.r_ctime, entry.run))
+
+            stale = [path for path, in self.db.execute("SELECT path FROM entries WHERE parent = ?", (rel_path,))
+                     if path not in names]
+            for path in stale:
+                self._delete_tree(path)
+
+            self.db.execute("INSERT OR REPLACE INTO entries (path, parent, is_dir, r_mtime, l_mtime, run) "
+                            "VALUES (?, ?, 1, ?, ?, ?)",
+                            (rel_path, parent_of(rel_path), r_mtime, l_mtime, run))
+
+
+    def record_mismatch(self, rel_path: str, r_size: int, r_mtime: int, l_size: int, l_mtime: int) -> None:
+        """ Note that a file's checksum differed from the remote's while the two sides looked like this. """
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO mismatches VALUES (?, ?, ?, ?, ?, ?)",
+                            (rel_path, parent_of(rel_path), r_size, r_mtime, l_size, l_mtime))
+
+
+    def mismatches(self, rel_path: str) -> Dict[str, Tuple[int, int, int, int]]:
+        """ Mismatches recorded in a directory: name -> (r_size, r_mtime, l_size, l_mtime). """
+        with self._lock:
+            rows = self.db.execute("SELECT path, r_size, r_mtime, l_size, l_mtime FROM mismatches WHERE parent = ?",
+                                   (rel_path,)).fetchall()
+        return {row[0].rpartition('/')[2]: tuple(row[1:]) for row in rows}
+
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+    def set_meta(self, key: str, value: Optional[str]) -> None:
+        """ Set, or with None remove, a meta value. """
+        with self._lock, self.db:
+            if value is None:
+                self.db.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+
+    def _delete_tree(self, rel_path: str) -> None:
+        self.db.execute("DELETE FROM entries WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                        (rel_path, _like_escape(rel_path) + '/%'))
+
+
+    def close(self) -> None:
+        with self._lock:
+            if self.db:
+                self.db.close()
+                self.db = None
@@ -1,7 +1,12 @@
 #! /usr/bin/env python
 #
-# Takes a block number followed by a list of files, and returns the md5 checkum
-# of the Nth block of each file.
+# Remote-side checksum helper for syncer. Runs under Python 2.7 or 3 so it can
+# be piped to whatever 'python' the remote host has:
+#
+#   ssh host python3 - --signatures 65536 /path/to/file < summer.py
+#
+# Block mode: takes a block number followed by a list of files, and returns
+# the md5 checkum of the Nth block of each file.
 #
 # e.g. 0 /etc/motd /etc/motd.issue
 # will yield the checksum of block 0 (the first 64k) of motd and motd.issue
@@ -9,24 +14,119 @@
 # Output format is:
 #
 # <filename> <md5sum for the given block>
+#
+# Signature mode (--signatures <block size> <file>): emits the signatures the
+# local side needs for a delta download (see sync/delta.py):
+#
+# <file size> <md5sum of the whole file>
+# <offset> <length> <adler32 as hex> <md5sum>     (one line per block)
+#
+# Manifest mode (--manifest <root>): walks the whole tree under root and
+# writes one gzip stream of NUL-terminated records, a directory at a time
+# (see sync/manifest.py):
+#
+# D <mtime_ns> <ino> <ctime_ns> <dir>               (starts a directory's entries)
+# <f|d> <size> <mtime_ns> <ino> <ctime_ns> <path>   (one per file or sub-directory)
+# E <dir>                                           (directory couldn't be listed)
+#
+# Paths are relative to root, and directories are written parents first.
+# Symlinks and special files are left out.
 
 from __future__ import print_function
 
 import hashlib
-import mmap
+import os
+import stat
 import sys
+import zlib
 
 BlockSize = 64 * 1024
 
-block, files = int(sys.argv[1]), sys.argv[2:]
-start_offset = BlockSize * block
 
-for filename in files:
+def block_sums(block, files):
+    start_offset = BlockSize * block
+    for filename in files:
+        with open(filename, "rb") as fh:
+            fh.seek(start_offset)
+            hashval = hashlib.md5(fh.read(BlockSize))
+        print(filename, hashval.hexdigest())
+
+
+def signatures(block_size, filename):
+    lines, whole, size = [], hashlib.md5(), 0
     with open(filename, "rb") as fh:
-        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
-        length = min(mm.size() - start_offset, BlockSize)
-        buf = buffer(mm, start_offset, length)
-        del mm
-        hashval = hashlib.md5(buf)
-    print(filename, hashval.hexdigest())
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            whole.update(block)
+            lines.append("%d %d %08x %s" % (size, len(block), zlib.adler32(block) & 0xffffffff,
+                                            hashlib.md5(block).hexdigest()))
+            size += len(block)
+    print(size, whole.hexdigest())
+    if lines:
+        print("\n".join(lines))
+
+
+def _stat_fields(st):
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    ctime_ns = getattr(st, "st_ctime_ns", None)
+    if ctime_ns is None:
+        ctime_ns = int(st.st_ctime * 1000000000)
+    return mtime_ns, st.st_ino, ctime_ns
+
+
+def manifest(root):
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    packer = zlib.compressobj(1, zlib.DEFLATED, 31)    # 31: gzip framing
+
+    def write(record):
+        data = packer.compress(record + b"\0")
+        if data:
+            out.write(data)
+
+    # Bytes throughout, so any file name survives the trip.
+    if not isinstance(root, bytes):
+        root = root.encode(sys.getfilesystemencoding())
+    pending = [b""]
+    while pending:
+        rel_dir = pending.pop()
+        full_dir = os.path.join(root, rel_dir) if rel_dir else root
+        try:
+            names = sorted(os.listdir(full_dir))
+            header = b"D %d %d %d " % _stat_fields(os.lstat(full_dir))
+        except OSError:
+            write(b"E " + rel_dir)
+            continue
+        write(header + rel_dir)
+        subdirs = []
+        for name in names:
+            path = rel_dir + b"/" + name if rel_dir else name
+            try:
+                st = os.lstat(os.path.join(full_dir, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(path)
+                kind = b"d"
+            elif stat.S_ISREG(st.st_mode):
+                kind = b"f"
+            else:
+                continue
+            write(kind + b" %d %d %d %d " % ((st.st_size,) + _stat_fields(st)) + path)
+        # Depth first, in name order.
+        pending.extend(reversed(subdirs))
+
+    out.write(packer.flush())
+    out.flush()
+
 
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--signatures"]:
+        signatures(int(sys.argv[2]), sys.argv[3])
+    elif sys.argv[1:2] == ["--manifest"]:
+        manifest(sys.argv[2])
+    else:
+        block_sums(int(sys.argv[1]), sys.argv[2:])
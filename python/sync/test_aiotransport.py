@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase
+
+import aiotransport
+
+
+class FakeClient(object):
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def stat(self, path):
+        with self.tracker.lock:
+            self.tracker.active += 1
+            self.tracker.peak = max(self.tracker.peak, self.tracker.active)
+            self.tracker.threads.add(threading.get_ident())
+        if path == "slow":
+            self.tracker.release.wait()
+        else:
+            time.sleep(0.005)
+        with self.tracker.lock:
+            self.tracker.active -= 1
+        return path.upper()
+
+
+class FakeSession(object):
+    def __init__(self, tracker):
+        self.client = FakeClient(tracker)
+
+    def close(self):
+        pass
+
+
+class Tracker(object):
+    def __init__(self):
+        self.lock, self.active, self.peak, self.threads = threading.Lock(), 0, 0, set()
+        self.release = threading.Event()
+
+
+class TestAioTransport(TestCase):
+    def test_channels_bound_concurrency(self) -> None:
+        tracker = Tracker()
+
+        async def run():
+            remote = aiotransport.AsyncSFTP([FakeSession(tracker) for _ in range(3)], ssh=None, max_execs=1)
+            async with remote:
+                return await asyncio.gather(*(remote.stat("f%d" % n) for n in range(50)))
+
+        results = asyncio.run(run())
+        self.assertEqual(results, ["F%d" % n for n in range(50)])
+        self.assertLessEqual(tracker.peak, 3)
+        # Each channel is only used from its own thread.
+        self.assertLessEqual(len(tracker.threads), 3)
+
+    def test_cancelled_call_keeps_channel(self) -> None:
+        """ A cancelled call's channel isn't handed on while its thread is still using it. """
+        tracker = Tracker()
+
+        async def run():
+            remote = aiotransport.AsyncSFTP([FakeSession(tracker)], ssh=None, max_execs=1)
+            async with remote:
+                slow = asyncio.ensure_future(remote.stat("slow"))
+                while not tracker.active:
+                    await asyncio.sleep(0.001)
+                slow.cancel()
+                fast = asyncio.ensure_future(remote.stat("fast"))
+                await asyncio.sleep(0.05)
+                waiting = not fast.done()
+                tracker.release.set()
+                return slow.cancelled(), waiting, await fast
+
+        self.assertEqual(asyncio.run(run()), (True, True, "FAST"))
+        self.assertEqual(tracker.peak, 1)
+
+    def test_bounded_map(self) -> None:
+        active, peak = 0, 0
+
+        async def work(n):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.001 * (n % 3))
+            active -= 1
+            return n * 2
+
+        async def run():
+            return [pair async for pair in aiotransport.bounded_map(work, range(100), limit=7)]
+
+        results = asyncio.run(run())
+        self.assertEqual(sorted(results), [(n, n * 2) for n in range(100)])
+        self.assertEqual(peak, 7)
+
+    def test_bounded_map_error(self) -> None:
+        async def work(n):
+            if n == 5:
+                raise ValueError(n)
+            await asyncio.sleep(0.01)
+            return n
+
+        async def run():
+            return [pair async for pair in aiotransport.bounded_map(work, range(100), limit=10)]
+
+        with self.assertRaises(ValueError):
+            asyncio.run(run())
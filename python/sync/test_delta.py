@@ -0,0 +1,90 @@
+from io import BytesIO
+import hashlib
+import random
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+import zlib
+
+import delta
+
+
+BLOCK = 64
+
+
+def signatures(data: bytes):
+    blocks = []
+    for offset in range(0, len(data), BLOCK):
+        block = data[offset:offset + BLOCK]
+        blocks.append(delta.BlockSignature(offset, len(block), zlib.adler32(block), hashlib.md5(block).hexdigest()))
+    return blocks
+
+
+def apply(old: bytes, new: bytes):
+    """ Returns (rebuilt bytes, number of bytes that had to be 'fetched'). """
+    blocks = signatures(new)
+    segments = delta.plan_segments(blocks, delta.match_blocks(old, blocks))
+    fetched = [new[source:source + length] for is_local, source, length in segments if not is_local]
+    out = BytesIO()
+    delta.rebuild(out, old, segments, iter(fetched), hashlib.md5(new).hexdigest())
+    return out.getvalue(), sum(len(f) for f in fetched)
+
+
+class TestDelta(TestCase):
+    def setUp(self) -> None:
+        rng = random.Random(1)
+        self.data = bytes(rng.getrandbits(8) for _ in range(BLOCK * 20 + 17))
+
+    def test_roll(self) -> None:
+        data = self.data
+        weak = zlib.adler32(data[:BLOCK])
+        a, b = weak & 0xffff, weak >> 16
+        for pos in range(200):
+            a, b = delta.roll(a, b, data[pos], data[pos + BLOCK], BLOCK)
+            self.assertEqual((b << 16) | a, zlib.adler32(data[pos + 1:pos + 1 + BLOCK]))
+
+    def test_parse_signatures(self) -> None:
+        size, digest, blocks = delta.parse_signatures("130 abc\n0 64 0000000a d1\n64 64 0000000b d2\n128 2 0000000c d3\n")
+        self.assertEqual((size, digest), (130, "abc"))
+        self.assertEqual(blocks[1], delta.BlockSignature(64, 64, 11, "d2"))
+
+    def test_unchanged(self) -> None:
+        rebuilt, fetched = apply(self.data, self.data)
+        self.assertEqual(rebuilt, self.data)
+        self.assertEqual(fetched, 0)
+
+    def test_appended(self) -> None:
+        new = self.data + b"more log lines\n" * 20
+        rebuilt, fetched = apply(self.data, new)
+        self.assertEqual(rebuilt, new)
+        self.assertLess(fetched, len(new) - len(self.data) + BLOCK)
+
+    def test_inserted(self) -> None:
+        new = self.data[:BLOCK * 3 + 5] + b"inserted" + self.data[BLOCK * 3 + 5:]
+        rebuilt, fetched = apply(self.data, new)
+        self.assertEqual(rebuilt, new)
+        self.assertLessEqual(fetched, BLOCK * 3)
+
+    def test_scans_agree(self) -> None:
+        # Moved blocks, repeats and blocks we don't have, through both rolling scans.
+        rng = random.Random(2)
+        new = (self.data[BLOCK * 5:] + b"x" + self.data[:BLOCK * 5] + self.data[BLOCK:BLOCK * 2] * 3 +
+               bytes(rng.getrandbits(8) for _ in range(BLOCK * 2)))
+        blocks = signatures(new)
+        expected = delta.match_blocks(self.data, blocks)
+        with patch.object(delta, "numpy", None):
+            self.assertEqual(delta.match_blocks(self.data, blocks), expected)
+        with patch.object(delta, "SCAN_CHUNK", 7):
+            self.assertEqual(delta.match_blocks(self.data, blocks), expected)
+        self.assertEqual(apply(self.data, new)[0], new)
+
+    @skipUnless(delta.numpy, "needs numpy")
+    def test_weak_sums(self) -> None:
+        data = self.data + b"\xff" * BLOCK
+        sums = delta.weak_sums(data, 3, 500, BLOCK)
+        self.assertEqual(sums.tolist(), [zlib.adler32(data[pos:pos + BLOCK]) for pos in range(3, 503)])
+
+    def test_bad_digest(self) -> None:
+        blocks = signatures(self.data)
+        segments = delta.plan_segments(blocks, delta.match_blocks(self.data, blocks))
+        with self.assertRaises(delta.DeltaError):
+            delta.rebuild(BytesIO(), self.data, segments, iter(()), "0" * 32)
@@ -0,0 +1,40 @@
+from io import BytesIO
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+import manifest
+
+
+class TestManifest(TestCase):
+    def test_walk_and_parse(self) -> None:
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "a", "empty"))
+            with open(os.path.join(root, "a", "x y"), "wb") as fh:
+                fh.write(b"12345")
+            with open(os.path.join(root, "z"), "wb") as fh:
+                fh.write(b"1")
+            os.symlink("z", os.path.join(root, "link"))
+
+            output = subprocess.run([sys.executable, manifest.SUMMER_PATH, "--manifest", root],
+                                    stdout=subprocess.PIPE, check=True).stdout
+            listings = list(manifest.read_manifest(BytesIO(output)))
+
+            self.assertEqual([listing.path for listing in listings], ["", "a", "a/empty"])
+            self.assertEqual(sorted(listings[0].entries), ["a", "z"])
+            self.assertEqual(listings[2].entries, {})
+
+            entry, st = listings[1].entries["x y"], os.stat(os.path.join(root, "a", "x y"))
+            self.assertEqual((entry.filename, entry.st_size, entry.st_mtime_ns, entry.st_ino, entry.st_ctime_ns),
+                             ("x y", 5, st.st_mtime_ns, st.st_ino, st.st_ctime_ns))
+            self.assertEqual(entry.st_mtime, int(st.st_mtime))
+            self.assertEqual(listings[1].stat.st_ino, os.stat(os.path.join(root, "a")).st_ino)
+
+    def test_truncated(self) -> None:
+        with tempfile.TemporaryDirectory() as root:
+            output = subprocess.run([sys.executable, manifest.SUMMER_PATH, "--manifest", root],
+                                    stdout=subprocess.PIPE, check=True).stdout
+        with self.assertRaises(manifest.ManifestError):
+            list(manifest.read_manifest(BytesIO(output[:-6])))
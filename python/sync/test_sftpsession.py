@@ -0,0 +1,70 @@
+import subprocess
+import sys
+from unittest import TestCase, skipUnless
+
+try:
+    import sftpsession
+except ImportError:         # paramiko isn't installed
+    sftpsession = None
+
+
+class ProcessChannel(object):
+    def __init__(self, process):
+        self.process = process
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class ProcessStream(object):
+    """ Just enough of a paramiko ChannelFile over one of a subprocess's pipes. """
+    def __init__(self, fh, channel):
+        self.fh, self.channel = fh, channel
+
+    def read(self, *args):
+        return self.fh.read(*args)
+
+    def __iter__(self):
+        return iter(self.fh)
+
+
+class LocalClient(object):
+    """ Runs 'remote' commands locally, with real pipes that fill up when nobody reads them. """
+    def exec_command(self, command):
+        process = subprocess.Popen([sys.executable, "-c", command], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        channel = ProcessChannel(process)
+        return (ProcessStream(process.stdin, channel), ProcessStream(process.stdout, channel),
+                ProcessStream(process.stderr, channel))
+
+
+@skipUnless(sftpsession, "needs paramiko")
+class TestSSHSession(TestCase):
+    def session(self):
+        session = object.__new__(sftpsession.SSHSession)
+        session.client, session.logger = LocalClient(), sftpsession.logging
+        return session
+
+    def test_chatty_command(self) -> None:
+        # Far more output on both streams than a pipe holds.
+        chatty = ("import sys\n"
+                  "for n in range(20000):\n"
+                  "    sys.stderr.write('warning %d\\n' % n)\n"
+                  "    sys.stdout.write('line %d\\n' % n)\n"
+                  "sys.exit(3)\n")
+        session = self.session()
+        rc, output = session.execute(chatty, read_stdout=True)
+        self.assertEqual(rc, 3)
+        self.assertEqual(output.count(b"\n"), 20000)
+        self.assertEqual(session.execute(chatty), 3)
+
+    def test_inputs(self) -> None:
+        rc, output = self.session().execute("import sys; sys.stdout.write(sys.stdin.read().upper())",
+                                            inputs=b"hello", read_stdout=True)
+        self.assertEqual((rc, output), (0, b"HELLO"))
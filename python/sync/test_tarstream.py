@@ -0,0 +1,62 @@
+from io import BytesIO
+import tarfile
+from unittest import TestCase
+
+import tarstream
+
+
+def make_archive(files, compression="gzip"):
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w|gz" if compression == "gzip" else "w|") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(data), 1234567890
+            tar.addfile(info, BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+
+class TestTarStream(TestCase):
+    def test_extract_wanted_only(self) -> None:
+        stream = make_archive({"a/one": b"1" * 300000, "../evil": b"x", "b/two": b"22"})
+        written = {}
+
+        def write(item, member, copy):
+            out = BytesIO()
+            self.assertEqual(copy(out), member.size)
+            written[item] = (out.getvalue(), member.mtime)
+
+        with tarstream.open_archive(stream, "gzip") as archive:
+            missing = tarstream.extract(archive, {"a/one": "A", "b/two": "B", "c/three": "C"}, write)
+
+        self.assertEqual(missing, ["c/three"])
+        self.assertEqual(sorted(written), ["A", "B"])
+        self.assertEqual(written["A"], (b"1" * 300000, 1234567890))
+
+    def test_command(self) -> None:
+        self.assertEqual(tarstream.archive_command("/data/my files", "gzip"),
+                         "cd '/data/my files' && tar -cf - --null -T - | gzip -1 -c")
+        self.assertEqual(tarstream.archive_command("src", "none"), "cd src && tar -cf - --null -T -")
+        with self.assertRaises(ValueError):
+            tarstream.archive_command("src", "lz4")
+
+    def test_non_regular_members_are_missing(self) -> None:
+        buffer = BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w|") as tar:
+            link = tarfile.TarInfo("a/link")
+            link.type, link.linkname = tarfile.SYMTYPE, "one"
+            tar.addfile(link)
+            directory = tarfile.TarInfo("a/dir")
+            directory.type = tarfile.DIRTYPE
+            tar.addfile(directory)
+            info = tarfile.TarInfo("a/one")
+            info.size = 3
+            tar.addfile(info, BytesIO(b"one"))
+        buffer.seek(0)
+
+        written = []
+        with tarstream.open_archive(buffer, "none") as archive:
+            missing = tarstream.extract(archive, {"a/link": "L", "a/dir": "D", "a/one": "O"},
+                                        lambda item, member, copy: written.append(item))
+        self.assertEqual(written, ["O"])
+        self.assertEqual(sorted(missing), ["a/dir", "a/link"])
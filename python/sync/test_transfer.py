@@ -0,0 +1,96 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import transfer
+
+
+class TestPartJournal(TestCase):
+    def test_sequential_parts_resume(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "file.tmp")
+            with open(path, "wb") as fl:
+                journal = transfer.PartJournal(fl, 250, 1234, part_size=100)
+                fl.write(b"x" * 150)
+                journal.update(150)
+                fl.write(b"x" * 80)
+                journal.update(230)
+                journal.close(complete=False)
+
+            jpath = transfer.journal_path(path)
+            self.assertEqual(transfer.load_journal(jpath, 250, 1234, 100), {0, 100})
+            # A different remote file, or part size, means starting again.
+            self.assertEqual(transfer.load_journal(jpath, 250, 1235, 100), set())
+            self.assertEqual(transfer.load_journal(jpath, 250, 1234, 50), set())
+
+    def test_last_part_and_cleanup(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "file.tmp")
+            with open(path, "wb") as fl:
+                journal = transfer.PartJournal(fl, 250, 1234, part_size=100)
+                fl.write(b"x" * 250)
+                journal.update(250)
+                self.assertEqual(transfer.load_journal(journal.path, 250, 1234, 100), {0, 100, 200})
+                journal.close(complete=True)
+            self.assertFalse(os.path.exists(transfer.journal_path(path)))
+
+
+class Source(object):
+    """ Opens SFTP 'channels' onto bytes in memory, noting each read; reads from 'fail_at' on raise. """
+    def __init__(self, data, fail_at=None):
+        self.data, self.fail_at = data, fail_at
+        self.reads = []
+
+    def open_channel(self):
+        return self
+
+    def open(self, path, mode):
+        return self
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            if self.fail_at is not None and offset >= self.fail_at:
+                raise IOError("connection lost")
+            self.reads.append(offset)
+            yield self.data[offset:offset + length]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestRangeTransfer(TestCase):
+    def test_resume_after_interruption(self) -> None:
+        data = os.urandom(10123)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "file.tmp")
+            with open(path, "wb") as fl:
+                fl.truncate(len(data))
+                source = Source(data, fail_at=5000)
+                with self.assertRaises(IOError):
+                    transfer.RangeTransfer(source.open_channel, channels=3, part_size=1000, read_size=250) \
+                        .fetch("file", fl, len(data), 1234)
+
+            # Every part before the failure made it, and is journalled; the file is kept to resume.
+            done = transfer.load_journal(transfer.journal_path(path), len(data), 1234, 1000)
+            self.assertEqual({offset for offset in done if offset < 5000}, set(range(0, 5000, 1000)))
+            self.assertNotIn(5000, done)
+
+            progress = []
+            with open(path, "r+b") as fl:
+                source = Source(data)
+                size = transfer.RangeTransfer(source.open_channel, channels=3, part_size=1000, read_size=250) \
+                    .fetch("file", fl, len(data), 1234, lambda dl, ttl: progress.append(dl))
+            self.assertEqual(size, len(data))
+            # Only what was missing is fetched again.
+            self.assertEqual({offset // 1000 * 1000 for offset in source.reads},
+                             set(range(0, len(data), 1000)) - done)
+            self.assertEqual(progress[-1], len(data))
+            with open(path, "rb") as fh:
+                self.assertEqual(fh.read(), data)
+            self.assertFalse(os.path.exists(transfer.journal_path(path)))
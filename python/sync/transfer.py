@@ -0,0 +1,192 @@
+"""
+Parallel, pipelined ranged downloads for large files.
+
+A single SFTP getfo is a stream of round-trips on one channel. For large files
+we instead split the file into parts, have several threads -- each with its
+own SFTP channel -- pull parts from a shared queue, read each part with a
+pipelined readv, and pwrite the data straight into the preallocated temp file
+create_file gives us.
+
+Completed parts are recorded in a '<temp file>.parts' journal (after the data
+has been flushed), so an interrupted download can pick up where it left off
+when the temp file is reopened with create_file(..., resume=True). Plain
+sequential downloads can keep the same journal with a PartJournal, so they
+too can be resumed -- with ranged reads of whatever is missing.
+"""
+
+import logging
+import os
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Any, BinaryIO, Callable, Optional, Set
+
+
+""" Size of the ranges handed to each channel. """
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+""" Size of the individual pipelined reads within a part. """
+DEFAULT_READ_SIZE = 256 * 1024
+
+
+if hasattr(os, "pwrite"):
+    def pwrite(fd: int, data: bytes, offset: int, lock: Lock) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view, offset = view[written:], offset + written
+else:
+    def pwrite(fd: int, data: bytes, offset: int, lock: Lock) -> None:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+def journal_path(tmp_path: str) -> str:
+    return tmp_path + ".parts"
+
+
+def load_journal(path: str, size: int, mtime: int, part_size: int) -> Set[int]:
+    """ Offsets of parts already downloaded for this size/mtime of the remote file, in parts of part_size. """
+    try:
+        with open(path, "r") as fh:
+            header = fh.readline().split()
+            if header != [str(size), str(mtime), str(part_size)]:
+                return set()
+            return {int(line) for line in fh if line.strip()}
+    except (OSError, ValueError):
+        return set()
+
+
+class PartJournal(object):
+    """
+    Journals a sequential download into 'fl' the way RangeTransfer does its
+    parts, for RangeTransfer to resume from: call update() with the bytes
+    received so far, and close() when done.
+    """
+
+    def __init__(self, fl: BinaryIO, size: int, mtime: int, part_size: int = DEFAULT_PART_SIZE):
+        self.fl        = fl
+        self.size      = size
+        self.part_size = part_size
+        self.path      = journal_path(fl.name)
+        self._next     = 0
+        self._fh       = open(self.path, "w")
+        self._fh.write("%d %d %d\n" % (size, mtime, part_size))
+        self._fh.flush()
+
+
+    def update(self, received: int) -> None:
+        if self._next >= self.size or received < min(self._next + self.part_size, self.size):
+            return
+        # The data has to be on disk before the journal says it is.
+        self.fl.flush()
+        os.fsync(self.fl.fileno())
+        while self._next < self.size and received >= min(self._next + self.part_size, self.size):
+            self._fh.write("%d\n" % self._next)
+            self._next += self.part_size
+        self._fh.flush()
+
+
+    def close(self, complete: bool) -> None:
+        """ Close the journal; it's removed if the download is complete, and kept to resume from if not. """
+        self._fh.close()
+        if complete:
+            os.unlink(self.path)
+
+
+class RangeTransfer(object):
+    """
+    :param open_channel: Returns a new paramiko SFTPClient (caller's cwd semantics),
+    :param channels:     Number of concurrent channels/threads,
+    :param part_size:    Size of each range,
+    :param read_size:    Size of each pipelined read request within a range,
+    :param throttle:     Optional callable(nbytes), e.g. RateLimiter.consume,
+    """
+
+    def __init__(self, open_channel: Callable[[], Any], channels: int = 4,
+                 part_size: int = DEFAULT_PART_SIZE, read_size: int = DEFAULT_READ_SIZE,
+                 throttle: Callable[[int], None] = None, logger=logging):
+        self.open_channel = open_channel
+        self.channels     = max(1, channels)
+        self.part_size    = part_size
+        self.read_size    = read_size
+        self.throttle     = throttle
+        self.logger       = logger
+
+
+    def fetch(self, remote_path: str, fl: BinaryIO, size: int, mtime: int,
+              progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """
+        Download remote_path into the open, already sized, file 'fl'.
+
+        :return: size
+        """
+        journal   = journal_path(fl.name)
+        done      = load_journal(journal, size, mtime, self.part_size)
+        parts     = Queue()
+        for offset in range(0, size, self.part_size):
+            if offset not in done:
+                parts.put((offset, min(self.part_size, size - offset)))
+
+        received  = [sum(min(self.part_size, size - o) for o in done if o < size)]
+        if done:
+            self.logger.info("%s: resuming, %d of %d bytes already present", remote_path, received[0], size)
+
+        fl.flush()
+        fd        = fl.fileno()
+        lock      = Lock()
+        errors    = []
+
+        # (Re)write the journal header; parts are appended as they complete.
+        jfh = open(journal, "a" if done else "w")
+        if not done:
+            jfh.write("%d %d %d\n" % (size, mtime, self.part_size))
+            jfh.flush()
+
+        def worker():
+            sftp = None
+            try:
+                sftp = self.open_channel()
+                with sftp.open(remote_path, "rb") as rfh:
+                    while not errors:
+                        try:
+                            offset, length = parts.get_nowait()
+                        except Empty:
+                            return
+                        reads = [(pos, min(self.read_size, offset + length - pos))
+                                 for pos in range(offset, offset + length, self.read_size)]
+                        for (pos, want), data in zip(reads, rfh.readv(reads)):
+                            if len(data) != want:
+                                raise IOError("%s: short read at %d" % (remote_path, pos))
+                            pwrite(fd, data, pos, lock)
+                            if self.throttle:
+                                self.throttle(len(data))
+                            with lock:
+                                received[0] += len(data)
+                                if progress:
+                                    progress(received[0], size)
+                        os.fsync(fd)
+                        with lock:
+                            jfh.write("%d\n" % offset)
+                            jfh.flush()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if sftp:
+                    sftp.close()
+
+        try:
+            threads = [Thread(target=worker, name="range-%d" % n)
+                       for n in range(min(self.channels, parts.qsize()))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            jfh.close()
+
+        if errors:
+            raise errors[0]
+
+        os.unlink(journal)
+        return size
@@ -1,32 +1,62 @@
 #! /usr/bin/env python3
 
 import argparse
+import asyncio
+import collections
+from   concurrent.futures import ThreadPoolExecutor
 from   dataclasses import dataclass
-import hashlib
-import mmap
+import itertools
 import os
 from   paramiko import SFTPAttributes
 import posixpath
 import re
+import shlex
 import shutil
 from   stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISLNK, S_ISREG
 import sys
 import threading
 import time
-from   typing import Any, Callable, Dict, List, Tuple, Union
+from   typing import Any, BinaryIO, Callable, Dict, List, Set, Tuple, Union
 
+from   sync.aiotransport import AsyncSFTP, bounded_map
+from   sync.delta       import DeltaError, delta_fetch
+from   sync.manifest    import ManifestError, remote_manifest
+from   sync.ratelimit   import RateLimiter
+from   sync.transfer    import PartJournal, RangeTransfer, journal_path, load_journal
 from   sync.sftpsession import SSHSession, SFTPSession
-from   sync.worker      import Worker
+from   sync.state       import Entry, SyncState
+from   sync.tarstream   import ArchiveError, available_compressions, fetch_archive
 
 from   lib import loggingex
+from   lib.hashing import hash_file
+from   lib.metrics import Recorder
+from   lib.pipeline import Pipeline, Stage
 import logging
 
 logger = logging.getLogger("sync")
 
+# Latencies of remote operations and bytes per channel, for the end-of-run summary and --trace.
+# main() starts a new one for each run, so its times and rates are of that run alone.
+recorder = Recorder()
+
 DEFAULT_LOG_LEVEL = logging.WARNING
 
 TRASH_FOLDER = ".SyncTrash"
 
+# Most files we'll ask one remote md5sum about.
+SUM_BATCH_FILES = 4096
+
+# Most small files handed to the --async-channels event loop at once.
+ASYNC_BATCH_FILES = 256
+
+# How often idle sessions are pinged to keep them alive (seconds).
+KEEPALIVE = 30.0
+
+STATE_FILE   = ".SyncState.db"
+
+# Suffix of files being uploaded (two-way mode), renamed into place when complete.
+UPLOAD_SUFFIX = ".SyncUpload"
+
 
 @dataclass
 class DownloadItem:
@@ -71,8 +101,11 @@ class ArgParseWithYamlFromFile(argparse.ArgumentParser):
         return (l,) if not r else (l, r)
 
 
-def initialize_trash(config: argparse.Namespace):
-    # Delete any existing trash bin and then create a new one.
+def initialize_trash(config: argparse.Namespace, resuming: bool = False):
+    # Delete any existing trash bin, unless it's from the interrupted run we're picking up.
+    if resuming:
+        logger.info("Resuming an interrupted run; keeping %s", config.trash_path)
+        return
     if os.path.exists(config.trash_path):
         logger.info("Removing previous %s", config.trash_path)
         dry_check(config.dry_run, shutil.rmtree, (config.trash_path,))
@@ -91,6 +124,78 @@ def parse_arguments(arglist):
                     help="Don't compare mtimes for determining file changes")
     parser.add_argument("--dry-run", "-n", "-WhatIf", dest="dry_run", action="store_true",
                     help="Enable dry-run mode")
+    parser.add_argument("--delta", action="store_true",
+                    help="Only fetch the changed blocks of files we already have a copy of")
+    parser.add_argument("--delta-min-size", dest="delta_min_size", type=int, default=1024 * 1024,
+                    help="Smallest file to consider for --delta")
+    parser.add_argument("--delta-block-size", dest="delta_block_size", type=int, default=64 * 1024,
+                    help="Block size for --delta signatures")
+    parser.add_argument("--remote-python", dest="remote_python", default="python3",
+                    help="Python interpreter on the remote host, for the helper scripts")
+    parser.add_argument("--remote-manifest", dest="remote_manifest", action="store_true",
+                    help="List the whole remote tree with one command (needs --remote-python there) "
+                         "rather than a directory at a time over SFTP")
+    parser.add_argument("--list-sessions", dest="list_sessions", type=int, default=4,
+                    help="Number of SFTP channels listing directories concurrently")
+    parser.add_argument("--list-depth", dest="list_depth", type=int, default=16,
+                    help="Maximum number of directories being listed at once")
+    parser.add_argument("--checksum-batch-size", dest="sum_batch_bytes", type=int, default=256 * 1024 * 1024,
+                    help="Gather files needing a checksum comparison into batches of about this many bytes")
+    parser.add_argument("--checksum-threads", dest="sum_threads", type=int, default=4,
+                    help="Number of threads hashing local files while the remote checksums run")
+    parser.add_argument("--dl-channels", dest="dl_channels", type=int, default=4,
+                    help="Number of concurrent downloads (SFTP channels)")
+    parser.add_argument("--dl-transports", dest="dl_transports", type=int, default=1,
+                    help="Number of SSH connections to spread the download channels over")
+    parser.add_argument("--large-file-size", dest="large_file_size", type=int, default=64 * 1024 * 1024,
+                    help="Files of at least this many bytes are scheduled as large files")
+    parser.add_argument("--large-slots", dest="large_slots", type=int, default=None,
+                    help="How many download channels may work on large files (default: a quarter)")
+    parser.add_argument("--range-min-size", dest="range_min_size", type=int, default=256 * 1024 * 1024,
+                    help="Download files of at least this many bytes as parallel ranges")
+    parser.add_argument("--range-channels", dest="range_channels", type=int, default=4,
+                    help="Number of SFTP channels per ranged download")
+    parser.add_argument("--range-part-size", dest="range_part_size", type=int, default=16 * 1024 * 1024,
+                    help="Size of each range of a ranged download")
+    parser.add_argument("--archive", choices=available_compressions(), default=None,
+                    help="Fetch batches of small files as a tar stream with this compression, rather than over SFTP")
+    parser.add_argument("--archive-max-file-size", dest="archive_max_file_size", type=int, default=1024 * 1024,
+                    help="Largest file to fetch as part of an archive")
+    parser.add_argument("--archive-min-files", dest="archive_min_files", type=int, default=16,
+                    help="Batches with fewer files than this are fetched over SFTP instead")
+    parser.add_argument("--archive-max-files", dest="archive_max_files", type=int, default=2000,
+                    help="Most files in one archive")
+    parser.add_argument("--archive-max-bytes", dest="archive_max_bytes", type=int, default=64 * 1024 * 1024,
+                    help="Most (uncompressed) bytes in one archive")
+    parser.add_argument("--archive-streams", dest="archive_streams", type=int, default=2,
+                    help="Number of archives being fetched at once")
+    parser.add_argument("--async-channels", dest="async_channels", type=int, default=0,
+                    help="Fetch small files over this many SFTP channels, driven by one thread's event loop, "
+                         "rather than by the download threads")
+    parser.add_argument("--async-max-file-size", dest="async_max_file_size", type=int, default=1024 * 1024,
+                    help="Largest file to fetch over the --async-channels")
+    parser.add_argument("--bwlimit", type=int, default=None,
+                    help="Limit total download bandwidth to this many KB/s")
+    parser.add_argument("--two-way", dest="two_way", action="store_true",
+                    help="Copy local changes to the remote as well, flagging paths changed on both sides")
+    parser.add_argument("--ul-channels", dest="ul_channels", type=int, default=2,
+                    help="Number of concurrent uploads in --two-way mode")
+    parser.add_argument("--no-state", dest="use_state", default=True, action="store_false",
+                    help="Don't use (or update) the local state database, which checkpoints runs and "
+                         "is needed by --two-way and --skip-unchanged-dirs")
+    parser.add_argument("--skip-unchanged-dirs", dest="skip_unchanged", action="store_true",
+                    help="Don't list directories whose mtime hasn't changed on either side since the last sync. "
+                         "Much faster for large trees, but a file modified in place leaves its directory's mtime "
+                         "alone, so such changes go unnoticed until the next full listing")
+    parser.add_argument("--full-listing-hours", dest="full_listing_hours", type=float, default=24.0,
+                    help="With --skip-unchanged-dirs, list every directory anyway once the last full listing "
+                         "is this many hours old")
+    parser.add_argument("--rebuild-state", dest="rebuild_state", action="store_true",
+                    help="Discard the local state database and do a full sync")
+    parser.add_argument("--stats", action="store_true",
+                    help="Print per-stage throughput, operation latencies and bytes per channel at the end")
+    parser.add_argument("--trace", default=None,
+                    help="Write a Chrome trace-event JSON file of the run (chrome://tracing, ui.perfetto.dev)")
     parser.add_argument("--verbose", "-v", action="count", default=0,
                     help="Enable additional logging output")
     parser.add_argument("host",
@@ -108,10 +213,16 @@ def parse_arguments(arglist):
     if not os.access(config.local, os.W_OK):
         raise ValueError("Local path is not writable: %s" % config.local)
 
-    config.exclude    = re.compile('|'.join(config.exclude + [TRASH_FOLDER]))
+    if config.two_way and not config.use_state:
+        raise ValueError("--two-way needs the state database to tell which side changed")
+    if config.skip_unchanged and not config.use_state:
+        raise ValueError("--skip-unchanged-dirs needs the state database to tell which directories changed")
+
+    config.exclude    = re.compile('|'.join(config.exclude + [TRASH_FOLDER, STATE_FILE, r'.*\.SyncUpload$']))
 
     config.trash_path = os.path.normpath(os.path.join(config.local, TRASH_FOLDER))
-    initialize_trash(config)
+    config.state_path = os.path.normpath(os.path.join(config.local, STATE_FILE))
+    config.run_stamp  = time.strftime("%Y%m%d-%H%M%S")
 
     # Check we can connect to the remote host:
 #    try:
@@ -137,7 +248,7 @@ def create_dir(config, rel_path, name, mtime):
     logger.info("Created: %s", full_path)
 
 
-def create_file(local_path: str, name: str, size: int, mtime: int, callback=None, dry_run: bool=False):
+def create_file(local_path: str, name: str, size: int, mtime: int, callback=None, dry_run: bool=False, resume: bool=False):
     """
     Create a file with a given initial size and optionally call a callback with the file object of
     the file while it is open during creation (e.g. so you can write to it).
@@ -147,6 +258,7 @@ def create_file(local_path: str, name: str, size: int, mtime: int, callback=None
     :param size int: Size of the file in bytes
     :param mtime int: Specifies a modified time to give the file
     :param callback: Callable that takes a file handle and returns the resulting size of the file
+    :param resume bool: Keep the content of an existing .tmp file (e.g. a partial ranged download)
     :return: Size of the file created (incase callback changed it)
     """
     if not os.path.exists(local_path):
@@ -160,7 +272,8 @@ def create_file(local_path: str, name: str, size: int, mtime: int, callback=None
             size = callback(sys.stderr)
     else:
         tmp_path  = full_path + ".tmp"
-        with open(tmp_path, "wb") as fl:
+        mode      = "r+b" if resume and os.path.isfile(tmp_path) else "wb"
+        with open(tmp_path, mode) as fl:
             fl.truncate(size)
             if callback:
                 size = callback(fl)
@@ -169,6 +282,12 @@ def create_file(local_path: str, name: str, size: int, mtime: int, callback=None
         except:
             pass
         os.rename(tmp_path, full_path)
+        # However the file arrived -- delta, archive, a fresh download -- the journal
+        # of an earlier, interrupted, download of it is now stale.
+        try:
+            os.unlink(journal_path(tmp_path))
+        except FileNotFoundError:
+            pass
 
     dry_check(dry_run, os.utime, (full_path, (mtime, mtime)))
 
@@ -187,13 +306,16 @@ def move_to_trash(config: argparse.Namespace, rel_path: str, deleted_items, dry_
         return
 
     trash_path = os.path.normpath(os.path.join(config.trash_path, rel_path))
-    dry_check(dry_run, os.makedirs, (trash_path,))
+    # The trash is kept when resuming a run, so it may already have this folder, and these names.
+    dry_check(dry_run, os.makedirs, (trash_path,), {'exist_ok': True})
 
     local_path = os.path.normpath(os.path.join(config.local, rel_path))
 
     for item in deleted_items:
         src = os.path.join(local_path, item)
         dst = os.path.join(trash_path, item)
+        if os.path.lexists(dst):
+            dst += "." + config.run_stamp
         assert src != dst
         dry_check(dry_run, os.renames, (src, dst))
         logger.spam("Moved %s to %s", src, TRASH_FOLDER)
@@ -201,6 +323,34 @@ def move_to_trash(config: argparse.Namespace, rel_path: str, deleted_items, dry_
     logger.info("%d items moved to %s.", len(deleted_items), trash_path)
 
 
+def remote_makedirs(sftp: SFTPSession, rel_path: str) -> None:
+    path = ''
+    for part in rel_path.split('/'):
+        path = posixpath.join(path, part)
+        try:
+            sftp.client.stat(path)
+        except FileNotFoundError:
+            sftp.client.mkdir(path)
+
+
+def create_remote_dir(sftp: SFTPSession, rel_path: str, name: str, mtime: int) -> None:
+    path = posixpath.join(rel_path, name)
+    sftp.client.mkdir(path)
+    sftp.client.utime(path, (mtime, mtime))
+    logger.info("Created remote: %s", path)
+
+
+def move_to_remote_trash(config: argparse.Namespace, sftp: SFTPSession, rel_path: str, deleted_items, dry_run=False):
+    """
+    Move items on the remote into its own sync trash bin (one folder per run), a safe delete.
+    """
+    trash_path = posixpath.join(TRASH_FOLDER, config.run_stamp, rel_path).rstrip('/')
+    dry_check(dry_run, remote_makedirs, (sftp, trash_path))
+    for item in deleted_items:
+        dry_check(dry_run, sftp.client.posix_rename, (posixpath.join(rel_path, item), posixpath.join(trash_path, item)))
+    logger.info("%d remote items moved to %s.", len(deleted_items), trash_path)
+
+
 def touch(root, rel_path, mtime=None):
     """ Update the modified time of a file """
     mtime = (mtime, mtime) if mtime else None
@@ -209,26 +359,35 @@ def touch(root, rel_path, mtime=None):
 
 def get_remote_files(sftp: SFTPSession, rel_path: str):
     logger.debug("remote: %s", rel_path)
-    return {
-        str(attrs.filename): attrs
-        for attrs in sftp.client.listdir_iter(rel_path)
-        if not is_symlink(attrs)
-    }
+    with recorder.timed("listdir", path=rel_path):
+        return {
+            str(attrs.filename): attrs
+            for attrs in sftp.client.listdir_iter(rel_path)
+            if not is_symlink(attrs)
+        }
+
+
+def local_attrs(st: os.stat_result, name: str) -> SFTPAttributes:
+    """ A local entry's attributes as SFTP would give them for the remote's: times in whole seconds. """
+    attrs = SFTPAttributes.from_stat(st, name)
+    attrs.st_mtime, attrs.st_atime = int(st.st_mtime), int(st.st_atime)
+    return attrs
 
 
 def get_local_files(root: str, rel_path: str,
                     normalize=os.path.normpath, joinpath=os.path.join):
     local_path = normalize(joinpath(root, rel_path))
     logger.debug("local: %s", local_path)
-    try:
-        generator = os.scandir(local_path)
-    except FileNotFoundError:
-        return {}
-    return {
-        ent.name: SFTPAttributes.from_stat(ent.stat(follow_symlinks=False), ent.name)
-        for ent in generator
-        if not ent.is_symlink()
-    }
+    with recorder.timed("local-listdir", path=rel_path):
+        try:
+            generator = os.scandir(local_path)
+        except FileNotFoundError:
+            return {}
+        return {
+            ent.name: local_attrs(ent.stat(follow_symlinks=False), ent.name)
+            for ent in generator
+            if not ent.is_symlink()
+        }
 
 
 def filtered(rel_path, stats, exclude_re):
@@ -240,30 +399,195 @@ def filtered(rel_path, stats, exclude_re):
     }
 
 
-def get_path_deltas(rel_path, config, sftp, sum_worker, dl_worker):
-
+def list_path(rel_path, config, sftp):
+    """ Fetch the (filtered) remote and local listings for a directory. """
     remote_stats = filtered(rel_path, get_remote_files(sftp, rel_path), config.exclude)
     logger.spam("%s: remote_stats: %s", rel_path, remote_stats)
 
-    children     = list(posixpath.join(rel_path, n) for n, st in remote_stats.items() if is_dir(st))
-
     local_stats  = filtered(rel_path, get_local_files(config.local, rel_path), config.exclude)
     logger.spam("%s: local_stats: %s", rel_path, local_stats)
 
-    remote_set   = set(remote_stats.keys())
-    local_set    = set(local_stats.keys())
-    logger.spam("%s: remotes: %s, locals: %s", rel_path, remote_set, local_set)
+    return remote_stats, local_stats
+
 
-    added        = remote_set - local_set
-    removed      = local_set  - remote_set
-    persisted    = remote_set - (added | removed)
+def list_work(config: argparse.Namespace, sftp: SFTPSession, data: Tuple[str, int, Entry], emit: Callable) -> None:
+    """
+    List a directory on both sides and pass (rel_path, remote_mtime, (remote_stats, local_stats)) on.
 
-    logger.spam("%s: added: %s, removed: %s, persisted: %s", rel_path, added, removed, persisted)
+    'data' is (rel_path, remote mtime or None to look it up, state from the last sync or None). If
+    neither side's mtime has changed since the last sync the listing is skipped and what is passed
+    on is (rel_path, remote_mtime, None).
+    """
+    rel_path, remote_mtime, known = data
+    if remote_mtime is None:
+        with recorder.timed("stat", path=rel_path):
+            remote_mtime = sftp.client.stat(rel_path or '.').st_mtime
+    if known is not None and known.r_mtime == remote_mtime and known.l_mtime == local_mtime(config, rel_path):
+        logger.debug("%s: unchanged since last sync", rel_path)
+        emit((rel_path, remote_mtime, None))
+        return
+    emit((rel_path, remote_mtime, list_path(rel_path, config, sftp)))
 
-    need_sum     = []
 
-    for name in persisted:
-        lhs, rhs = remote_stats[name], local_stats[name]
+def manifest_work(config: argparse.Namespace, ssh: SSHSession, root: str, emit: Callable) -> None:
+    """
+    List the whole remote tree with a single remote_manifest() and pass each
+    directory on as (rel_path, remote_mtime, (remote_stats, None)): the local
+    side is listed by reconcile, once the directory's parent has been dealt with.
+
+    If the remote can't produce a manifest at all (e.g. no Python there) we fall
+    back to listing over SFTP.
+    """
+    emitted = False
+    try:
+        for listing in remote_manifest(ssh, posixpath.join(config.remote, root), config.remote_python, logger=logger):
+            if listing.entries is None:
+                logger.warning("%s: remote directory couldn't be listed", listing.path)
+                continue
+            rel_path = posixpath.join(root, listing.path).rstrip('/')
+            remote_stats = filtered(rel_path, listing.entries, config.exclude)
+            logger.spam("%s: remote_stats: %s", rel_path, remote_stats)
+            emit((rel_path, listing.stat.st_mtime, (remote_stats, None)))
+            emitted = True
+    except ManifestError as e:
+        if emitted:
+            raise
+        logger.warning("No remote manifest (%s); listing over SFTP instead", e)
+        config.remote_manifest = False
+        emit((root, None, None), to="list")
+
+
+def local_mtime(config: argparse.Namespace, rel_path: str) -> Union[int, None]:
+    try:
+        return os.stat(os.path.normpath(os.path.join(config.local, rel_path))).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def record_state(config: argparse.Namespace, state: SyncState, rel_path: str, remote_mtime: int,
+                 remote: Dict[str, Tuple[bool, int, int, Union[int, None], Union[int, None]]],
+                 run: str = None) -> bool:
+    """
+    Record a directory we've finished with in the state database, stamped with
+    'run', provided the local side now actually matches the remote listing -- a
+    failed download or checksum leaves it unrecorded, so it is listed again next time.
+    """
+    local_path = os.path.normpath(os.path.join(config.local, rel_path))
+    try:
+        with os.scandir(local_path) as it:
+            local = {ent.name: ent.stat(follow_symlinks=False) for ent in it
+                     if not ent.is_symlink() and not config.exclude.match(posixpath.join(rel_path, ent.name))}
+        # Downloads will have bumped the mtime; give it the remote's, as get_path_deltas
+        # would without the state database.
+        if rel_path:
+            touch(config.local, rel_path, remote_mtime)
+        dir_mtime = os.stat(local_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+    if local.keys() != remote.keys():
+        return False
+
+    entries = []
+    for name, (remote_dir, size, mtime, ino, ctime) in remote.items():
+        st = local[name]
+        if remote_dir != S_ISDIR(st.st_mode):
+            return False
+        path = posixpath.join(rel_path, name)
+        if remote_dir:
+            entries.append(Entry(path, True))
+        elif st.st_size != size or int(st.st_mtime) != mtime:
+            return False
+        else:
+            entries.append(Entry(path, False, size, mtime, st.st_size, st.st_mtime_ns, ino, ctime))
+
+    state.record_dir(rel_path, remote_mtime, dir_mtime, entries, run)
+    return True
+
+
+def remote_snapshot(attrs) -> Tuple[bool, int, int, Union[int, None], Union[int, None]]:
+    """ What record_state keeps of a remote entry: (is_dir, size, mtime, inode, ctime), the last two from a manifest. """
+    return (is_dir(attrs), attrs.st_size, attrs.st_mtime,
+            getattr(attrs, "st_ino", None), getattr(attrs, "st_ctime_ns", None))
+
+
+def remote_changed(attrs, base: Union[Entry, None]) -> Union[bool, None]:
+    """
+    Whether a remote file has changed since we last synced it, going by the
+    inode and ctime a manifest gives us -- a rewrite gets a new ctime even if
+    its mtime is put back. None if we can't tell.
+    """
+    ino = getattr(attrs, "st_ino", None)
+    if ino is None or base is None or base.is_dir or base.r_ino is None:
+        return None
+    return (ino, attrs.st_ctime_ns, attrs.st_size, attrs.st_mtime) != (base.r_ino, base.r_ctime, base.r_size, base.r_mtime)
+
+
+def partial_downloads(remote_stats, local_names):
+    """ Local leftovers of interrupted downloads (temp file, ranged-download journal) worth keeping. """
+    partials = set()
+    for name, attrs in remote_stats.items():
+        if is_file(attrs):
+            for leftover in (name + ".tmp", journal_path(name + ".tmp")):
+                if leftover in local_names and leftover not in remote_stats:
+                    partials.add(leftover)
+    return partials
+
+
+def merge_listings(remote_stats: Dict[str, Any], local_stats: Dict[str, Any]):
+    """
+    Walk both listings together in name order, yielding (name, remote_attrs, local_attrs)
+    with None for the side that doesn't have the name.
+    """
+    remote_names, local_names = sorted(remote_stats), sorted(local_stats)
+    r, l = 0, 0
+    while r < len(remote_names) or l < len(local_names):
+        r_name = remote_names[r] if r < len(remote_names) else None
+        l_name = local_names[l] if l < len(local_names) else None
+        if l_name is None or (r_name is not None and r_name < l_name):
+            yield r_name, remote_stats[r_name], None
+            r += 1
+        elif r_name is None or l_name < r_name:
+            yield l_name, None, local_stats[l_name]
+            l += 1
+        else:
+            yield r_name, remote_stats[r_name], local_stats[l_name]
+            r, l = r + 1, l + 1
+
+
+def get_path_deltas(rel_path, config, remote_stats, local_stats, emit, base: Dict[str, Entry] = None,
+                    mismatches: Dict[str, Tuple[int, int, int, int]] = None):
+    """
+    Work out what has to change locally: downloads are emit()ed and files
+    that need a checksum comparison are sent to the checksum stage.
+
+    'base' is the directory's entries from the state database, if it has them.
+    With a manifest's inodes and ctimes they settle most files without a
+    checksum (see remote_changed). 'mismatches' are files an earlier, interrupted,
+    run already found to differ (SyncState.mismatches): unless either side has
+    changed since, they're downloaded without another checksum.
+
+    :return: (added {name: remote_stat}, removed {name}, child directories)
+    """
+
+    keep         = partial_downloads(remote_stats, local_stats)
+    added        = {}
+    removed      = set()
+    children     = []
+
+    for name, lhs, rhs in merge_listings(remote_stats, local_stats):
+        if lhs is None:
+            if name not in keep:
+                removed.add(name)
+            continue
+
+        if is_dir(lhs):
+            children.append(posixpath.join(rel_path, name))
+
+        if rhs is None:
+            added[name] = lhs
+            continue
+
         lhs_file, rhs_file = is_file(lhs), is_file(rhs)
 
         # If the entity type changes, e.g File->Dir, we need to delete the
@@ -271,73 +595,191 @@ def get_path_deltas(rel_path, config, sftp, sum_worker, dl_worker):
         # lists.
         if lhs_file != rhs_file:
             removed.add(name)
-            added.add(name)
+            added[name] = lhs
             continue
 
         # If size changes, ignore on directories but force download files.
         if lhs_file and lhs.st_size != rhs.st_size:
-            dl_worker.put(DownloadItem(rel_path, name, lhs.st_size, lhs.st_mtime))
+            emit(DownloadItem(rel_path, name, lhs.st_size, lhs.st_mtime))
             continue
 
+        changed = remote_changed(lhs, base.get(name)) if lhs_file and base else None
+
         # If the mtime changes, for a file, check the MD5 sum, for a dir,
-        # just touch the mtime on that folder.
+        # just touch the mtime on that folder. With the state database that
+        # waits until the folder itself is reconciled (record_state), or we'd
+        # hide local changes in it.
         if lhs.st_mtime != rhs.st_mtime:
-            if lhs_file:
-                need_sum.append(lhs)
-            else:
+            known_diff = mismatches and mismatches.get(name) == (lhs.st_size, lhs.st_mtime, rhs.st_size, rhs.st_mtime)
+            if changed or known_diff:
+                # Rewritten on the remote since we synced it, or already checksummed; a
+                # checksum would only confirm that.
+                emit(DownloadItem(rel_path, name, lhs.st_size, lhs.st_mtime))
+            elif lhs_file:
+                emit(DownloadItem(rel_path, name, lhs.st_size, lhs.st_mtime), to="checksum")
+            elif not config.use_state:
                 dry_check(config.dry_run, touch, (config.local, os.path.join(rel_path, name), lhs.st_mtime))
 
-    if need_sum:
-        sum_worker.put((rel_path, need_sum))
+        # Same size and mtime, but rewritten on the remote with its mtime put back.
+        elif changed:
+            emit(DownloadItem(rel_path, name, lhs.st_size, lhs.st_mtime), to="checksum")
 
-    return {k: remote_stats[k] for k in added}, removed, children
+    logger.spam("%s: added: %s, removed: %s", rel_path, added, removed)
 
+    return added, removed, children
 
-def sum_work(config: argparse.Namespace, client: SSHSession, data: Tuple[str, List[SFTPAttributes]], nextq: Worker) -> None:
-    # data is a tuple(relative path, list(FileEntity))
-    rel_path, need_sum = data
-    info = { str(e.filename): (e.st_size, e.st_mtime) for e in need_sum }
 
-    # Issue a remote md5sum command for just the files
-    filenames = "\0".join(e.filename for e in need_sum) + "\0"
-    cmd = "cd '%s' && xargs -0 md5sum --binary" % (posixpath.join(config.remote, rel_path))
+def entry_key(attrs) -> Union[Tuple, None]:
+    """ What we compare to tell whether a path changed: its type, and a file's size and mtime (in seconds). """
+    if attrs is None:
+        return None
+    return ('d',) if is_dir(attrs) else ('f', attrs.st_size, int(attrs.st_mtime))
 
-    logger.info("Fetching %d remote checksums", len(filenames))
-    logger.debug(cmd)
 
-    rc, stdout = client.execute(cmd, read_stdout=True, inputs=filenames)
-    if rc is not 0:
-        raise RuntimeError("md5sum failed: %d" % rc)
+def base_keys(base: Union[Entry, None]) -> Tuple[Union[Tuple, None], Union[Tuple, None]]:
+    """ The remote and local entry_keys a path had when we last synced it. """
+    if base is None:
+        return None, None
+    if base.is_dir:
+        return ('d',), ('d',)
+    return ('f', base.r_size, base.r_mtime), ('f', base.l_size, base.l_mtime // 1000000000)
 
-    hashes = {}
-    for line in stdout.decode().split("\n"):
-        if not line: continue
-        checksum, _, filename = line.partition(" *")
-        hashes[filename] = checksum.lower()
 
-    for filename, remote_hash in hashes.items():
-        filepath = posixpath.join(rel_path, filename)
+@dataclass
+class TwoWayPlan:
+    download:      List[DownloadItem]
+    upload:        List[DownloadItem]
+    local_dirs:    Dict[str, int]           # name: mtime, to create locally
+    remote_dirs:   Dict[str, int]           # name: mtime, to create on the remote
+    local_trash:   Set[str]
+    remote_trash:  Set[str]
+    children:      List[str]
+    conflicts:     List[str]
+
+
+def get_two_way_deltas(rel_path: str, remote_stats, local_stats, base: Dict[str, Entry]) -> TwoWayPlan:
+    """
+    Compare both sides with what they were when last synced ('base', from the
+    state database) in a single merge pass over the listings:
 
-        fullpath = os.path.normpath(os.path.join(config.local, filepath))
-        with open(fullpath, "rb") as fh:
-            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
-            local_hash = hashlib.md5(mm).hexdigest().lower()
-            mm.close()
+      * a path only changed on one side has that change copied to the other,
+        whether it was created, modified, deleted or changed type;
+      * a path changed on both sides is left alone and flagged as a conflict,
+        unless both sides ended up the same.
 
-        if local_hash != remote_hash:
-            logger.info("%s: remote:%s, local:%s", filepath, remote_hash, local_hash)
-            nextq.put(DownloadItem(rel_path, filename, *info[filename]))
-        else:
-            mtime = info[filename][1]
-            logger.debug("Hash match for %s -> touching %d", filepath, mtime)
-            touch(config.local, filepath, mtime)
+    Anything with no base counts as created on whichever sides have it.
+    """
+    plan = TwoWayPlan([], [], {}, {}, set(), set(), [], [])
+    keep = partial_downloads(remote_stats, local_stats)
+
+    for name, remote, local in merge_listings(remote_stats, {k: v for k, v in local_stats.items() if k not in keep}):
+        path = posixpath.join(rel_path, name)
+        r_key, l_key = entry_key(remote), entry_key(local)
+        b_remote, b_local = base_keys(base.get(name))
+        r_changed, l_changed = r_key != b_remote, l_key != b_local
+
+        if r_changed and l_changed and r_key != l_key:
+            logger.warning("%s: changed on both sides (remote: %s, local: %s)", path, r_key, l_key)
+            plan.conflicts.append(path)
+            continue
+
+        if r_changed and not l_changed:
+            # Remote -> local.
+            if local is not None and (remote is None or is_dir(remote) != is_dir(local)):
+                plan.local_trash.add(name)
+            if remote is not None:
+                if is_dir(remote):
+                    if local is None or not is_dir(local):
+                        plan.local_dirs[name] = remote.st_mtime
+                else:
+                    plan.download.append(DownloadItem(rel_path, name, remote.st_size, remote.st_mtime))
+
+        elif l_changed and not r_changed:
+            # Local -> remote.
+            if remote is not None and (local is None or is_dir(remote) != is_dir(local)):
+                plan.remote_trash.add(name)
+            if local is not None:
+                if is_dir(local):
+                    if remote is None or not is_dir(remote):
+                        plan.remote_dirs[name] = local.st_mtime
+                else:
+                    plan.upload.append(DownloadItem(rel_path, name, local.st_size, local.st_mtime))
+
+        # Unchanged, converged, or just copied: directories get looked into.
+        if (remote is not None and is_dir(remote)) or (local is not None and is_dir(local)):
+            if name not in plan.local_trash or name in plan.local_dirs:
+                if name not in plan.remote_trash or name in plan.remote_dirs:
+                    plan.children.append(path)
+
+    return plan
+
+
+def sum_work(config: argparse.Namespace, client: SSHSession, batch: List[DownloadItem], emit: Callable,
+             state: SyncState = None) -> None:
+    """
+    Compare remote and local md5s for a batch of files, which may come from
+    several directories: files that differ are queued for download (and noted
+    in the state database, should we be interrupted before they are), files
+    that match just get the remote mtime.
+
+    The local copies are hashed in a thread pool while the remote md5sum runs.
+    """
+    files = {posixpath.join(item.path, item.name): item for item in batch}
+
+    # Issue a single remote md5sum command for all the files
+    cmd = "cd %s && xargs -0 md5sum --binary" % shlex.quote(config.remote)
+
+    logger.info("Fetching %d remote checksums (%.2fKb)", len(files), sum(item.size for item in batch) / 1024)
+    logger.debug(cmd)
+
+    stdout = client.start(cmd, inputs="\0".join(files) + "\0")
+
+    with ThreadPoolExecutor(max_workers=max(1, config.sum_threads), thread_name_prefix="checksum") as pool:
+        local_hashes = {
+            filepath: pool.submit(hash_file, os.path.normpath(os.path.join(config.local, filepath)))
+            for filepath in files
+        }
+
+        with recorder.timed("md5sum", files=len(files)):
+            output = stdout.read()
+            rc = stdout.channel.recv_exit_status()
+        if rc != 0:
+            # e.g. a file vanished; anything we didn't get a checksum for is downloaded.
+            logger.warning("md5sum exited with %d", rc)
+
+        hashes = {}
+        for line in output.decode().split("\n"):
+            if not line: continue
+            checksum, _, filepath = line.partition(" *")
+            hashes[filepath] = checksum.lower()
+
+        for filepath, item in files.items():
+            remote_hash = hashes.get(filepath)
+            try:
+                local_hash = local_hashes[filepath].result()
+            except OSError as e:
+                logger.warning("%s: %s", filepath, e)
+                local_hash = None
+
+            if remote_hash is None or local_hash != remote_hash:
+                logger.info("%s: remote:%s, local:%s", filepath, remote_hash, local_hash)
+                if state and remote_hash and local_hash and not config.dry_run:
+                    try:
+                        st = os.stat(os.path.join(config.local, filepath))
+                        state.record_mismatch(filepath, item.size, item.mtime, st.st_size, int(st.st_mtime))
+                    except OSError:
+                        pass
+                emit(item)
+            else:
+                logger.debug("Hash match for %s -> touching %d", filepath, item.mtime)
+                touch(config.local, filepath, item.mtime)
 
 
 def dl_progress(filename: str, bytes_dl: int, bytes_ttl: int) -> None:
-    logger.info("%s: {:9n}/{:9n}".format(filename, bytes_dl, bytes_ttl))
-    
+    logger.spam("%s: %9d/%9d", filename, bytes_dl, bytes_ttl)
 
-def dl_work(config: argparse.Namespace, sftp: SFTPSession, data: DownloadItem, nextq: Worker) -> None:
+
+def dl_work(config: argparse.Namespace, sftp: SFTPSession, data: DownloadItem, throttle: Callable[[int], None]) -> None:
     rel_path = posixpath.join(data.path, data.name)
     remote_path = posixpath.join(config.remote, rel_path)
     logger.info("Downloading %s (%.2fKb)", remote_path, data.size / 1024)
@@ -345,58 +787,545 @@ def dl_work(config: argparse.Namespace, sftp: SFTPSession, data: DownloadItem, n
         return
 
     local_path = os.path.join(config.local, data.path)
-    sized = create_file(local_path, data.name, data.size, data.mtime, callback=lambda fl:
-                            sftp.client.getfo(remote_path, fl,
-                                        lambda dl, ttl: dl_progress(rel_path, dl, ttl))
-    )
-    logger.debug("Downloaded %d bytes", sized)
 
+    existing = os.path.join(local_path, data.name)
+    if config.delta and data.size >= config.delta_min_size and os.path.isfile(existing):
+        try:
+            sized = create_file(local_path, data.name, data.size, data.mtime, callback=lambda fl:
+                                    delta_fetch(sftp.client, sftp.ssh, remote_path, existing, fl,
+                                                config.delta_block_size, config.remote_python, logger)
+            )
+            logger.debug("Delta-synced %d bytes", sized)
+            return
+        except DeltaError as e:
+            logger.info("%s: delta failed (%s), downloading in full", rel_path, e)
+
+    # A download an interrupted run had started -- ranged or not -- carries on from its journal.
+    tmp_path = os.path.normpath(existing) + ".tmp"
+    resuming = os.path.isfile(tmp_path) and load_journal(journal_path(tmp_path), data.size, data.mtime,
+                                                         config.range_part_size)
+
+    if data.size >= config.range_min_size or resuming:
+        # Large file: parallel ranged reads over extra channels on this worker's connection.
+        transfer = RangeTransfer(sftp.ssh.client.open_sftp, channels=config.range_channels,
+                                 part_size=config.range_part_size, throttle=throttle, logger=logger)
+        # New channels start in the login directory, like remote_path.
+        sized = create_file(local_path, data.name, data.size, data.mtime, resume=True, callback=lambda fl:
+                                transfer.fetch(remote_path, fl, data.size, data.mtime,
+                                               lambda dl, ttl: dl_progress(rel_path, dl, ttl))
+        )
+        logger.debug("Downloaded %d bytes in ranges", sized)
+        return
 
-def main(config: argparse.Namespace):
+    received = 0
+    journal = None
+    def fetch(fl: BinaryIO) -> int:
+        nonlocal journal
+        # Journal the parts as they arrive, so an interruption needn't mean starting again.
+        if data.size > config.range_part_size:
+            journal = PartJournal(fl, data.size, data.mtime, config.range_part_size)
+        complete = False
+        try:
+            size = sftp.client.getfo(remote_path, fl, progress)
+            complete = True
+            return size
+        finally:
+            if journal:
+                journal.close(complete)
+
+    def progress(dl: int, ttl: int) -> None:
+        nonlocal received
+        # Progress is cumulative; the bandwidth cap wants deltas.
+        throttle(dl - received)
+        received = dl
+        if journal:
+            journal.update(dl)
+        dl_progress(rel_path, dl, ttl)
+
+    sized = create_file(local_path, data.name, data.size, data.mtime, callback=fetch)
+    logger.debug("Downloaded %d bytes", sized)
 
-    # Create a worker for downloading individual files
-    dl_client   = SFTPSession(config.host, config.username, config.password, initial_path=config.remote, logger=logger)
-    dl_worker   = Worker(config, dl_work, dl_client, None, logger=logger)
-    dl_worker.start()
 
-    # For lists of changed files we need to perform checksums on
-    sum_client  = SSHSession(config.host, config.username, config.password, logger=logger)
-    sum_worker  = Worker(config, sum_work, sum_client, dl_worker, logger=logger)
-    sum_worker.start()
+def archive_work(config: argparse.Namespace, ssh: SSHSession, batch: List[DownloadItem], emit: Callable,
+                 throttle: Callable[[int], None]) -> None:
+    """
+    Fetch a batch of small files as one compressed tar stream; anything that
+    doesn't come through that way, or a batch too small to be worth it, goes
+    to the SFTP download stage instead.
+    """
+    if len(batch) < config.archive_min_files:
+        for item in batch:
+            emit(item, to="download")
+        return
 
-    # We'll need an sftp session to get directory listings.
-    sftp = SFTPSession(config.host, config.username, config.password, initial_path=config.remote, logger=logger)
+    items = {posixpath.join(item.path, item.name): item for item in batch}
+    logger.info("Fetching %d files (%.2fKb) as a %s archive", len(items), sum(item.size for item in batch) / 1024,
+                config.archive)
+    if config.dry_run:
+        return
 
-    # Paths that we need to inspect.
-    dir_queue  = ['']
+    written = set()
+    def write(item: DownloadItem, member, copy) -> None:
+        # The member's size and mtime are those of what we actually received.
+        create_file(os.path.join(config.local, item.path), item.name, member.size, int(member.mtime), callback=copy)
+        written.add(member.name)
 
     try:
-        while dir_queue:
-
-            rel_path = dir_queue.pop(0)
-            logging.info('~ %s', rel_path)
-            added, removed, children = get_path_deltas(rel_path, config, sftp, sum_worker, dl_worker)
-
-            # Remove anything that needs deleting first, so that if we have items that
-            # changed type (e.g a file became a folder), we delete it before trying to
-            # create anything. Also ensures we free up space where possible before adding
-            # to usage.
-            if removed:
-                move_to_trash(config, rel_path, removed, config.dry_run)
-
-            # Now add things.
-            for name, remote_stat in added.items():
-                if is_file(remote_stat):
-                    dl_worker.put(DownloadItem(rel_path, name, remote_stat.st_size, remote_stat.st_mtime))
-                else:
-                    dry_check(config.dry_run, create_dir, args=(config, rel_path, name, remote_stat.st_mtime))
+        missing = fetch_archive(ssh, config.remote, items, config.archive, write, items=items,
+                                throttle=throttle, logger=logger)
+    except ArchiveError as e:
+        logger.warning("Archive transfer failed (%s), using SFTP for the rest of the batch", e)
+        missing = [item for path, item in items.items() if path not in written]
+
+    for item in missing:
+        emit(item, to="download")
 
-            # If this gave us child directories, add them.
-            dir_queue.extend(children)
+
+def async_dl_work(config: argparse.Namespace, remote: AsyncSFTP, loop: asyncio.AbstractEventLoop,
+                  batch: List[DownloadItem], emit: Callable, throttle: Callable[[int], None]) -> None:
+    """
+    Fetch a batch of small files concurrently over the channels of an
+    AsyncSFTP, whose calls run on 'loop'; anything that fails goes to the SFTP
+    download stage to be tried again there.
+    """
+    logger.info("Fetching %d files (%.2fKb) over %d channels", len(batch), sum(item.size for item in batch) / 1024,
+                remote.channels)
+    if config.dry_run:
+        return
+
+    async def fetch(item: DownloadItem) -> bool:
+        rel_path = posixpath.join(item.path, item.name)
+        try:
+            data = await remote.read(posixpath.join(config.remote, rel_path))
+            throttle(len(data))
+            create_file(os.path.join(config.local, item.path), item.name, len(data), item.mtime, callback=lambda fl:
+                            fl.write(data))
+            return True
+        except Exception as e:
+            logger.info("%s: %s, downloading it over SFTP instead", rel_path, e)
+            return False
+
+    async def fetch_all() -> List[DownloadItem]:
+        # A couple of reads queued per channel, so none of them waits on us.
+        return [item async for item, fetched in bounded_map(fetch, batch, limit=remote.channels * 2) if not fetched]
+
+    for item in loop.run_until_complete(fetch_all()):
+        emit(item, to="download")
+
+
+def ul_work(config: argparse.Namespace, sftp: SFTPSession, data: DownloadItem, throttle: Callable[[int], None]) -> None:
+    """ Upload a local file under a temporary name, then rename it over the original and give it our mtime. """
+    rel_path = posixpath.join(data.path, data.name)
+    logger.info("Uploading %s (%.2fKb)", rel_path, data.size / 1024)
+    if config.dry_run:
+        return
+
+    sent = 0
+    def progress(done: int, total: int) -> None:
+        nonlocal sent
+        throttle(done - sent)
+        sent = done
+
+    tmp_path = rel_path + UPLOAD_SUFFIX
+    with open(os.path.join(config.local, data.path, data.name), "rb") as fl:
+        sftp.client.putfo(fl, tmp_path, file_size=data.size, callback=progress, confirm=True)
+    sftp.client.posix_rename(tmp_path, rel_path)
+    sftp.client.utime(rel_path, (data.mtime, data.mtime))
+    # SFTP only keeps whole seconds: give ours the same, so both sides match exactly.
+    touch(config.local, rel_path, data.mtime)
+    logger.debug("Uploaded %d bytes", sent)
+
+
+def route_download(config: argparse.Namespace, pipe: Pipeline, item: DownloadItem) -> str:
+    """
+    The stage to download an item: 'archive' or 'download-async' for a small
+    file, if they're enabled, otherwise 'download-large' or 'download'.
+    """
+    if config.archive and item.size <= config.archive_max_file_size:
+        return "archive"
+    if config.async_channels and item.size <= config.async_max_file_size:
+        return "download-async"
+    if item.size >= config.large_file_size:
+        return "download-large"
+    # Let a large-file channel help out when it has nothing to do -- not just nothing queued, as it
+    # may be busy with a huge file -- and there's no small-file channel free for this one.
+    if pipe.idle("download-large") > pipe.depth("download-large") and pipe.idle("download") <= pipe.depth("download"):
+        return "download-large"
+    return "download"
+
+
+def report_run(config: argparse.Namespace, pipe: Pipeline) -> None:
+    """
+    End-of-run summary -- per-stage throughput and queueing, operation
+    latencies and bytes per channel -- and the trace, if one was asked for.
+    """
+    directories = pipe.metrics()["reconcile"]
+    summary = "Pipeline:\n%s\n\nDirectories: %d (%.1f/s)\n\n%s" % (
+        pipe.report(), directories['processed'], directories['per_second'], recorder.summary())
+    if config.stats:
+        print(summary)
+    else:
+        logger.info(summary)
+    if config.trace:
+        recorder.write_trace(config.trace)
+        logger.info("Trace written to %s", config.trace)
+
+
+def main(config: argparse.Namespace):
+    global recorder
+    recorder = Recorder(trace=bool(config.trace))
+
+    # What we reconciled last time, so unchanged directories needn't be listed (--skip-unchanged-dirs),
+    # and the base two-way mode compares against. A dry run only reads it, if there is one.
+    state = None
+    if config.use_state and not (config.dry_run and not os.path.exists(config.state_path)):
+        state = SyncState(config.state_path, rebuild=config.rebuild_state and not config.dry_run)
+
+    # The state database doubles as the checkpoint of a run: if the last one didn't finish, this
+    # one picks up from what it recorded -- and keeps its trash. Until a run completes, directories
+    # are stamped with the stamp of the one that started it, however many times it's resumed.
+    run = state.get_meta("run") if state else None
+    resuming = run is not None
+    initialize_trash(config, resuming)
+    if not resuming:
+        run = config.run_stamp
+        if state and not config.dry_run:
+            state.set_meta("run", run)
+    completed = False
+
+    # Skipping directories by their mtimes misses files modified in place, so it's opt-in, and
+    # even then a run lists everything once the last one to do so is --full-listing-hours old.
+    started   = time.time()
+    skip_unchanged = False
+    if state and config.skip_unchanged and not config.two_way:
+        last_full = float(state.get_meta("listed") or 0)
+        skip_unchanged = started - last_full < config.full_listing_hours * 3600
+        if not skip_unchanged:
+            logger.info("Listing every directory; the last full listing was %.1f hours ago",
+                        (started - last_full) / 3600)
+
+    def known(rel_path: str) -> Union[Entry, None]:
+        """ A directory's state, if list_work may skip it when its mtimes haven't changed. """
+        if state is None:
+            return None
+        entry = state.get(rel_path)
+        # A resumed run needn't list again what the interrupted one finished.
+        if skip_unchanged or (resuming and not config.two_way and entry is not None and entry.run == run):
+            return entry
+        return None
+
+    # Directories listed this run: rel_path -> (remote mtime, {name: (is_dir, size, mtime)}) of how
+    # the remote should now look, recorded in the state database once their transfers are done;
+    # None for a directory with conflicts, which mustn't be recorded.
+    reconciled = {}
+    conflicts  = []
+
+    # Transfers still to finish per directory, and directories reconcile is done with. A directory
+    # is recorded as soon as it's both, rather than at the end, so an interrupted run keeps it.
+    outstanding    = collections.Counter()
+    finished       = set()
+    failed_uploads = set()
+    recorded       = 0
+    progress_lock  = threading.Lock()
+
+    def checkpoint(rel_path: str) -> None:
+        nonlocal recorded
+        with progress_lock:
+            snapshot = reconciled.pop(rel_path, None)
+        if snapshot is not None and not config.dry_run and rel_path not in failed_uploads:
+            if record_state(config, state, rel_path, *snapshot, run=run):
+                with progress_lock:
+                    recorded += 1
+
+    def mark_finished(rel_path: str) -> None:
+        if state is None:
+            return
+        with progress_lock:
+            finished.add(rel_path)
+            ready = rel_path not in outstanding
+        if ready:
+            checkpoint(rel_path)
+
+    def tracked(emit: Callable) -> Callable:
+        """ Wrap a stage's emit() to count the transfers it queues against their directories. """
+        def emit_tracked(item: Any, to: str = None) -> None:
+            if isinstance(item, DownloadItem):
+                with progress_lock:
+                    outstanding[item.path] += 1
+            emit(item, to=to)
+        return emit_tracked
+
+    def transferred(items: List[DownloadItem]) -> None:
+        """ Transfers are done with, one way or another; record any directory that's now finished. """
+        ready = []
+        with progress_lock:
+            for item in items:
+                outstanding[item.path] -= 1
+                if outstanding[item.path] <= 0:
+                    del outstanding[item.path]
+                    if item.path in finished:
+                        ready.append(item.path)
+        if state:
+            for rel_path in ready:
+                checkpoint(rel_path)
+    # Directories whose listings reconcile is waiting for from the manifest.
+    requested  = set()
+
+    def list_child(child: str, remote_mtime: Union[int, None], known: Union[Entry, None], emit: Callable) -> None:
+        if config.remote_manifest and remote_mtime is not None:
+            # A remote directory: its listing is on its way in the manifest.
+            requested.add(child)
+        else:
+            emit((child, remote_mtime, known), to="list")
+
+    def reconcile_two_way(sftp, rel_path, remote_mtime, remote_stats, local_stats, emit):
+        plan = get_two_way_deltas(rel_path, remote_stats, local_stats, state.children(rel_path) if state else {})
+        expected = {name: remote_snapshot(st) for name, st in remote_stats.items()}
+
+        # Deletions first, as for a mirror, so type changes have room to happen.
+        if plan.local_trash:
+            move_to_trash(config, rel_path, plan.local_trash, config.dry_run)
+        if plan.remote_trash:
+            move_to_remote_trash(config, sftp, rel_path, plan.remote_trash, config.dry_run)
+            for name in plan.remote_trash:
+                del expected[name]
+
+        for name, mtime in plan.local_dirs.items():
+            dry_check(config.dry_run, create_dir, args=(config, rel_path, name, mtime))
+        for name, mtime in plan.remote_dirs.items():
+            dry_check(config.dry_run, create_remote_dir, args=(sftp, rel_path, name, mtime))
+            expected[name] = (True, 0, mtime, None, None)
+
+        for item in plan.download:
+            emit(item)
+        for item in plan.upload:
+            emit(item, to="upload")
+            expected[item.name] = (False, item.size, item.mtime, None, None)
+
+        conflicts.extend(plan.conflicts)
+        reconciled[rel_path] = None if plan.conflicts else (remote_mtime, expected)
+
+        for child in plan.children:
+            name = posixpath.basename(child)
+            if config.dry_run and (name in plan.remote_dirs or name in plan.local_dirs):
+                continue
+            remote = remote_stats.get(name)
+            list_child(child, remote.st_mtime if remote is not None and is_dir(remote) else None, None, emit)
+
+    def reconcile(sftp, data, emit):
+        rel_path, remote_mtime, listing = data
+        emit = tracked(emit)
+        if listing is None:
+            # Unchanged on both sides; only its sub-directories need checking.
+            for child in state.child_dirs(rel_path):
+                if not config.exclude.match(child):
+                    emit((child, None, known(child)), to="list")
+            return
+
+        remote_stats, local_stats = listing
+        if local_stats is None:
+            # From the manifest, which has everything: only wanted if the parent's
+            # reconcile asked for it, which has also created it locally by now.
+            if rel_path and rel_path not in requested:
+                return
+            requested.discard(rel_path)
+            local_stats = filtered(rel_path, get_local_files(config.local, rel_path), config.exclude)
+            logger.spam("%s: local_stats: %s", rel_path, local_stats)
+        logging.info('~ %s', rel_path)
+        if config.two_way:
+            reconcile_two_way(sftp, rel_path, remote_mtime, remote_stats, local_stats, emit)
+            mark_finished(rel_path)
+            return
+
+        if state:
+            reconciled[rel_path] = (remote_mtime, {name: remote_snapshot(st) for name, st in remote_stats.items()})
+        base = state.children(rel_path) if state and config.remote_manifest else None
+        added, removed, children = get_path_deltas(rel_path, config, remote_stats, local_stats, emit, base,
+                                                   state.mismatches(rel_path) if state else None)
+
+        # Remove anything that needs deleting first, so that if we have items that
+        # changed type (e.g a file became a folder), we delete it before trying to
+        # create anything. Also ensures we free up space where possible before adding
+        # to usage.
+        if removed:
+            move_to_trash(config, rel_path, removed, config.dry_run)
+
+        # Now add things.
+        for name, remote_stat in added.items():
+            if is_file(remote_stat):
+                emit(DownloadItem(rel_path, name, remote_stat.st_size, remote_stat.st_mtime))
+            else:
+                dry_check(config.dry_run, create_dir, args=(config, rel_path, name, remote_stat.st_mtime))
+
+        # If this gave us child directories, list them; only now that we've created them locally.
+        for child in children:
+            list_child(child, remote_stats[posixpath.basename(child)].st_mtime, known(child), emit)
+        mark_finished(rel_path)
+
+    # Download channels, spread over one or more connections, with a few reserved for large files
+    # so that a handful of huge files can't hold up thousands of small ones.
+    transports   = [SSHSession(config.host, config.username, config.password, logger=logger)
+                    for _ in range(max(1, config.dl_transports))]
+    dl_channels  = max(1, config.dl_channels)
+    large_slots  = min(dl_channels, max(1, config.large_slots or dl_channels // 4))
+    small_slots  = max(1, dl_channels - large_slots)
+    limiter      = RateLimiter(config.bwlimit * 1024) if config.bwlimit else None
+
+    def throttle(nbytes: int) -> None:
+        # Every transfer reports what it moves through here, so it's also where we count bytes.
+        if nbytes > 0:
+            recorder.add_bytes(nbytes)
+            if limiter:
+                limiter.consume(nbytes)
+
+    channel_idx  = itertools.count()
+    dl_session   = lambda: SFTPSession(initial_path=config.remote, logger=logger,
+                                       ssh=transports[next(channel_idx) % len(transports)])
+
+    def download(sftp: SFTPSession, item: DownloadItem, emit: Callable) -> None:
+        try:
+            with recorder.timed("download", path=posixpath.join(item.path, item.name), size=item.size):
+                dl_work(config, sftp, item, throttle)
+        finally:
+            transferred([item])
+
+    def upload(sftp: SFTPSession, item: DownloadItem, emit: Callable) -> None:
+        try:
+            with recorder.timed("upload", path=posixpath.join(item.path, item.name), size=item.size):
+                ul_work(config, sftp, item, throttle)
+        except Exception:
+            # The local side looks right either way, so this directory mustn't be recorded.
+            with progress_lock:
+                failed_uploads.add(item.path)
+            raise
+        finally:
+            transferred([item])
+
+    def archive(ssh: SSHSession, batch: List[DownloadItem], emit: Callable) -> None:
+        try:
+            with recorder.timed("archive", files=len(batch)):
+                archive_work(config, ssh, batch, tracked(emit), throttle)
+        finally:
+            transferred(batch)
+
+    def async_session() -> Tuple[asyncio.AbstractEventLoop, AsyncSFTP]:
+        """ An event loop, and the channels it drives, for the 'download-async' worker. """
+        loop = asyncio.new_event_loop()
+        sessions = [dl_session() for _ in range(config.async_channels)]
+        async def connect() -> AsyncSFTP:
+            return AsyncSFTP(sessions, sessions[0].ssh, logger=logger)
+        return loop, loop.run_until_complete(connect())
+
+    def async_close(context: Tuple[asyncio.AbstractEventLoop, AsyncSFTP]) -> None:
+        loop, remote = context
+        try:
+            loop.run_until_complete(remote.close())
+        finally:
+            loop.close()
+
+    def async_download(context: Tuple[asyncio.AbstractEventLoop, AsyncSFTP], batch: List[DownloadItem],
+                       emit: Callable) -> None:
+        loop, remote = context
+        try:
+            with recorder.timed("download-async", files=len(batch)):
+                async_dl_work(config, remote, loop, batch, tracked(emit), throttle)
+        finally:
+            transferred(batch)
+
+    def checksum(client: SSHSession, batch: List[DownloadItem], emit: Callable) -> None:
+        try:
+            sum_work(config, client, batch, tracked(emit), state)
+        finally:
+            transferred(batch)
+
+    route = lambda item: route_download(config, pipe, item)
+
+    # A pool of sftp sessions, sharing one connection, to get directory listings.
+    list_ssh     = SSHSession(config.host, config.username, config.password, logger=logger)
+    ping         = lambda session: session.ping()
+
+    pipe = Pipeline(logger=logger, recorder=recorder)
+    # The listing queue is fed by 'reconcile', which it feeds, so it mustn't block.
+    pipe.add_stage(Stage("list", lambda sftp, data, emit: list_work(config, sftp, data, emit),
+                         workers=config.list_sessions, queue_size=0, outputs=["reconcile"],
+                         setup=lambda: SFTPSession(initial_path=config.remote, logger=logger, ssh=list_ssh),
+                         idle_timeout=KEEPALIVE, on_idle=ping))
+    # One thread applies the listings, so the state database and local tree have a single writer.
+    # Its session is for creating, and trashing, things on the remote in two-way mode.
+    pipe.add_stage(Stage("reconcile", reconcile, queue_size=config.list_depth,
+                         outputs=["download", "download-large"], router=route,
+                         setup=lambda: SFTPSession(initial_path=config.remote, logger=logger, ssh=list_ssh),
+                         idle_timeout=KEEPALIVE, on_idle=ping))
+    if config.remote_manifest:
+        pipe.add_stage(Stage("manifest", lambda ssh, root, emit: manifest_work(config, ssh, root, emit),
+                             queue_size=0, outputs=["reconcile"], setup=lambda: list_ssh, teardown=lambda ssh: None))
+    pipe.add_stage(Stage("checksum", checksum,
+                         queue_size=0, outputs=["download", "download-large"], router=route,
+                         setup=lambda: SSHSession(config.host, config.username, config.password, logger=logger),
+                         batch_size=SUM_BATCH_FILES, batch_weight=lambda item: item.size,
+                         batch_limit=config.sum_batch_bytes, batch_timeout=1.0,
+                         idle_timeout=KEEPALIVE, on_idle=ping))
+    pipe.add_stage(Stage("download", download, workers=small_slots, queue_size=0, setup=dl_session,
+                         idle_timeout=KEEPALIVE, on_idle=ping))
+    pipe.add_stage(Stage("download-large", download, workers=large_slots, queue_size=0, setup=dl_session,
+                         idle_timeout=KEEPALIVE, on_idle=ping))
+    if config.archive:
+        # Archive streams run over the download connections, taking a turn each.
+        pipe.add_stage(Stage("archive", archive,
+                             workers=config.archive_streams, queue_size=0,
+                             setup=lambda: transports[next(channel_idx) % len(transports)], teardown=lambda ssh: None,
+                             batch_size=config.archive_max_files, batch_weight=lambda item: item.size,
+                             batch_limit=config.archive_max_bytes, batch_timeout=1.0))
+    if config.async_channels:
+        # One thread, however many channels; files it can't fetch go to 'download'.
+        pipe.add_stage(Stage("download-async", async_download, queue_size=0, setup=async_session,
+                             teardown=async_close, batch_size=ASYNC_BATCH_FILES, batch_timeout=0.5,
+                             idle_timeout=KEEPALIVE,
+                             on_idle=lambda context: context[0].run_until_complete(context[1].stat('.'))))
+    pipe.add_stage(Stage("upload", upload, workers=config.ul_channels if config.two_way else 1, queue_size=0,
+                         setup=dl_session, idle_timeout=KEEPALIVE, on_idle=ping))
+
+    try:
+        pipe.start()
+        if config.remote_manifest:
+            pipe.put("manifest", '')
+        else:
+            pipe.put("list", ('', None, known('')))
+        pipe.drain()
+        completed = True
+    except BaseException:
+        logger.warning("Cancelling")
+        pipe.cancel()
+        raise
 
     finally:
-        logger.debug("Closing workers")
-        sum_worker.close()
+        logger.debug("Closing sessions")
+        list_ssh.close()
+        for transport in transports:
+            transport.close()
+        report_run(config, pipe)
+        failed_downloads = sum(1 for failure in pipe.failures if failure.stage.startswith("download"))
+        if failed_downloads:
+            logger.error("%d downloads failed", failed_downloads)
+        if failed_uploads:
+            logger.error("Uploads failed in %d directories", len(failed_uploads))
+        for path in conflicts:
+            logger.warning("Conflict (changed on both sides, left alone): %s", path)
+        if conflicts:
+            logger.error("%d conflicts", len(conflicts))
+        if state:
+            if not config.dry_run:
+                # Everything queued has now been transferred or failed, so whatever
+                # matches its listing can be recorded, even if we were interrupted
+                # before the directory was finished.
+                for rel_path in list(reconciled):
+                    checkpoint(rel_path)
+                logger.info("Recorded %d listed directories in %s", recorded, STATE_FILE)
+                if completed:
+                    state.set_meta("run", None)
+                    if not skip_unchanged:
+                        state.set_meta("listed", "%f" % started)
+            state.close()
         logger.debug("Finished")
 
 
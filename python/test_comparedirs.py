@@ -0,0 +1,76 @@
+from io import StringIO
+import os
+import tempfile
+from unittest import TestCase
+
+from comparedirs import Comparison
+
+
+def write(root, rel_path, data):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(data)
+
+
+class TestComparison(TestCase):
+    def setUp(self) -> None:
+        # Comparison lower-cases paths, so keep everything lower-case.
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name.lower()
+        self.assertEqual(self.root, self.tmp.name)
+        self.tree = os.path.join(self.root, "tree")
+        for name in ("a", "b", "c"):
+            write(self.tree, "left/%s.txt" % name, name.encode() * 100)
+            write(self.tree, "right/%s.txt" % name, name.encode() * 100)
+        write(self.tree, "left/dupe.txt", b"a" * 100)
+        write(self.tree, "right/d.txt", b"d" * 300)
+        write(self.tree, "other/a-copy.txt", b"a" * 100)
+        write(self.tree, "other/unique.txt", b"u" * 100)
+
+        self.comparison = Comparison()
+        self.comparison.DB = os.path.join(self.root, "hashes.db")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_match_and_cache(self) -> None:
+        comparison = self.comparison
+        comparison.scan([self.tree])
+        progress = []
+        matched, distinct = comparison.match(lambda info, done: progress.append((info.path, done)), workers=3,
+                                             queue_size=2)
+        self.assertEqual((matched, distinct), (8, 3))
+        self.assertEqual(comparison.cache_miss, 9)      # every 100 byte file, not the one 300 byte file
+        # Each hashed file is reported as started then done.
+        for path in {path for path, _ in progress}:
+            self.assertEqual([done for seen, done in progress if seen == path], [0, 100])
+
+        # A second pass comes from the (batched) cache.
+        comparison.DB_BATCH_SIZE = 3
+        comparison.scan([self.tree])
+        self.assertEqual(comparison.match(workers=2), (8, 3))
+        self.assertEqual((comparison.cache_hit, comparison.cache_miss), (9, 0))
+
+    def test_similarity(self) -> None:
+        comparison = self.comparison
+        comparison.scan([self.tree])
+        comparison.match()
+        comparison.classify()
+        ranked = {(pair.lhs, pair.rhs): pair for pair in comparison.similarity()}
+        left, right, other = (os.path.join(self.tree, name) for name in ("left", "right", "other"))
+
+        pair = ranked[(left, right)]
+        # left has a, b, c, dupe(a) and right a, b, c, d: 3 shared of 8 files.
+        self.assertEqual((pair.shared_files, pair.shared_bytes), (3, 300))
+        self.assertAlmostEqual(pair.count_pct, 75.0)
+        self.assertAlmostEqual(pair.bytes_pct, 200.0 * 300 / (400 + 600))
+
+        # Both copies of 'a' in left are shared with other, which has one.
+        self.assertEqual(ranked[(left, other)].shared_files, 1)
+        self.assertEqual(ranked[(other, right)].shared_files, 1)
+
+        self.assertEqual([(pair.lhs, pair.rhs) for pair in comparison.similarity(min_pct=60)], [(left, right)])
+        out = StringIO()
+        comparison.report(min_pct=60, fh=out)
+        self.assertIn("75.00% files", out.getvalue())
@@ -0,0 +1,38 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from finddupes import Catalog
+
+
+def write(root, rel_path, data):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    return path
+
+
+class TestCatalog(TestCase):
+    def test_matching_files(self) -> None:
+        big = os.urandom(100 * 1024)
+        with tempfile.TemporaryDirectory() as tmp:
+            root = os.path.realpath(tmp)
+            small = [write(root, "small/%d" % n, b"same") for n in range(2)]
+            large = [write(root, "large/%d" % n, big) for n in range(2)]
+            # Same size and first 64k, but different after that.
+            write(root, "large/near-miss", big[:-1] + bytes([big[-1] ^ 1]))
+            write(root, "ignored/copy", big)
+            # A symlinked file is walked as the file it points to.
+            os.symlink(small[0], os.path.join(root, "small", "link"))
+
+            catalog = Catalog([root], ignore_folders=[os.path.join(root, "ignored")], threads=2)
+            matches = sorted((size, sorted(paths)) for size, paths in catalog.matching_files())
+            self.assertEqual(matches, [(4, sorted(small + [os.path.join(root, "small", "link")])),
+                                       (len(big), large)])
+            self.assertEqual(catalog.files_observed, 6)
+
+            catalog = Catalog([root], min_size=5, ignore_folders=[os.path.join(root, "ignored")], threads=2)
+            self.assertEqual([size for size, _ in catalog.matching_files()], [len(big)])
+            # Files outside the size limits are still counted as observed.
+            self.assertEqual(catalog.files_observed, 6)
@@ -0,0 +1,297 @@
+import ctypes
+from io import BytesIO
+import os
+import socket
+import tempfile
+import threading
+from unittest import TestCase, skipUnless
+
+from packedstruct import Converter, FrameReader, PackedStruct, RecordFile, _field_offsets, numpy
+
+
+Header = PackedStruct.create('Header', [('8s', 'name'), ('i', 'value'), ('2h', 'pair')], net_endian=True)
+Sample = PackedStruct.create('Sample', [('I', 'id'), ('d', 'value')])
+Message = PackedStruct.create('Message', [('H', 'type'), ('I', 'length')], net_endian=True)
+Padded = PackedStruct.create('Padded', [('b', 'flag'), ('3x', 'pad'), ('2i', 'pair')])
+
+
+class TestPackedStruct(TestCase):
+    def test_round_trip(self) -> None:
+        header = Header(mName=b'abc', mValue=-5, mPair=(1, 2))
+        data = header.pack()
+        self.assertEqual(data, b'abc\0\0\0\0\0' + b'\xff\xff\xff\xfb' + b'\0\x01\0\x02')
+        self.assertEqual(len(data), Header.SIZE)
+
+        decoded = Header.unpack_from(b'xx' + data, 2)
+        self.assertEqual((decoded.mName, decoded.mValue, decoded.mPair), (b'abc\0\0\0\0\0', -5, (1, 2)))
+        self.assertEqual(decoded, Header(BytesIO(data)))
+        self.assertEqual(decoded.to_bytes(), data)
+
+    def test_slots_and_bulk(self) -> None:
+        data = b''.join(Sample(mId=n, mValue=n / 2).pack() for n in range(10))
+        samples = list(Sample.iter_unpack(data))
+        self.assertEqual([s.mId for s in samples], list(range(10)))
+        self.assertEqual(samples[3].mValue, 1.5)
+        self.assertFalse(hasattr(samples[0], '__dict__'))
+
+        buffer = bytearray(Sample.SIZE)
+        samples[7].pack_into(buffer)
+        self.assertEqual(Sample.from_bytes(buffer), samples[7])
+
+    def test_hashable(self) -> None:
+        samples = [Sample(mId=n % 3, mValue=1.5) for n in range(6)]
+        self.assertEqual(len(set(samples)), 3)
+        self.assertEqual({samples[0]: 'first'}[Sample(mId=0, mValue=1.5)], 'first')
+        self.assertEqual(hash(Header(mName=b'a', mValue=1, mPair=(1, 2))),
+                         hash(Header(mName=b'a', mValue=1, mPair=(1, 2))))
+
+    def test_missing_field(self) -> None:
+        with self.assertRaises(TypeError):
+            Sample(mId=1)
+
+    def test_nested_alignment(self) -> None:
+        # The struct module doesn't pad the end of an aligned struct, so it can't be nested as C would.
+        A = PackedStruct.create('A', (('c', 't'), ('d', 'd'), ('c', 'e')))
+        with self.assertRaises(ValueError):
+            PackedStruct.create('B', (((2, A), 'as'), ('c', 'f')))
+        with self.assertRaises(ValueError):
+            PackedStruct.create('B', (((2, A), 'as'), ('c', 'f')), aligned=False)
+
+        A = PackedStruct.create('A', (('c', 't'), ('7x', 'pad'), ('d', 'd'), ('c', 'e'), ('7x', 'pad')), aligned=False)
+        B = PackedStruct.create('B', (((2, A), 'as'), ('c', 'f')), aligned=False)
+        self.assertEqual(B.SIZE, 2 * A.SIZE + 1)
+        b = B(mAs=(A(mT=b'x', mD=0.5, mE=b'y'), A(mT=b'z', mD=1.5, mE=b'w')), mF=b'f')
+        self.assertEqual(B.unpack_from(b.pack()), b)
+        self.assertEqual(B.view(b.pack()).mAs[1].mD, 1.5)
+
+    def test_padding(self) -> None:
+        self.assertEqual(Padded.FIELDS, ('mFlag', 'mPair'))
+        self.assertEqual(Padded(mFlag=1, mPair=(2, 3)).pack()[:4], b'\x01\0\0\0')
+
+
+class TestRecordFile(TestCase):
+    def test_views_and_bisect(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "headers")
+            with open(path, "wb") as fh:
+                fh.write(b'file-header!')
+                for n in range(100):
+                    fh.write(Header(mName=b'n%02d' % n, mValue=n * 3, mPair=(n, -n)).pack())
+                fh.write(b'tail')
+
+            with RecordFile(Header, path, offset=12) as records:
+                self.assertEqual(len(records), 100)
+                self.assertEqual(records[7].mValue, 21)
+                self.assertEqual(records[-1].mPair, (99, -99))
+                self.assertEqual(records.decode(5), records[5].record())
+
+                evens = records[10:20:2]
+                self.assertEqual([record.mValue for record in evens], [30, 36, 42, 48, 54])
+                self.assertEqual(evens[1].offset, 12 + Header.SIZE * 12)
+
+                self.assertEqual(records.bisect_left(100, key=lambda record: record.mValue), 34)
+                self.assertEqual(records.bisect_left(b'n50', key=lambda record: record.mName), 50)
+                if numpy is not None:
+                    self.assertEqual(list(records[40:43].array()['mValue']), [120, 123, 126])
+
+    def test_empty(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "empty")
+            open(path, "wb").close()
+            with RecordFile(Sample, path) as records:
+                self.assertEqual(len(records), 0)
+                self.assertEqual(list(records), [])
+
+
+def frames(count):
+    """ 'count' Messages, alternately a Sample and bytes of increasing length. """
+    data = b''
+    for n in range(count):
+        if n % 2:
+            payload = Sample(mId=n, mValue=n / 4).pack() + b'tail'
+        else:
+            payload = bytes(range(n % 256)) * 3
+        data += Message(mType=n % 2, mLength=len(payload)).pack() + payload
+    return data
+
+
+class TestFrameReader(TestCase):
+    def check(self, reader, count) -> None:
+        seen = 0
+        for n, frame in enumerate(reader):
+            self.assertEqual(frame.header.mType, n % 2)
+            if n % 2:
+                self.assertEqual((frame.record.mId, frame.record.mValue), (n, n / 4))
+                self.assertEqual(bytes(frame.payload[Sample.SIZE:]), b'tail')
+            else:
+                self.assertIsNone(frame.record)
+                self.assertEqual(bytes(frame.payload), bytes(range(n % 256)) * 3)
+            seen += 1
+        self.assertEqual(seen, count)
+
+    def test_file(self) -> None:
+        # A buffer much smaller than the frames, so it's refilled and grown.
+        reader = FrameReader(BytesIO(frames(200)), Message, 'length', 'type', {1: Sample}, buffer_size=16)
+        self.check(reader, 200)
+
+    def test_pipe_and_socket(self) -> None:
+        data = frames(300)
+        read_fd, write_fd = os.pipe()
+        writer = threading.Thread(target=lambda: (os.write(write_fd, data), os.close(write_fd)))
+        writer.start()
+        with os.fdopen(read_fd, 'rb', buffering=0) as fh:
+            self.check(FrameReader(fh, Message, 'mLength', 'mType', {1: Sample}, buffer_size=1024), 300)
+        writer.join()
+
+        left, right = socket.socketpair()
+        writer = threading.Thread(target=lambda: (left.sendall(data), left.close()))
+        writer.start()
+        with right:
+            self.check(FrameReader(right, Message, 'length', 'type', {1: Sample}), 300)
+        writer.join()
+
+    def test_truncated(self) -> None:
+        data = frames(3)
+        with self.assertRaises(EOFError):
+            list(FrameReader(BytesIO(data[:-1]), Message, 'length'))
+        whole = Message(mType=0, mLength=Message.SIZE).pack()
+        self.assertEqual(len(list(FrameReader(BytesIO(whole * 4), Message, 'length',
+                                              length_includes_header=True))), 4)
+        with self.assertRaises(ValueError):
+            list(FrameReader(BytesIO(frames(200)), Message, 'length', max_length=100))
+
+
+HEADER = '''
+enum lyColor
+{
+    RED,
+    GREEN = 4,
+    BLUE        // 5
+};
+
+struct lyPoint {
+    uint8_t     tag;
+    double      x;
+    int16_t     y;
+};
+
+#pragma pack(push, 2)
+struct lyPacked
+{
+    char        c;
+    uint64_t    big;
+    struct lyPoint pt;
+};
+#pragma pack(pop)
+
+struct lyOuter
+{
+    bool        flag;
+    struct lyPoint pts[2];
+    enum lyColor color;
+    int64_t     delta;
+    char        name[3];
+};
+'''
+
+
+class CPoint(ctypes.Structure):
+    _fields_ = [('tag', ctypes.c_uint8), ('x', ctypes.c_double), ('y', ctypes.c_int16)]
+
+
+class CPacked(ctypes.Structure):
+    _pack_ = 2
+    _fields_ = [('c', ctypes.c_char), ('big', ctypes.c_uint64), ('pt', CPoint)]
+
+
+class COuter(ctypes.Structure):
+    _fields_ = [('flag', ctypes.c_bool), ('pts', CPoint * 2), ('color', ctypes.c_int),
+                ('delta', ctypes.c_int64), ('name', ctypes.c_char * 3)]
+
+
+class TestConverter(TestCase):
+    def setUp(self) -> None:
+        self.types = {'PackedStruct': PackedStruct}
+        exec(Converter().parse(HEADER.splitlines(), prefix='ly'), self.types)
+
+    def test_enum(self) -> None:
+        color = self.types['LyColor']
+        self.assertEqual((color.RED, color.GREEN, color.BLUE), (0, 4, 5))
+
+    def test_ctypes_layout(self) -> None:
+        for name, c_struct in (('LyPoint', CPoint), ('LyPacked', CPacked), ('LyOuter', COuter)):
+            cls = self.types[name]
+            self.assertEqual(cls.SIZE, ctypes.sizeof(c_struct), name)
+            c_fields = [field for field, _ in c_struct._fields_]
+            self.assertEqual([offset for _, _, offset in _field_offsets(cls)],
+                             [getattr(c_struct, field).offset for field in c_fields], name)
+
+    def test_ctypes_values(self) -> None:
+        Outer = self.types['LyOuter']
+        c_outer = COuter(True, (CPoint(1, 0.5, -2), CPoint(2, 1.5, 3)), 5, -(2 ** 40), b'abc')
+        outer = Outer.from_bytes(bytes(c_outer))
+        self.assertEqual((outer.mFlag, outer.mColor, outer.mDelta, outer.mName), (True, 5, -(2 ** 40), b'abc'))
+        self.assertEqual((outer.mPts[1].mTag, outer.mPts[1].mX, outer.mPts[1].mY), (2, 1.5, 3))
+        self.assertEqual(outer.pack(), bytes(c_outer))
+
+        view = Outer.view(bytes(c_outer))
+        self.assertEqual((view.mPts[0].mY, view.mDelta), (-2, -(2 ** 40)))
+
+        Packed = self.types['LyPacked']
+        c_packed = CPacked(b'z', 2 ** 63, CPoint(7, -1.0, 9))
+        packed = Packed.from_bytes(bytes(c_packed))
+        self.assertEqual((packed.mBig, packed.mPt.mTag, packed.mPt.mY), (2 ** 63, 7, 9))
+        self.assertEqual(packed.pack(), bytes(c_packed))
+
+
+@skipUnless(numpy, "needs numpy")
+class TestNumpy(TestCase):
+    def test_dtype_layout(self) -> None:
+        dtype = Header.dtype()
+        self.assertEqual(dtype.itemsize, Header.SIZE)
+        self.assertEqual(dtype.names, Header.FIELDS)
+        self.assertEqual(dtype.fields['mValue'][0], numpy.dtype('>i4'))
+        self.assertEqual(dtype.fields['mPair'][1], 12)
+        # Native alignment, as the struct module does it.
+        self.assertEqual(Sample.dtype().fields['mValue'][1], 8)
+        self.assertEqual(Padded.dtype().fields['mPair'][1], 4)
+
+    def test_bulk(self) -> None:
+        records = [Header(mName=b'n%d' % n, mValue=n * 10, mPair=(n, -n)) for n in range(50)]
+        data = b''.join(record.pack() for record in records)
+
+        array = Header.from_buffer(data)
+        self.assertEqual(len(array), 50)
+        self.assertEqual(array['mValue'].sum(), sum(n * 10 for n in range(50)))
+        self.assertEqual(Header.columns(array).mName[7], b'n7')
+        self.assertEqual(tuple(array[9]['mPair']), (9, -9))
+
+        self.assertEqual(len(Header.read_array(BytesIO(data[:-3]), 100)), 49)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "headers")
+            with open(path, "wb") as fh:
+                fh.write(data)
+            mapped = Header.memmap(path, count=10, offset=Header.SIZE * 40)
+            self.assertEqual(list(mapped['mValue']), [n * 10 for n in range(40, 50)])
+            del mapped
+
+    def test_record_file_array(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "samples")
+            with open(path, "wb") as fh:
+                fh.write(b''.join(Sample(mId=n, mValue=n / 2).pack() for n in range(20)))
+            with RecordFile(Sample, path) as records:
+                array = records.array()
+            # Closing leaves the mapping to the array, but the file itself is closed.
+            self.assertIsNone(records._fh)
+            self.assertEqual(array['mValue'][5], 2.5)
+            del array
+
+    def test_nested_dtype(self) -> None:
+        types = {'PackedStruct': PackedStruct}
+        exec(Converter().parse(HEADER.splitlines(), prefix='ly'), types)
+        c_outer = COuter(True, (CPoint(1, 0.5, -2), CPoint(2, 1.5, 3)), 5, 7, b'abc')
+        array = types['LyOuter'].from_buffer(bytes(c_outer) * 3)
+        self.assertEqual(array.dtype.itemsize, ctypes.sizeof(COuter))
+        self.assertEqual(list(array['mPts']['mX'][2]), [0.5, 1.5])
@@ -0,0 +1,496 @@
+import os
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import TestCase, mock, skipUnless
+
+try:
+    import syncer
+except ImportError:         # paramiko isn't installed
+    syncer = None
+
+
+MTIME = 1500000000
+
+
+def write(root, rel_path, data, mtime=MTIME):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+def read(root, rel_path):
+    with open(os.path.join(root, rel_path), "rb") as fh:
+        return fh.read()
+
+
+class RemoteFile(object):
+    """ Just enough of a paramiko SFTPFile for RangeTransfer and AsyncSFTP. """
+    def __init__(self, path, mode):
+        self.path = path
+        self.fh = open(path, mode)
+
+    def stat(self):
+        return SimpleNamespace(st_size=os.fstat(self.fh.fileno()).st_size)
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self.fh.seek(offset)
+            yield self.fh.read(length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fh.close()
+
+
+class LocalSFTP(object):
+    """
+    An SFTP client over a local directory. Like the real thing it has a
+    working directory, and mtimes come over as whole seconds.
+    """
+    def __init__(self):
+        self.cwd = "/"
+
+    def _path(self, path):
+        return os.path.join(self.cwd, path)
+
+    def _attrs(self, st, name=None):
+        attrs = syncer.SFTPAttributes()
+        attrs.st_size, attrs.st_mode = st.st_size, st.st_mode
+        attrs.st_mtime, attrs.st_atime = int(st.st_mtime), int(st.st_atime)
+        attrs.filename = name
+        return attrs
+
+    def chdir(self, path):
+        self.cwd = self._path(path)
+
+    def listdir_iter(self, path="."):
+        with os.scandir(self._path(path)) as it:
+            return [self._attrs(ent.stat(follow_symlinks=False), ent.name) for ent in it]
+
+    def stat(self, path):
+        return self._attrs(os.stat(self._path(path)))
+
+    def open(self, path, mode="rb"):
+        return RemoteFile(self._path(path), mode)
+
+    def getfo(self, path, fl, callback=None):
+        total = os.path.getsize(self._path(path))
+        with open(self._path(path), "rb") as fh:
+            done = 0
+            for data in iter(lambda: fh.read(4096), b""):
+                fl.write(data)
+                done += len(data)
+                if callback:
+                    callback(done, total)
+        return done
+
+    def putfo(self, fl, path, file_size=0, callback=None, confirm=True):
+        with open(self._path(path), "wb") as fh:
+            shutil.copyfileobj(fl, fh)
+        if callback:
+            callback(file_size, file_size)
+        return self.stat(path)
+
+    def utime(self, path, times):
+        os.utime(self._path(path), times)
+
+    def posix_rename(self, old, new):
+        os.replace(self._path(old), self._path(new))
+
+    def mkdir(self, path):
+        os.mkdir(self._path(path))
+
+    def close(self):
+        pass
+
+
+class LocalOutput(object):
+    """ A running command's stdout, with its exit status where paramiko keeps it. """
+    def __init__(self, process):
+        self.process = process
+        self.channel = self
+
+    def read(self, *args):
+        return self.process.stdout.read(*args)
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class LocalSSH(object):
+    """ Stands in for SSHSession: 'remote' commands run locally. """
+    def __init__(self, *args, **kwargs):
+        self.client = self
+
+    def open_sftp(self):
+        return LocalSFTP()
+
+    def start(self, command, inputs=None):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.stdin.write(inputs.encode() if isinstance(inputs, str) else inputs or b"")
+        process.stdin.close()
+        return LocalOutput(process)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@skipUnless(syncer, "needs paramiko")
+class TestRouting(TestCase):
+    def route(self, size, depths=None, idle=None, archive=None, async_channels=0):
+        """ Route an item with both download stages' queues at 'depths', and 'idle' workers of 3 and 1. """
+        depths = depths or {}
+        idle = dict({"download": 3, "download-large": 1}, **(idle or {}))
+        config = SimpleNamespace(archive=archive, archive_max_file_size=100, large_file_size=1000,
+                                 async_channels=async_channels, async_max_file_size=200)
+        pipe = SimpleNamespace(depth=lambda stage: depths.get(stage, 0), idle=lambda stage: idle[stage])
+        return syncer.route_download(config, pipe, syncer.DownloadItem("", "f", size, MTIME))
+
+    def test_lanes(self) -> None:
+        self.assertEqual(self.route(1000), "download-large")
+        self.assertEqual(self.route(999), "download")
+        self.assertEqual(self.route(100, archive="gz"), "archive")
+        self.assertEqual(self.route(101, archive="gz"), "download")
+        self.assertEqual(self.route(200, async_channels=2), "download-async")
+        self.assertEqual(self.route(100, archive="gz", async_channels=2), "archive")
+        self.assertEqual(self.route(201, async_channels=2), "download")
+
+    def test_large_lane_helps_out(self) -> None:
+        # Only once every small-file channel has something to do.
+        self.assertEqual(self.route(10, {"download": 2}), "download")
+        self.assertEqual(self.route(10, {"download": 3}), "download-large")
+        self.assertEqual(self.route(10, idle={"download": 0}), "download-large")
+        # ... and not if a large file is waiting for the large-file channel.
+        self.assertEqual(self.route(10, {"download": 3, "download-large": 1}), "download")
+
+    def test_busy_large_lane(self) -> None:
+        # Nothing queued for it, but busy with a huge file: small files mustn't wait behind it.
+        self.assertEqual(self.route(10, {"download": 3}, idle={"download-large": 0}), "download")
+        self.assertEqual(self.route(10, {"download": 100}, idle={"download": 0, "download-large": 0}), "download")
+
+
+@skipUnless(syncer, "needs paramiko")
+class TestChecksums(TestCase):
+    def test_batch_across_directories(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            remote, local = os.path.join(tmp, "remote"), os.path.join(tmp, "local")
+            for rel_path, data in (("a/same", b"same"), ("a/differs", b"remote"), ("b/same", b"also the same"),
+                                   ("b/gone", b"only on the remote")):
+                write(remote, rel_path, data)
+            write(local, "a/same", b"same", mtime=MTIME + 60)
+            write(local, "a/differs", b"locale", mtime=MTIME + 60)
+            write(local, "b/same", b"also the same", mtime=MTIME + 60)
+            batch = [syncer.DownloadItem(*posixpath.split(rel_path), os.path.getsize(os.path.join(remote, rel_path)),
+                                         MTIME)
+                     for rel_path in ("a/same", "a/differs", "b/same", "b/gone")]
+
+            commands, hashed, emitted = [], [], []
+            class CountingSSH(LocalSSH):
+                def start(self, command, inputs=None):
+                    commands.append(command)
+                    return super().start(command, inputs)
+
+            hash_file = syncer.hash_file
+            def recording_hash_file(path):
+                hashed.append(threading.current_thread().name)
+                return hash_file(path)
+
+            config = SimpleNamespace(remote=remote, local=local, sum_threads=2, dry_run=False)
+            with mock.patch.object(syncer, "hash_file", recording_hash_file):
+                syncer.sum_work(config, CountingSSH(), batch, emitted.append)
+
+            # One remote command for both directories, with the local copies hashed by the pool.
+            self.assertEqual(len(commands), 1)
+            self.assertEqual(len(hashed), 4)
+            self.assertTrue(all(name.startswith("checksum") for name in hashed), hashed)
+            self.assertEqual(sorted(posixpath.join(item.path, item.name) for item in emitted),
+                             ["a/differs", "b/gone"])
+            # Files that match just get the remote's mtime.
+            self.assertEqual(os.stat(os.path.join(local, "a", "same")).st_mtime, MTIME)
+            self.assertEqual(os.stat(os.path.join(local, "b", "same")).st_mtime, MTIME)
+            self.assertEqual(os.stat(os.path.join(local, "a", "differs")).st_mtime, MTIME + 60)
+
+
+@skipUnless(syncer, "needs paramiko")
+class TestSync(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.remote = os.path.join(self.tmp.name, "remote")
+        self.local = os.path.join(self.tmp.name, "local")
+        os.makedirs(self.local)
+        for n in range(10):
+            write(self.remote, "small/%d.txt" % n, b"%d" % n * 100)
+        write(self.remote, "big/large.bin", os.urandom(5000))
+        write(self.remote, "big/ranged.bin", os.urandom(300000))
+        os.utime(os.path.join(self.remote, "small"), (MTIME, MTIME))
+        os.utime(os.path.join(self.remote, "big"), (MTIME, MTIME))
+
+        # Which download stage's threads handled which file.
+        self.lanes = {}
+        dl_work = syncer.dl_work
+        def recording_dl_work(config, sftp, data, throttle):
+            self.lanes[data.name] = threading.current_thread().name.rsplit("-", 1)[0]
+            dl_work(config, sftp, data, throttle)
+
+        for patch in (mock.patch.object(syncer, "SSHSession", LocalSSH),
+                      mock.patch.object(syncer, "dl_work", recording_dl_work)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def sync(self, *args):
+        config = syncer.parse_arguments(["--username", "u", "--password", "p", "--dl-channels", "4",
+                                         "--large-file-size", "1000", "--range-min-size", "100000",
+                                         "--range-part-size", "16384", "--range-channels", "3"]
+                                        + list(args) + ["host", self.remote, self.local])
+        self.lanes.clear()
+        syncer.main(config)
+
+    def assertMirrored(self) -> None:
+        for dirpath, dirnames, filenames in os.walk(self.remote):
+            for name in filenames:
+                rel_path = os.path.relpath(os.path.join(dirpath, name), self.remote)
+                self.assertEqual(read(self.local, rel_path), read(self.remote, rel_path), rel_path)
+                self.assertEqual(os.stat(os.path.join(self.local, rel_path)).st_mtime, MTIME, rel_path)
+        self.assertEqual(sorted(name for name in os.listdir(self.local) if not name.startswith(".Sync")),
+                         sorted(os.listdir(self.remote)))
+
+    def test_download(self) -> None:
+        self.sync()
+        self.assertMirrored()
+        self.assertEqual(self.lanes["large.bin"], "download-large")
+        self.assertEqual(self.lanes["ranged.bin"], "download-large")
+        self.assertEqual(len(self.lanes), 12)
+        self.assertFalse([name for name in os.listdir(os.path.join(self.local, "big")) if name.endswith(".tmp")])
+
+        # Nothing has changed, so there's nothing to fetch.
+        self.sync()
+        self.assertEqual(self.lanes, {})
+        # ... and the metrics are of this run alone.
+        self.assertNotIn("download", syncer.recorder.histograms)
+        self.assertEqual(syncer.recorder.bytes, {})
+
+    def test_changes(self) -> None:
+        self.sync()
+        write(self.remote, "small/3.txt", b"changed")
+        write(self.remote, "big/ranged.bin", os.urandom(200000))
+        os.remove(os.path.join(self.remote, "small", "4.txt"))
+        # Same size and content, different mtime: only needs a checksum.
+        os.utime(os.path.join(self.local, "small", "5.txt"), (MTIME + 60, MTIME + 60))
+
+        self.sync("--no-state")
+        self.assertMirrored()
+        self.assertEqual(sorted(self.lanes), ["3.txt", "ranged.bin"])
+        self.assertTrue(os.path.exists(posixpath.join(self.local, syncer.TRASH_FOLDER, "small", "4.txt")))
+
+    def test_resume_interrupted_download(self) -> None:
+        data = os.urandom(60000)
+        write(self.remote, "big/seq.bin", data)
+        getfo = LocalSFTP.getfo
+        def interrupted_getfo(sftp, path, fl, callback=None):
+            if not path.endswith("seq.bin"):
+                return getfo(sftp, path, fl, callback)
+            fl.write(data[:40000])
+            callback(40000, len(data))
+            raise IOError("connection lost")
+
+        with mock.patch.object(LocalSFTP, "getfo", interrupted_getfo):
+            self.sync()
+        # The first two parts are journalled as they arrive, and kept.
+        tmp_path = os.path.join(self.local, "big", "seq.bin.tmp")
+        self.assertFalse(os.path.exists(os.path.join(self.local, "big", "seq.bin")))
+        self.assertEqual(syncer.load_journal(syncer.journal_path(tmp_path), len(data), MTIME, 16384), {0, 16384})
+
+        # The next run carries on with ranged reads of the rest.
+        reads = []
+        readv = RemoteFile.readv
+        def recording_readv(rfh, chunks):
+            chunks = list(chunks)
+            if rfh.path.endswith("seq.bin"):
+                reads.extend(offset for offset, length in chunks)
+            return readv(rfh, chunks)
+
+        with mock.patch.object(RemoteFile, "readv", recording_readv):
+            self.sync()
+        self.assertMirrored()
+        self.assertEqual(self.lanes, {"seq.bin": "download-large"})
+        self.assertEqual(min(reads), 32768)
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertFalse(os.path.exists(syncer.journal_path(tmp_path)))
+
+    def test_resume_interrupted_run(self) -> None:
+        # Same size and a newer mtime, but different content: one for the checksums to find.
+        write(self.local, "small/5.txt", b"x" * 100, mtime=MTIME + 60)
+        getfo = LocalSFTP.getfo
+        def failing_getfo(sftp, path, fl, callback=None):
+            if path.endswith("5.txt"):
+                raise IOError("connection lost")
+            return getfo(sftp, path, fl, callback)
+        drain = syncer.Pipeline.drain
+        def interrupted_drain(pipe, *args):
+            drain(pipe, *args)
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(LocalSFTP, "getfo", failing_getfo), \
+                mock.patch.object(syncer.Pipeline, "drain", interrupted_drain):
+            with self.assertRaises(KeyboardInterrupt):
+                self.sync()
+        state = syncer.SyncState(os.path.join(self.local, syncer.STATE_FILE))
+        self.assertEqual(list(state.mismatches("small")), ["5.txt"])
+        state.close()
+
+        listed, summed = [], []
+        list_path, sum_work = syncer.list_path, syncer.sum_work
+        def recording_list_path(rel_path, *args):
+            listed.append(rel_path)
+            return list_path(rel_path, *args)
+        def recording_sum_work(config, client, batch, emit, *args):
+            summed.extend(posixpath.join(item.path, item.name) for item in batch)
+            return sum_work(config, client, batch, emit, *args)
+
+        # Without --skip-unchanged-dirs, the resumed run skips what the interrupted one finished ...
+        with mock.patch.object(syncer, "list_path", recording_list_path), \
+                mock.patch.object(syncer, "sum_work", recording_sum_work):
+            self.sync()
+        self.assertMirrored()
+        self.assertEqual(sorted(listed), ["", "small"])
+        # ... and downloads the file it found to differ without checksumming it again.
+        self.assertEqual(self.lanes, {"5.txt": "download"})
+        self.assertEqual(summed, [])
+
+        # Once a run has completed, the next lists everything.
+        listed.clear()
+        with mock.patch.object(syncer, "list_path", recording_list_path):
+            self.sync()
+        self.assertEqual(sorted(listed), ["", "big", "small"])
+
+    def test_modified_in_place(self) -> None:
+        self.sync()
+        # A remote file rewritten in place: its directory's mtime stays as it was.
+        write(self.remote, "small/3.txt", b"x" * 100, mtime=MTIME + 60)
+        os.utime(os.path.join(self.remote, "small"), (MTIME, MTIME))
+
+        # Only noticed by a full listing ...
+        self.sync("--skip-unchanged-dirs")
+        self.assertEqual(self.lanes, {})
+        self.sync("--skip-unchanged-dirs", "--full-listing-hours", "0")
+        self.assertEqual(self.lanes, {"3.txt": "download"})
+        self.assertEqual(read(self.local, "small/3.txt"), b"x" * 100)
+
+        # ... which is what every run does by default.
+        write(self.remote, "small/4.txt", b"y" * 100, mtime=MTIME + 60)
+        os.utime(os.path.join(self.remote, "small"), (MTIME, MTIME))
+        self.sync()
+        self.assertEqual(self.lanes, {"4.txt": "download"})
+
+    def test_two_way(self) -> None:
+        plans, uploads = [], []
+        get_two_way_deltas, ul_work = syncer.get_two_way_deltas, syncer.ul_work
+        def recording_deltas(*args):
+            plans.append(get_two_way_deltas(*args))
+            return plans[-1]
+        def recording_ul_work(config, sftp, data, throttle):
+            uploads.append(data.name)
+            ul_work(config, sftp, data, throttle)
+
+        def sync():
+            plans.clear()
+            uploads.clear()
+            self.sync("--two-way")
+            return [path for plan in plans for path in plan.conflicts]
+
+        with mock.patch.object(syncer, "get_two_way_deltas", recording_deltas), \
+                mock.patch.object(syncer, "ul_work", recording_ul_work):
+            self.assertEqual(sync(), [])
+            self.assertMirrored()
+
+            # Local changes, with the sub-second mtimes local files usually have.
+            write(self.local, "small/3.txt", b"local" * 20, mtime=MTIME + 60.5)
+            write(self.local, "new/file.txt", b"new", mtime=MTIME + 0.25)
+            self.assertEqual(sync(), [])
+            self.assertEqual(sorted(uploads), ["3.txt", "file.txt"])
+            self.assertEqual(read(self.remote, "small/3.txt"), b"local" * 20)
+            self.assertEqual(read(self.remote, "new/file.txt"), b"new")
+
+            # Nothing has changed since, on either side.
+            self.assertEqual(sync(), [])
+            self.assertEqual((uploads, self.lanes), ([], {}))
+
+            # Both sides changed differently.
+            write(self.local, "small/5.txt", b"local")
+            write(self.remote, "small/5.txt", b"remote", mtime=MTIME + 120)
+            self.assertEqual(sync(), ["small/5.txt"])
+            self.assertEqual(read(self.local, "small/5.txt"), b"local")
+            self.assertEqual(read(self.remote, "small/5.txt"), b"remote")
+
+    def test_stale_journal(self) -> None:
+        # Leftovers of an interrupted download of a remote file that has changed since.
+        write(self.local, "small/3.txt.tmp", b"old")
+        write(self.local, "small/3.txt.tmp.parts", b"3 1234 16384\n0\n")
+        self.sync()
+        self.assertMirrored()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.local, "small"))), ["%d.txt" % n for n in range(10)])
+
+    def test_async_channels(self) -> None:
+        open_file = LocalSFTP.open
+        def failing_open(sftp, path, mode="rb"):
+            if path.endswith("5.txt"):
+                raise IOError("no such luck")
+            return open_file(sftp, path, mode)
+
+        with mock.patch.object(LocalSFTP, "open", failing_open):
+            self.sync("--async-channels", "3", "--async-max-file-size", "1000")
+        self.assertMirrored()
+        # Small files came over the async channels, but for the one that failed there.
+        self.assertEqual(self.lanes, {"5.txt": "download", "large.bin": "download-large",
+                                      "ranged.bin": "download-large"})
+
+    def test_archive(self) -> None:
+        # One of the files is a symlink by the time tar gets to it: it comes over SFTP instead.
+        start = LocalSSH.start
+        def racing_start(ssh, command, inputs=None):
+            if "tar " in command and os.path.isfile(os.path.join(self.remote, "small", "7.txt")):
+                os.remove(os.path.join(self.remote, "small", "7.txt"))
+                os.symlink("6.txt", os.path.join(self.remote, "small", "7.txt"))
+            return start(ssh, command, inputs)
+
+        with mock.patch.object(LocalSSH, "start", racing_start):
+            self.sync("--archive", "gzip", "--archive-max-file-size", "1000", "--archive-min-files", "2")
+        self.assertMirrored()
+        self.assertEqual(self.lanes, {"7.txt": "download", "large.bin": "download-large",
+                                      "ranged.bin": "download-large"})
+        self.assertEqual(read(self.local, "small/7.txt"), read(self.local, "small/6.txt"))
+
+    def test_remote_manifest(self) -> None:
+        listdir = LocalSFTP.listdir_iter
+        listed = []
+        def recording_listdir(sftp, path="."):
+            listed.append(path)
+            return listdir(sftp, path)
+
+        with mock.patch.object(LocalSFTP, "listdir_iter", recording_listdir):
+            self.sync("--remote-manifest")
+            self.assertMirrored()
+            self.assertEqual(len(self.lanes), 12)
+
+            write(self.remote, "small/3.txt", b"changed")
+            os.makedirs(os.path.join(self.remote, "new", "deeper"))
+            write(self.remote, "new/deeper/file.txt", b"new")
+            self.sync("--remote-manifest")
+            self.assertMirrored()
+            self.assertEqual(sorted(self.lanes), ["3.txt", "file.txt"])
+        # The remote was only ever listed by the manifest.
+        self.assertEqual(listed, [])